@@ -0,0 +1,430 @@
+/*
+ * ovirt-imageio
+ * Copyright (C) 2020 Red Hat, Inc.
+ *
+ * This program is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 2 of the License, or
+ * (at your option) any later version.
+*/
+
+/*
+ * Linux native asynchronous I/O, using the io_setup(2) family of system
+ * calls directly, so we don't depend on libaio.
+ *
+ * Native AIO is asynchronous only for files opened with O_DIRECT, which is
+ * how imageio opens images.
+ */
+
+#include <Python.h>
+
+#include <errno.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/syscall.h>
+#include <linux/aio_abi.h>
+
+static inline int
+io_setup(unsigned nr, aio_context_t *ctxp)
+{
+    return syscall(SYS_io_setup, nr, ctxp);
+}
+
+static inline int
+io_destroy(aio_context_t ctx)
+{
+    return syscall(SYS_io_destroy, ctx);
+}
+
+static inline int
+io_submit(aio_context_t ctx, long nr, struct iocb **iocbpp)
+{
+    return syscall(SYS_io_submit, ctx, nr, iocbpp);
+}
+
+static inline int
+io_getevents(aio_context_t ctx, long min_nr, long max_nr,
+             struct io_event *events, struct timespec *timeout)
+{
+    return syscall(SYS_io_getevents, ctx, min_nr, max_nr, events, timeout);
+}
+
+/*
+ * In-flight request. Keeps a reference to the buffer object until the
+ * request completes.
+ */
+typedef struct {
+    struct iocb iocb;
+    Py_buffer view;
+    PyObject *obj;
+} Slot;
+
+typedef struct {
+    PyObject_HEAD
+    aio_context_t ctx;
+    int nr_events;
+    int pending;
+    Slot *slots;
+    struct io_event *events;
+} Context;
+
+PyDoc_STRVAR(Context_doc, "\
+Context(nr_events)\n\
+Linux native AIO context, submitting up to nr_events requests at the same\n\
+time.\n\
+\n\
+Arguments\n\
+  nr_events (int):  maximum number of in-flight requests\n\
+\n\
+Raises\n\
+  OSError if the context cannot be created.\n\
+");
+
+static int
+Context_init(Context *self, PyObject *args, PyObject *kw)
+{
+    char *keywords[] = {"nr_events", NULL};
+    int nr_events;
+    int err;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "i:Context", keywords,
+                &nr_events))
+        return -1;
+
+    if (nr_events < 1) {
+        PyErr_SetString(PyExc_ValueError, "nr_events must be positive");
+        return -1;
+    }
+
+    if (self->slots != NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Context already initialized");
+        return -1;
+    }
+
+    self->slots = PyMem_Calloc(nr_events, sizeof(Slot));
+    self->events = PyMem_Calloc(nr_events, sizeof(struct io_event));
+    if (self->slots == NULL || self->events == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    self->ctx = 0;
+    err = io_setup(nr_events, &self->ctx);
+    if (err != 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return -1;
+    }
+
+    self->nr_events = nr_events;
+    self->pending = 0;
+    return 0;
+}
+
+static void
+release_slot(Slot *slot)
+{
+    PyBuffer_Release(&slot->view);
+    Py_CLEAR(slot->obj);
+}
+
+/*
+ * Wait for at least min_nr events, and return a list of (obj, result)
+ * tuples.
+ */
+static PyObject *
+wait_events(Context *self, int min_nr)
+{
+    PyObject *list;
+    int n;
+    int i;
+
+    if (min_nr > self->pending)
+        min_nr = self->pending;
+
+    do {
+        Py_BEGIN_ALLOW_THREADS
+        n = io_getevents(
+            self->ctx, min_nr, self->nr_events, self->events, NULL);
+        Py_END_ALLOW_THREADS
+    } while (n < 0 && errno == EINTR);
+
+    if (n < 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+
+    list = PyList_New(n);
+    if (list == NULL)
+        return NULL;
+
+    for (i = 0; i < n; i++) {
+        Slot *slot = &self->slots[self->events[i].data];
+        PyObject *item;
+
+        item = Py_BuildValue("(OL)", slot->obj,
+                             (long long)self->events[i].res);
+        release_slot(slot);
+        self->pending--;
+
+        if (item == NULL) {
+            Py_DECREF(list);
+            return NULL;
+        }
+
+        PyList_SET_ITEM(list, i, item);
+    }
+
+    return list;
+}
+
+static int
+check_open(Context *self)
+{
+    if (self->nr_events == 0) {
+        PyErr_SetString(PyExc_ValueError, "Context is closed");
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+submit(Context *self, PyObject *args, int opcode)
+{
+    int fd;
+    PyObject *obj;
+    long long offset;
+    Slot *slot = NULL;
+    struct iocb *iocbp;
+    int flags = opcode == IOCB_CMD_PREAD ? PyBUF_WRITABLE : PyBUF_SIMPLE;
+    int i;
+    int n;
+
+    if (!PyArg_ParseTuple(args, "iOL", &fd, &obj, &offset))
+        return NULL;
+
+    if (check_open(self))
+        return NULL;
+
+    if (self->pending == self->nr_events) {
+        PyErr_SetString(PyExc_RuntimeError, "Too many in-flight requests");
+        return NULL;
+    }
+
+    for (i = 0; i < self->nr_events; i++) {
+        if (self->slots[i].obj == NULL) {
+            slot = &self->slots[i];
+            break;
+        }
+    }
+
+    if (PyObject_GetBuffer(obj, &slot->view, flags))
+        return NULL;
+
+    Py_INCREF(obj);
+    slot->obj = obj;
+
+    memset(&slot->iocb, 0, sizeof(slot->iocb));
+    slot->iocb.aio_data = i;
+    slot->iocb.aio_lio_opcode = opcode;
+    slot->iocb.aio_fildes = fd;
+    slot->iocb.aio_buf = (uint64_t)(uintptr_t)slot->view.buf;
+    slot->iocb.aio_nbytes = slot->view.len;
+    slot->iocb.aio_offset = offset;
+
+    iocbp = &slot->iocb;
+
+    do {
+        Py_BEGIN_ALLOW_THREADS
+        n = io_submit(self->ctx, 1, &iocbp);
+        Py_END_ALLOW_THREADS
+    } while (n < 0 && errno == EINTR);
+
+    if (n != 1) {
+        if (n == 0)
+            errno = EAGAIN;
+        PyErr_SetFromErrno(PyExc_OSError);
+        release_slot(slot);
+        return NULL;
+    }
+
+    self->pending++;
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(Context_pread_doc, "\
+pread(fd, buf, offset)\n\
+Submit a request reading len(buf) bytes from fd at offset into buf.\n\
+\n\
+The buffer must not be modified until the request completes.\n\
+\n\
+Raises\n\
+  OSError if the request could not be submitted.\n\
+");
+
+static PyObject *
+Context_pread(Context *self, PyObject *args)
+{
+    return submit(self, args, IOCB_CMD_PREAD);
+}
+
+PyDoc_STRVAR(Context_pwrite_doc, "\
+pwrite(fd, buf, offset)\n\
+Submit a request writing buf to fd at offset.\n\
+\n\
+The buffer must not be modified until the request completes.\n\
+\n\
+Raises\n\
+  OSError if the request could not be submitted.\n\
+");
+
+static PyObject *
+Context_pwrite(Context *self, PyObject *args)
+{
+    return submit(self, args, IOCB_CMD_PWRITE);
+}
+
+PyDoc_STRVAR(Context_wait_doc, "\
+wait(min_nr=1)\n\
+Wait until at least min_nr requests complete, and return list of\n\
+(buf, result) tuples for completed requests. The result is the number of\n\
+bytes transferred, or a negative errno value if the request failed.\n\
+\n\
+Raises\n\
+  OSError if waiting failed.\n\
+");
+
+static PyObject *
+Context_wait(Context *self, PyObject *args, PyObject *kw)
+{
+    char *keywords[] = {"min_nr", NULL};
+    int min_nr = 1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kw, "|i:wait", keywords, &min_nr))
+        return NULL;
+
+    if (check_open(self))
+        return NULL;
+
+    return wait_events(self, min_nr);
+}
+
+static int
+close_context(Context *self)
+{
+    int err = 0;
+
+    if (self->nr_events == 0)
+        return 0;
+
+    /*
+     * The kernel may still access the buffers, so we must wait for
+     * in-flight requests before releasing them.
+     */
+    while (self->pending) {
+        PyObject *list = wait_events(self, self->pending);
+        if (list == NULL) {
+            err = -1;
+            break;
+        }
+        Py_DECREF(list);
+    }
+
+    if (err == 0) {
+        io_destroy(self->ctx);
+        self->nr_events = 0;
+    }
+
+    return err;
+}
+
+PyDoc_STRVAR(Context_close_doc, "\
+close()\n\
+Wait for in-flight requests and destroy the context.\n\
+");
+
+static PyObject *
+Context_close(Context *self, PyObject *Py_UNUSED(ignored))
+{
+    if (close_context(self))
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+Context_get_pending(Context *self, void *closure)
+{
+    return PyLong_FromLong(self->pending);
+}
+
+static void
+Context_dealloc(Context *self)
+{
+    if (close_context(self))
+        PyErr_WriteUnraisable((PyObject *)self);
+
+    PyMem_Free(self->slots);
+    PyMem_Free(self->events);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyMethodDef Context_methods[] = {
+    {"pread", (PyCFunction) Context_pread, METH_VARARGS, Context_pread_doc},
+    {"pwrite", (PyCFunction) Context_pwrite, METH_VARARGS,
+        Context_pwrite_doc},
+    {"wait", (PyCFunction) Context_wait, METH_VARARGS | METH_KEYWORDS,
+        Context_wait_doc},
+    {"close", (PyCFunction) Context_close, METH_NOARGS, Context_close_doc},
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef Context_getset[] = {
+    {"pending", (getter) Context_get_pending, NULL,
+        "Number of in-flight requests", NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject ContextType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "aio.Context",
+    .tp_doc = Context_doc,
+    .tp_basicsize = sizeof(Context),
+    .tp_itemsize = 0,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc) Context_init,
+    .tp_dealloc = (destructor) Context_dealloc,
+    .tp_methods = Context_methods,
+    .tp_getset = Context_getset,
+};
+
+#define MODULE_NAME "aio"
+#define MODULE_DOC "Linux native asynchronous I/O"
+
+static struct PyModuleDef moduledef = {
+    PyModuleDef_HEAD_INIT,
+    MODULE_NAME,
+    MODULE_DOC,
+    -1,
+    NULL,
+};
+
+PyMODINIT_FUNC
+PyInit_aio(void)
+{
+    PyObject *m;
+
+    if (PyType_Ready(&ContextType) < 0)
+        return NULL;
+
+    m = PyModule_Create(&moduledef);
+    if (m == NULL)
+        return NULL;
+
+    Py_INCREF(&ContextType);
+    if (PyModule_AddObject(m, "Context", (PyObject *)&ContextType) < 0) {
+        Py_DECREF(&ContextType);
+        Py_DECREF(m);
+        return NULL;
+    }
+
+    return m;
+}
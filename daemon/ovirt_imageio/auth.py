@@ -12,6 +12,7 @@ import threading
 import urllib.parse as urllib_parse
 
 from . import backends
+from . import cache
 from . import errors
 from . import util
 from . import measure
@@ -21,7 +22,8 @@ log = logging.getLogger("auth")
 
 class Ticket(object):
 
-    def __init__(self, ticket_dict):
+    def __init__(self, ticket_dict, cache=None, write_buffer_size=0,
+                 cache_extents=True):
         if not isinstance(ticket_dict, dict):
             raise errors.InvalidTicket(
                 "Invalid ticket: %r, expecting a dict" % ticket_dict)
@@ -59,6 +61,24 @@ class Ticket(object):
         # Ranges transferred by completed operations.
         self._completed = []
 
+        # Cached image extents, keyed by extents context. Invalidated when an
+        # operation modifying the image completes. Disabled if the image can
+        # be modified by another process.
+        self._cache_extents = cache_extents
+        self._extents = {}
+        self._generation = 0
+
+        # Cache for image data blocks, shared by all tickets, or None.
+        # Invalidated with the cached extents.
+        self._cache = cache
+
+        # Buffer coalescing small unaligned writes, shared by all backends
+        # of this ticket, or None.
+        self._write_buffer = None
+        if (write_buffer_size and "write" in self._ops and
+                self._url.scheme == "file"):
+            self._write_buffer = backends.file.WriteBuffer(write_buffer_size)
+
     @property
     def uuid(self):
         return self._uuid
@@ -102,6 +122,22 @@ class Ticket(object):
         """
         return self._dirty
 
+    @property
+    def cache(self):
+        """
+        Return the cache for image data blocks, or None if caching is
+        disabled.
+        """
+        return self._cache
+
+    @property
+    def write_buffer(self):
+        """
+        Return the buffer coalescing small unaligned writes, or None if
+        write buffering is disabled.
+        """
+        return self._write_buffer
+
     @property
     def idle_time(self):
         """
@@ -138,11 +174,90 @@ class Ticket(object):
     def _remove_operation(self, op):
         with self._lock:
             self._ongoing.remove(op)
-            r = measure.Range(op.offset, op.offset + op.done)
-            bisect.insort(self._completed, r)
+            for start, end in op.done_ranges():
+                bisect.insort(self._completed, measure.Range(start, end))
             self._completed = measure.merge_ranges(self._completed)
+            if op.modifies_image:
+                self._invalidate_extents()
+                if self._cache is not None:
+                    self._cache.discard(self)
         self.touch()
 
+    def extents(self, context, load):
+        """
+        Return image extents for context.
+
+        Extents are cached until an operation modifying the image completes.
+        If the extents are not cached, or caching is disabled, call load() to
+        get the extents from the backend.
+
+        Arguments:
+            context (str): extents context ("zero", "dirty")
+            load (callable): return sequence of extents for context
+        """
+        if not self._cache_extents:
+            return load()
+
+        with self._lock:
+            extents = self._extents.get(context)
+            if extents is not None:
+                log.debug("Using cached extents ticket=%s context=%s",
+                          self._uuid, context)
+                return extents
+            generation = self._generation
+
+        extents = load()
+
+        with self._lock:
+            # If the image was modified while we loaded the extents, they may
+            # be stale.
+            if generation == self._generation:
+                self._extents[context] = extents
+
+        return extents
+
+    def cached_extents(self, context):
+        """
+        Return cached image extents for context, or None if the extents are
+        not cached.
+        """
+        with self._lock:
+            return self._extents.get(context)
+
+    def cached_block(self, offset, load):
+        """
+        Return image data block at offset.
+
+        If the block is not cached, call load() to read the block from the
+        backend, and cache the block, unless the image was modified while
+        loading the block.
+
+        Arguments:
+            offset (int): block offset in the image
+            load (callable): return block data read from the backend
+        """
+        data = self._cache.get(self, offset)
+        if data is not None:
+            return data
+
+        with self._lock:
+            generation = self._generation
+
+        data = load()
+
+        with self._lock:
+            # If the image was modified while we loaded the block, it may be
+            # stale.
+            if generation == self._generation:
+                self._cache.put(self, offset, data)
+
+        return data
+
+    def _invalidate_extents(self):
+        # Must be called while holding the lock.
+        self._generation += 1
+        self._extents.clear()
+
     def active(self):
         return bool(self._ongoing)
 
@@ -158,8 +273,9 @@ class Ticket(object):
             # NOTE: this must not modify the ticket state.
             completed = [measure.Range(r.start, r.end)
                          for r in self._completed]
-            ongoing = [measure.Range(op.offset, op.offset + op.done)
-                       for op in self._ongoing]
+            ongoing = [measure.Range(start, end)
+                       for op in self._ongoing
+                       for start, end in op.done_ranges()]
 
         ranges = sorted(completed + ongoing)
         ranges = measure.merge_ranges(ranges)
@@ -243,8 +359,12 @@ def _validate(key, value, type):
 
 class Authorizer:
 
-    def __init__(self):
+    def __init__(self, cache_size=0, write_buffer_size=0, cache_extents=True):
         self._tickets = {}
+        # Cache for image data blocks shared by all tickets.
+        self._cache = cache.Cache(cache_size) if cache_size else None
+        self._write_buffer_size = write_buffer_size
+        self._cache_extents = cache_extents
 
     def add(self, ticket_dict):
         """
@@ -252,14 +372,25 @@ class Authorizer:
 
         Raises errors.InvalidTicket if ticket dict is invalid.
         """
-        ticket = Ticket(ticket_dict)
+        ticket = Ticket(
+            ticket_dict,
+            cache=self._cache,
+            write_buffer_size=self._write_buffer_size,
+            cache_extents=self._cache_extents)
+        old = self._tickets.get(ticket.uuid)
         self._tickets[ticket.uuid] = ticket
+        if old is not None and self._cache is not None:
+            self._cache.discard(old)
 
     def remove(self, ticket_id):
-        del self._tickets[ticket_id]
+        ticket = self._tickets.pop(ticket_id)
+        if self._cache is not None:
+            self._cache.discard(ticket)
 
     def clear(self):
         self._tickets.clear()
+        if self._cache is not None:
+            self._cache.clear()
 
     def get(self, ticket_id):
         """
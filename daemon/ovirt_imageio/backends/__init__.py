@@ -44,7 +44,8 @@ def get(req, ticket):
             ticket.url,
             mode,
             sparse=ticket.sparse,
-            dirty=ticket.dirty)
+            dirty=ticket.dirty,
+            write_buffer=ticket.write_buffer)
 
         req.context[ticket.uuid] = backend
 
@@ -12,6 +12,7 @@ import errno
 import logging
 import os
 import stat
+import threading
 
 from contextlib import closing
 
@@ -21,10 +22,19 @@ from .. import util
 
 from . import image
 
+# Maximum number of extents reported by extents(). In a very fragmented
+# file, the rest of the file is reported as data.
+MAX_EXTENTS = 100000
+
+# Number of extents detected at once. Extents are detected in batches while
+# iterating, so a caller consuming only some extents does not scan the rest
+# of the file, and memory usage does not depend on the number of extents.
+EXTENTS_BATCH = 1024
+
 log = logging.getLogger("backends.file")
 
 
-def open(url, mode, sparse=False, dirty=False):
+def open(url, mode, sparse=False, dirty=False, write_buffer=None):
     """
     Open a file backend.
 
@@ -33,13 +43,15 @@ def open(url, mode, sparse=False, dirty=False):
         mode: (str): "r" for readonly, "r+" for read write.
         sparse (bool): deallocate space when zeroing if possible.
         dirty (bool): ignored, file backend does not support dirty extents.
+        write_buffer (WriteBuffer): if set, coalesce small unaligned writes
+            using this buffer, shared by all backends of the same image.
     """
     fio = util.open(url.path, mode, direct=True)
     try:
         fio.name = url.path
         mode = os.fstat(fio.fileno()).st_mode
         backend = BlockBackend if stat.S_ISBLK(mode) else FileBackend
-        return backend(fio, sparse=sparse)
+        return backend(fio, sparse=sparse, write_buffer=write_buffer)
     except:  # noqa: E722
         fio.close()
         raise
@@ -50,23 +62,27 @@ class Backend(object):
     Base class for file backends.
     """
 
-    def __init__(self, fio, sparse=False):
+    def __init__(self, fio, sparse=False, write_buffer=None):
         """
         Initizlie an I/O backend.
 
         Arguments:
             fio (io.FileIO): underlying file object.
             sparse (bool): deallocate space when zeroing if possible.
+            write_buffer (WriteBuffer): if set, coalesce small unaligned
+                writes using this buffer.
         """
         log.debug("Open backend path=%s mode=%s sparse=%s)",
                   fio.name, fio.mode, sparse)
         self._fio = fio
         self._sparse = sparse
+        self._write_buffer = write_buffer
         self._dirty = False
 
     # io.FileIO interface
 
     def readinto(self, buf):
+        self._write_pending()
         return util.uninterruptible(self._fio.readinto, buf)
 
     def write(self, buf):
@@ -76,6 +92,7 @@ class Backend(object):
             return self._write_unaligned(buf)
         else:
             # The fast path.
+            self._write_pending()
             if self._aligned(len(buf)):
                 return util.uninterruptible(self._fio.write, buf)
             else:
@@ -86,6 +103,11 @@ class Backend(object):
     def tell(self):
         return self._fio.tell()
 
+    def fileno(self):
+        # The caller is going to access the file directly.
+        self._write_pending()
+        return self._fio.fileno()
+
     def seek(self, pos, how=os.SEEK_SET):
         return self._fio.seek(pos, how)
 
@@ -106,9 +128,27 @@ class Backend(object):
             log.debug("Close backend path=%s dirty=%s",
                       self._fio.name, self._dirty)
             try:
-                self._fio.close()
+                self._write_pending()
             finally:
-                self._fio = None
+                try:
+                    self._fio.close()
+                finally:
+                    self._fio = None
+
+    def clone(self):
+        """
+        Return new backend using the same file, with its own file descriptor
+        and position.
+        """
+        mode = "r+" if self._fio.writable() else "r"
+        fio = util.open(self._fio.name, mode, direct=True)
+        try:
+            fio.name = self._fio.name
+            return self.__class__(
+                fio, sparse=self._sparse, write_buffer=self._write_buffer)
+        except:  # noqa: E722
+            fio.close()
+            raise
 
     # Backend interface.
 
@@ -127,6 +167,7 @@ class Backend(object):
             return self._write_unaligned(b"\0" * count)
         else:
             # The fast path.
+            self._write_pending()
             count = util.round_down(count, self._block_size)
             if self._sparse:
                 return self._trim(count)
@@ -134,6 +175,7 @@ class Backend(object):
                 return self._zero(count)
 
     def flush(self):
+        self._write_pending()
         os.fsync(self._fio.fileno())
         self._dirty = False
 
@@ -141,14 +183,72 @@ class Backend(object):
     def block_size(self):
         return self._block_size
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", start=0, length=None):
+        """
+        Iterate over extents from start to the end of the file, or up to
+        start + length if length is specified.
+        """
         if context != "zero":
             raise errors.UnsupportedOperation(
                 "Backend {} does not support {} extents"
                 .format(self.name, context))
 
-        # TODO: Use qemu-img map to get extents.
-        yield image.ZeroExtent(0, self.size(), False)
+        end = self.size()
+        if length is not None:
+            end = min(start + length, end)
+
+        if not hasattr(os, "SEEK_DATA"):
+            yield image.ZeroExtent(start, end - start, False)
+            return
+
+        # The last extent is kept until the next batch is detected, since
+        # it is merged with the rest of the file if there are too many
+        # extents.
+        last = None
+        count = 0
+        offset = start
+
+        while offset < end:
+            if count >= MAX_EXTENTS - 1:
+                # Too many extents, report the rest of the range as data.
+                if last is not None and not last.zero:
+                    offset = last.start
+                elif last is not None:
+                    yield last
+                yield image.ZeroExtent(offset, end - offset, False)
+                return
+
+            batch = self._seek_extents(
+                offset, end, min(EXTENTS_BATCH, MAX_EXTENTS - 1 - count))
+
+            for ext in batch:
+                if last is not None:
+                    yield last
+                last = ext
+
+            count += len(batch)
+            offset = last.start + last.length
+
+        if last is not None:
+            yield last
+
+    def _seek_extents(self, start, end, limit):
+        """
+        Return list of up to limit extents from start to end.
+        """
+        # Seeking modifies the file position; restore it so the caller can
+        # use the backend while iterating.
+        pos = self._fio.tell()
+        try:
+            return _seek_extents(self._fio.fileno(), start, end, limit)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            log.debug("SEEK_DATA not supported for %s, reporting "
+                      "single data extent", self._fio.name)
+            return [image.ZeroExtent(start, end - start, False)]
+        finally:
+            self._fio.seek(pos)
 
     # Debugging interface
 
@@ -171,6 +271,8 @@ class Backend(object):
         return "file"
 
     def size(self):
+        # Pending blocks may extend the file.
+        self._write_pending()
         old_pos = self._fio.tell()
         self._fio.seek(0, os.SEEK_END)
         result = self._fio.tell()
@@ -185,6 +287,16 @@ class Backend(object):
         """
         return not (n & (self._block_size - 1))
 
+    def _write_pending(self):
+        """
+        Write blocks pending in the write buffer to storage.
+
+        Must be called before accessing storage, so we never read stale
+        data, or overwrite new data with older pending data.
+        """
+        if self._write_buffer is not None:
+            self._write_buffer.write_pending(self._fio.fileno())
+
     def _write_unaligned(self, buf):
         """
         Write up to block_size bytes from buf into the current block.
@@ -192,7 +304,9 @@ class Backend(object):
         If position is not aligned to block size, writes only up to end of
         current block.
 
-        Perform a read-modify-write on the current block:
+        If using a write buffer, merge the bytes into the pending block,
+        written to storage later. Otherwise perform a read-modify-write on
+        the current block:
         1. Read the current block
         2. copy bytes from buf into the block
         3. write the block back to storage.
@@ -204,6 +318,13 @@ class Backend(object):
         offset = start % self._block_size
         count = min(len(buf), self._block_size - offset)
 
+        if self._write_buffer is not None:
+            with memoryview(buf)[:count] as view:
+                self._write_buffer.write(
+                    self._fio.fileno(), self._block_size, start, view)
+            self.seek(start + count)
+            return count
+
         log.debug("Unaligned write start=%s offset=%s count=%s",
                   start, offset, count)
 
@@ -234,15 +355,18 @@ class BlockBackend(Backend):
     Block device backend.
     """
 
-    def __init__(self, fio, sparse=False):
+    def __init__(self, fio, sparse=False, write_buffer=None):
         """
         Initialize a BlockBackend.
 
         Arguments:
             fio (io.FileIO): underlying file object.
             sparse (bool): deallocate space when zeroing if possible.
+            write_buffer (WriteBuffer): if set, coalesce small unaligned
+                writes using this buffer.
         """
-        super(BlockBackend, self).__init__(fio, sparse=sparse)
+        super(BlockBackend, self).__init__(
+            fio, sparse=sparse, write_buffer=write_buffer)
         # May be set to False if the first call to fallocate() reveal that it
         # is not supported.
         self._can_fallocate = True
@@ -292,15 +416,18 @@ class FileBackend(Backend):
     Regular file backend.
     """
 
-    def __init__(self, fio, sparse=False):
+    def __init__(self, fio, sparse=False, write_buffer=None):
         """
         Initialize a FileBackend.
 
         Arguments:
             fio (io.FileIO): underlying file object.
             sparse (bool): deallocate space when zeroing if possible.
+            write_buffer (WriteBuffer): if set, coalesce small unaligned
+                writes using this buffer.
         """
-        super(FileBackend, self).__init__(fio, sparse=sparse)
+        super(FileBackend, self).__init__(
+            fio, sparse=sparse, write_buffer=write_buffer)
         # These will be set to False if the first call to fallocate() reveal
         # that it is not supported on the current file system.
         self._can_zero_range = True
@@ -444,3 +571,165 @@ class FileBackend(Backend):
         with util.aligned_buffer(buf_size) as buf, memoryview(buf) as view:
             while count:
                 count -= self.write(view[:count])
+
+
+class WriteBuffer(object):
+    """
+    Write-back buffer coalescing small unaligned writes to an image.
+
+    Without a buffer, every unaligned write performs a read-modify-write of
+    the block. With a buffer, unaligned writes are merged into pending
+    blocks in memory, and every block is written once. Blocks written
+    completely are written without reading them from storage.
+
+    Pending blocks are written to storage when the buffer is full, on the
+    first write after the oldest pending block was added more than
+    write_after seconds ago, and by the backends before accessing storage,
+    flushing, or closing. There is no timer; pending blocks of an idle
+    image are kept until the next access, so write_after does not bound
+    the time data may be lost. Flushing a backend writes all pending
+    blocks before syncing, so writes are durable after a flush, like
+    writes without a buffer.
+
+    The buffer is shared by all backends of the same image, and is thread
+    safe.
+    """
+
+    # Write pending blocks on the next write after this number of seconds.
+    WRITE_AFTER = 1.0
+
+    def __init__(self, max_size, write_after=WRITE_AFTER):
+        self.max_size = max_size
+        self.write_after = write_after
+        self._lock = threading.Lock()
+        # Pending blocks, keyed by block offset. Every block is a list of
+        # [aligned buffer, sorted list of written (start, end) ranges].
+        self._blocks = {}
+        self._block_size = None
+        # Time when the oldest pending block was added.
+        self._since = None
+
+    @property
+    def pending(self):
+        """
+        Number of pending blocks.
+        """
+        return len(self._blocks)
+
+    def write(self, fd, block_size, offset, buf):
+        """
+        Merge buf into the pending block at offset, writing pending blocks
+        to file descriptor fd if needed. buf must not cross a block
+        boundary.
+        """
+        with self._lock:
+            if self._blocks and (
+                    block_size != self._block_size or
+                    util.monotonic_time() - self._since > self.write_after):
+                self._write_pending(fd)
+
+            start = offset - offset % block_size
+            block = self._blocks.get(start)
+            if block is None:
+                if (len(self._blocks) + 1) * block_size > self.max_size:
+                    self._write_pending(fd)
+                if not self._blocks:
+                    self._block_size = block_size
+                    self._since = util.monotonic_time()
+                block = [util.aligned_buffer(block_size), []]
+                self._blocks[start] = block
+
+            data, ranges = block
+            pos = offset - start
+            data[pos:pos + len(buf)] = buf
+            block[1] = _merge_range(ranges, pos, pos + len(buf))
+
+    def write_pending(self, fd):
+        """
+        Write pending blocks to file descriptor fd.
+        """
+        with self._lock:
+            self._write_pending(fd)
+
+    def _write_pending(self, fd):
+        # Must be called while holding the lock.
+        if not self._blocks:
+            return
+
+        log.debug("Writing %d pending blocks", len(self._blocks))
+        block_size = self._block_size
+        tmp = None
+        try:
+            for start in sorted(self._blocks):
+                data, ranges = self._blocks[start]
+                if ranges == [(0, block_size)]:
+                    src = data
+                else:
+                    # Read the rest of the block from storage. Reading
+                    # after the end of the file is padded with zeroes.
+                    if tmp is None:
+                        tmp = util.aligned_buffer(block_size)
+                    n = util.uninterruptible(os.preadv, fd, [tmp], start)
+                    tmp[n:] = b"\0" * (block_size - n)
+                    for s, e in ranges:
+                        tmp[s:e] = data[s:e]
+                    src = tmp
+
+                util.uninterruptible(os.pwrite, fd, src, start)
+
+                # Keep blocks that were not written if writing failed.
+                del self._blocks[start]
+                data.close()
+        finally:
+            if tmp is not None:
+                tmp.close()
+
+        self._since = None
+
+
+def _seek_extents(fd, start, end, limit):
+    """
+    Return list of up to limit zero extents from start to end, using
+    SEEK_DATA and SEEK_HOLE. Holes are reported as zero extents. If the range
+    has more than limit extents, the last extent ends before end.
+
+    Raises OSError with EINVAL if the file system does not support seeking
+    data and holes.
+    """
+    extents = []
+    offset = start
+    while offset < end and len(extents) < limit:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # No more data after offset.
+            if e.errno != errno.ENXIO:
+                raise
+            data = end
+
+        if data > offset:
+            next_offset = min(data, end)
+            zero = True
+        else:
+            next_offset = min(os.lseek(fd, offset, os.SEEK_HOLE), end)
+            zero = False
+
+        extents.append(
+            image.ZeroExtent(offset, next_offset - offset, zero))
+        offset = next_offset
+
+    return extents
+
+
+def _merge_range(ranges, start, end):
+    """
+    Return sorted list of ranges, adding range (start, end) and merging
+    overlapping and adjacent ranges.
+    """
+    merged = []
+    for s, e in sorted(ranges + [(start, end)]):
+        if merged and s <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], e))
+        else:
+            merged.append((s, e))
+    return merged
@@ -15,16 +15,28 @@ import http.client as http_client
 import json
 import logging
 import os
+import select
 import socket
 import ssl
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import compression
 from .. import errors
 from . import image
 
+# Maximum number of idle connections kept in a connection pool.
+MAX_IDLE = 8
+
+# Maximum number of zero requests sent in a single batched PATCH request.
+MAX_BATCH = 128
+
 log = logging.getLogger("backends.http")
 
 
-def open(url, mode, sparse=True, dirty=False, cafile=None, secure=True):
+def open(url, mode, sparse=True, dirty=False, cafile=None, secure=True,
+         pool=None, encoding=None):
     """
     Open a HTTP backend.
 
@@ -38,32 +50,60 @@ def open(url, mode, sparse=True, dirty=False, cafile=None, secure=True):
             verification. If not set, trust system's default CA certificates
             instead.
         secure (bool): If True, verify server certificate.
+        pool (ConnectionPool): if set, get connections from this pool.
+            The pool may be shared by backends for different images on the
+            same server. Otherwise the backend creates a private pool,
+            shared with its clones.
+        encoding (str): if set, compress transferred data using this
+            encoding ("zstd" or "gzip"), if the server supports it.
+            Compression is not used with unix socket.
     """
     assert url.scheme == "https"
-    return Backend(url, cafile, secure=secure)
+    return Backend(url, cafile, secure=secure, pool=pool, encoding=encoding)
 
 
 class Backend(object):
 
-    def __init__(self, url, cafile, secure=True):
-        log.debug("Open backend netloc=%s path=%s cafile=%s secure=%s",
-                  url.netloc, url.path, cafile, secure)
+    def __init__(self, url, cafile, secure=True, pool=None, encoding=None):
+        log.debug("Open backend netloc=%s path=%s cafile=%s secure=%s "
+                  "encoding=%s",
+                  url.netloc, url.path, cafile, secure, encoding)
         self.url = url
+        self._cafile = cafile
+        self._secure = secure
+        self._requested_encoding = encoding
         self._position = 0
         self._size = None
         self._extents = {}
-
-        self._con = self._create_connection(cafile, secure)
+        self._executor = None
+        # Zero messages not sent yet, when the server supports batching.
+        self._batch = []
+
+        # Backend without a pool owns a private pool, shared with its clones.
+        self._owns_pool = pool is None
+        if pool is None:
+            pool = ConnectionPool(url, cafile, secure=secure)
+        elif pool.netloc != url.netloc:
+            raise ValueError(
+                "Pool netloc {!r} does not match url netloc {!r}"
+                .format(pool.netloc, url.netloc))
+        self._pool = pool
+
+        self._con = self._pool.get()
         try:
-            options = self._options()
+            options = self._pool.options(url.path)
             log.debug("Server options: %s", options)
             self._can_extents = options.get("extents", False)
+            self._can_extents_range = options.get("extents_range", False)
+            self._can_extents_binary = options.get("extents_binary", False)
             self._can_zero = options.get("zero", False)
             self._can_flush = options.get("flush", False)
-
-            self._optimize_connection(options.get("unix_socket"))
+            self._can_batch = options.get("batch", False)
+            self._encoding = self._negotiate_encoding(encoding, options)
         except Exception:
             self._con.close()
+            if self._owns_pool:
+                self._pool.close()
             raise
 
     # Preferred interface.
@@ -78,6 +118,11 @@ class Backend(object):
             length (int): number of bytes to read from reader
             buf (buffer): buffer to used for reading and writing.
         """
+        self._send_batch()
+
+        if self._encoding:
+            return self._compressed_read_from(reader, length, buf)
+
         self._put_header(length)
 
         with memoryview(buf) as view:
@@ -114,6 +159,11 @@ class Backend(object):
             length (int): number of bytes to read from reader
             buf (buffer): buffer to used for reading and writing.
         """
+        self._send_batch()
+
+        if self._encoding:
+            return self._compressed_write_to(writer, length, buf)
+
         res = self._get(length)
 
         with memoryview(buf) as view:
@@ -138,9 +188,16 @@ class Backend(object):
         """
         Send GET request, reading bytes at current position into buf.
         """
+        self._send_batch()
+
         length = len(buf)
         res = self._get(length)
-        self._read_all(res, buf)
+
+        encoding = res.getheader("content-encoding")
+        if encoding:
+            self._read_compressed(res, encoding, buf)
+        else:
+            self._read_all(res, buf)
 
         self._position += length
         return length
@@ -149,7 +206,13 @@ class Backend(object):
         """
         Send PUT request, writing buf contents at current position.
         """
+        self._send_batch()
+
         length = len(buf)
+        if self._encoding:
+            data = compression.compress(self._encoding, buf)
+            return self._put_compressed(length, data)
+
         self._put_header(length)
         self._con.send(buf)
         res = self._con.getresponse()
@@ -167,6 +230,10 @@ class Backend(object):
     def zero(self, length):
         """
         Send PATCH/zero request, writing zeroes at current position.
+
+        If the server supports batching, the request is queued and sent
+        with the next zero requests in a single PATCH request, before the
+        next request using the connection.
         """
         if not self._can_zero:
             return self._emulate_zero(length)
@@ -177,17 +244,30 @@ class Backend(object):
             "size": length,
             "flush": not self._can_flush
         }
-        self._patch(msg)
+
+        if self._can_batch:
+            self._batch.append(msg)
+            if len(self._batch) >= MAX_BATCH:
+                self._send_batch()
+        else:
+            self._patch(msg)
 
         self._position += length
         return length
 
     def flush(self):
         """
-        Send a PATCH/flush request, flushing changes to storage.
+        Send a PATCH/flush request, flushing changes to storage. Queued zero
+        requests are sent with the flush request.
         """
         if self._can_flush:
-            self._patch({"op": "flush"})
+            if self._batch:
+                self._batch.append({"op": "flush"})
+                self._send_batch()
+            else:
+                self._patch({"op": "flush"})
+        else:
+            self._send_batch()
 
     def extents(self, context="zero"):
         """
@@ -196,6 +276,8 @@ class Backend(object):
         if context not in ("zero", "dirty"):
             raise RuntimeError("Invalid context: {}".format(context))
 
+        self._send_batch()
+
         if not self._can_extents:
             if context == "zero":
                 yield image.ZeroExtent(0, self.size(), False)
@@ -204,8 +286,15 @@ class Backend(object):
                 raise errors.UnsupportedOperation(
                     "Server does not support dirty extents")
 
+        if self._can_extents_range:
+            # Get the extents in bounded chunks, without keeping all of them
+            # in memory.
+            for ext in self._iter_extents(context):
+                yield ext
+            return
+
         if context not in self._extents:
-            self._extents[context] = list(self._get_extents(context))
+            _, self._extents[context] = self._get_extents(context)
 
         for ext in self._extents[context]:
             yield ext
@@ -222,6 +311,10 @@ class Backend(object):
             self._position = self.size() + n
         return self._position
 
+    @property
+    def name(self):
+        return "http"
+
     def size(self):
         # We have 2 bad options:
         # - Get last extent, may be slow, and may not be neded otherwise.
@@ -229,7 +322,8 @@ class Backend(object):
         # Getting extents is more polite, so lets use it if we can.
         if self._size is None:
             if self._can_extents:
-                last = list(self.extents())[-1]
+                for last in self.extents():
+                    pass
                 self._size = last.start + last.length
             else:
                 self._size = self._emulate_head()
@@ -237,9 +331,33 @@ class Backend(object):
         return self._size
 
     def close(self):
+        if self._con is None:
+            return
         log.debug("Close backend netloc=%s path=%s",
                   self.url.netloc, self.url.path)
-        self._con.close()
+        try:
+            self._send_batch()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+                self._executor = None
+            con = self._con
+            self._con = None
+            self._pool.put(con)
+            if self._owns_pool:
+                self._pool.close()
+
+    def clone(self):
+        """
+        Return new backend using another connection from the pool to the
+        same url, with its own position.
+        """
+        return Backend(
+            self.url,
+            self._cafile,
+            secure=self._secure,
+            pool=self._pool,
+            encoding=self._requested_encoding)
 
     def __enter__(self):
         return self
@@ -259,44 +377,39 @@ class Backend(object):
     def server_address(self):
         return self._con.server_address
 
+    @property
+    def encoding(self):
+        """
+        The encoding used to compress transferred data, or None.
+        """
+        return self._encoding
+
     # Private
 
-    def _create_connection(self, cafile, secure):
-        context = ssl.create_default_context(
-            purpose=ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    def _negotiate_encoding(self, encoding, options):
+        if encoding is None:
+            return None
 
-        if not secure:
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
+        if encoding not in compression.encodings():
+            raise ValueError("Unsupported encoding: {!r}".format(encoding))
 
-        return HTTPSConnection(self.url.netloc, context=context)
+        if not options.get(encoding, False):
+            log.debug("Server does not support %s compression", encoding)
+            return None
 
-    def _optimize_connection(self, unix_socket):
-        """
-        Try to switch to Unix socket for improved performane. If we fail to
-        switch continue to use HTTPS.
-        """
-        if not (self._con.is_local() and unix_socket):
-            return
+        # Compressing data over unix socket only wastes CPU time.
+        if self._pool.unix_socket:
+            log.debug("Using unix socket, disabling %s compression", encoding)
+            return None
 
-        try:
-            con = UnixHTTPConnection(unix_socket)
-            try:
-                con.connect()
-            except Exception:
-                con.close()
-                raise
-        except Exception as e:
-            log.warning("Cannot use unix socket: %s", e)
-        else:
-            log.debug("Using unix socket: %r", unix_socket)
-            self._con.close()
-            self._con = con
+        return encoding
 
     def _get(self, length):
         headers = {}
         headers["range"] = "bytes={}-{}".format(
             self._position, self._position + length - 1)
+        if self._encoding:
+            headers["accept-encoding"] = self._encoding
 
         self._con.request("GET", self.url.path, headers=headers)
         res = self._con.getresponse()
@@ -307,6 +420,10 @@ class Backend(object):
                 "Error GET offset={} length={}: {}"
                 .format(self._position, length, error))
 
+        # Compressed content length is the size of the compressed data.
+        if res.getheader("content-encoding"):
+            return res
+
         content_length = int(res.getheader("content-length"))
         if content_length != length:
             raise RuntimeError(
@@ -315,20 +432,129 @@ class Backend(object):
 
         return res
 
-    def _put_header(self, length):
+    def _put_header(self, length, content_length=None):
         path = self.url.path
         if self._can_flush:
             path += "?flush=n"
 
         self._con.putrequest("PUT", path)
 
-        self._con.putheader("content-length", length)
+        if content_length is None:
+            content_length = length
+        else:
+            self._con.putheader("content-encoding", self._encoding)
+
+        self._con.putheader("content-length", content_length)
         self._con.putheader("content-type", "application/octet-stream")
         self._con.putheader("content-range", "bytes {}-{}/*".format(
                 self._position, self._position + length - 1))
 
         self._con.endheaders()
 
+    def _put_compressed(self, length, data):
+        """
+        Send PUT request with compressed data, writing length bytes at
+        current position.
+        """
+        self._put_header(length, content_length=len(data))
+        self._con.send(data)
+        res = self._con.getresponse()
+
+        if res.status != http_client.OK:
+            error = res.read(512)
+            raise RuntimeError(
+                "Error PUT offset={} length={}: {}"
+                .format(self._position, length, error))
+
+        res.read()
+        self._position += length
+        return length
+
+    def _compressed_read_from(self, reader, length, buf):
+        """
+        Stream length bytes from reader, sending a compressed PUT request for
+        every buffer. The next buffer is compressed in another thread while
+        sending the previous buffer.
+        """
+        executor = self._get_executor()
+        pending = None
+
+        with memoryview(buf) as view:
+            max_step = len(view)
+            todo = length
+            while todo:
+                step = min(todo, max_step)
+                n = reader.readinto(view[:step])
+                if n == 0:
+                    raise RuntimeError(
+                        "Expected {} bytes, got {} bytes"
+                        .format(length, length - todo))
+
+                # The compressor copies the data, so the buffer can be reused
+                # once the future is done.
+                future = executor.submit(
+                    compression.compress, self._encoding, view[:n])
+                if pending:
+                    self._put_compressed(*pending)
+                pending = (n, future.result())
+                todo -= n
+
+        if pending:
+            self._put_compressed(*pending)
+
+        return length
+
+    def _compressed_write_to(self, writer, length, buf):
+        """
+        Stream length bytes to writer, sending a GET request accepting
+        compressed data for every buffer size. The previous response is
+        decompressed in another thread while receiving the next response.
+        """
+        executor = self._get_executor()
+        pending = None
+
+        max_step = len(buf)
+        todo = length
+        while todo:
+            step = min(todo, max_step)
+            res = self._get(step)
+            encoding = res.getheader("content-encoding")
+            if encoding:
+                data = res.read()
+            else:
+                data = bytearray(step)
+                self._read_all(res, data)
+
+            if pending:
+                writer.write(pending.result())
+            pending = executor.submit(_decompress, encoding, data, step)
+            self._position += step
+            todo -= step
+
+        if pending:
+            writer.write(pending.result())
+
+        return length
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        return self._executor
+
+    def _send_batch(self):
+        """
+        Send queued zero requests in a single PATCH request.
+        """
+        if not self._batch:
+            return
+
+        msgs = self._batch
+        self._batch = []
+        if len(msgs) == 1:
+            self._patch(msgs[0])
+        else:
+            self._patch(msgs)
+
     def _patch(self, msg):
         body = json.dumps(msg).encode("utf-8")
         headers = {"content-type": "application/json"}
@@ -342,42 +568,51 @@ class Backend(object):
 
         res.read()
 
-    def _options(self):
-        self._con.request("OPTIONS", self.url.path)
-        res = self._con.getresponse()
-        body = res.read()
+    def _iter_extents(self, context):
+        """
+        Iterate over extents, getting the next chunk of extents from the
+        start reported by the server, until the server does not report the
+        next start.
 
-        options = {}
+        The extents are fetched using another connection from the pool,
+        since the caller may use the backend while iterating, for example
+        when copying the extents in parallel.
+        """
+        con = self._pool.get()
+        try:
+            start = 0
+            while True:
+                res, extents = self._get_extents(context, start=start, con=con)
+                for ext in extents:
+                    yield ext
 
-        if res.status == http_client.METHOD_NOT_ALLOWED:
-            # Older daemon did not implement OPTIONS
-            return options
-        elif res.status == http_client.NO_CONTENT:
-            # Older proxy did implement OPTIONS but does not return any
-            # content.
-            return options
-        elif res.status != http_client.OK:
-            raise RuntimeError("Error OPTIONS: {}".format(body))
+                next_start = res.getheader("x-next-start")
+                if next_start is None:
+                    break
 
-        # New daemon or proxy provides options dict.
-        try:
-            options = json.loads(body.decode("utf-8"))
-        except ValueError:
-            # Bad response, we must assume we don't support any features or
-            # unix socket.
-            return options
-
-        # Flaten features into options dict to make it easier to consume.  If
-        # we get invalid response without feature list, assume the server does
-        # not support any feature.
-        for feature in options.pop("features", []):
-            options[feature] = True
+                start = int(next_start)
+        finally:
+            self._pool.put(con)
 
-        return options
+    def _get_extents(self, context, start=None, con=None):
+        """
+        Get extents from the server using con, or the backend connection if
+        con is not specified. Return the response and the extents as
+        image.ExtentList.
+        """
+        if con is None:
+            con = self._con
 
-    def _get_extents(self, context):
-        self._con.request("GET", self.url.path + "/extents?context=" + context)
-        res = self._con.getresponse()
+        path = self.url.path + "/extents?context=" + context
+        if start is not None:
+            path += "&start={}".format(start)
+
+        headers = {}
+        if self._can_extents_binary:
+            headers["accept"] = "application/octet-stream"
+
+        con.request("GET", path, headers=headers)
+        res = con.getresponse()
         data = res.read()
 
         if res.status == http_client.NOT_FOUND:
@@ -388,11 +623,16 @@ class Backend(object):
         if res.status != http_client.OK:
             raise RuntimeError("Error EXTENTS: {}".format(data[:512]))
 
+        if res.getheader("content-type") == "application/octet-stream":
+            return res, image.ExtentList.from_bytes(context, data)
+
         extents = json.loads(data.decode("utf-8"))
 
         cls = image.ZeroExtent if context == "zero" else image.DirtyExtent
-        for ext in extents:
-            yield cls(ext["start"], ext["length"], ext[context])
+        return res, image.ExtentList(
+            context,
+            (cls(ext["start"], ext["length"], ext[context])
+             for ext in extents))
 
     def _emulate_head(self):
         """
@@ -452,12 +692,355 @@ class Backend(object):
                         "Expected {} byes, got {} bytes".format(length, pos))
                 pos += n
 
+    def _read_compressed(self, res, encoding, buf):
+        """
+        Decompress the response body into buf while receiving it.
+        """
+        reader = compression.Reader(encoding, res)
+        self._read_all(reader, buf)
+
+        # Consume the end of the compressed data, so the connection can be
+        # used for the next request.
+        if reader.read(1) or res.read():
+            raise RuntimeError(
+                "Compressed data is larger than {} bytes".format(len(buf)))
+
+
+class ConnectionPool(object):
+    """
+    Pool of connections to an imageio server, keyed by the server netloc.
+
+    The pool can be shared by backends for different images on the same
+    server, for example when transferring several disks to the same host.
+    Connections and TLS sessions are reused for all images.
+
+    The pool sends an OPTIONS request for the url path using the first
+    connection, and caches the options of every image path. If the server
+    is on the local host and supports unix socket, all connections use the
+    unix socket.
+
+    Connections returned to the pool are reused by the next caller, avoiding
+    a new connection and TLS handshake. The pool is thread safe, and can
+    provide connections to parallel readers and writers.
+    """
+
+    def __init__(self, url, cafile=None, secure=True, maxsize=MAX_IDLE):
+        self.url = url
+        self.netloc = url.netloc
+        self._context = _create_context(cafile, secure)
+        self.session_cache = SessionCache()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._idle = []
+        # Options per image path.
+        self._options = {}
+        self._connected = False
+        self._unix_socket = None
+        self._closed = False
+
+    def get(self):
+        """
+        Return idle connection, or create a new connection.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Connection pool is closed")
+
+            while self._idle:
+                con = self._idle.pop()
+                if con.reusable():
+                    log.debug("Reusing connection to %s", self.url.netloc)
+                    return con
+                con.close()
+
+            connected = self._connected
+
+        if not connected:
+            return self._connect_first()
+
+        return self._connect()
+
+    def put(self, con):
+        """
+        Return connection to the pool. If the connection cannot be reused or
+        the pool is full, close it.
+        """
+        with self._lock:
+            if (not self._closed and
+                    len(self._idle) < self._maxsize and
+                    con.reusable()):
+                self._idle.append(con)
+                return
+
+        con.close()
+
+    def options(self, path=None):
+        """
+        Return server options for image path, sending an OPTIONS request if
+        the options are not cached yet. If path is not specified, return
+        the options for the pool url path.
+        """
+        if path is None:
+            path = self.url.path
+
+        with self._lock:
+            options = self._options.get(path)
+
+        if options is None:
+            con = self.get()
+            try:
+                options = _get_options(con, path)
+            finally:
+                self.put(con)
+            with self._lock:
+                self._options[path] = options
+
+        return options
+
+    @property
+    def unix_socket(self):
+        """
+        Return the unix socket path if connections use unix socket, or None.
+        """
+        return self._unix_socket
+
+    def close(self):
+        """
+        Close idle connections. Connections returned to the pool after it was
+        closed are closed.
+        """
+        with self._lock:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+
+        for con in idle:
+            con.close()
+
+    def _connect(self):
+        if self._unix_socket:
+            con = UnixHTTPConnection(self._unix_socket)
+        else:
+            con = HTTPSConnection(
+                self.url.netloc,
+                context=self._context,
+                session_cache=self.session_cache)
+        try:
+            con.connect()
+        except Exception:
+            con.close()
+            raise
+        return con
+
+    def _connect_first(self):
+        con = HTTPSConnection(
+            self.url.netloc,
+            context=self._context,
+            session_cache=self.session_cache)
+        try:
+            options = _get_options(con, self.url.path)
+            con = self._optimize_connection(con, options.get("unix_socket"))
+        except Exception:
+            con.close()
+            raise
+
+        with self._lock:
+            self._options[self.url.path] = options
+            self._connected = True
+
+        return con
+
+    def _optimize_connection(self, con, unix_socket):
+        """
+        Try to switch to Unix socket for improved performane. If we fail to
+        switch continue to use HTTPS.
+        """
+        if not (con.is_local() and unix_socket):
+            return con
+
+        try:
+            unix_con = UnixHTTPConnection(unix_socket)
+            try:
+                unix_con.connect()
+            except Exception:
+                unix_con.close()
+                raise
+        except Exception as e:
+            log.warning("Cannot use unix socket: %s", e)
+            return con
+
+        log.debug("Using unix socket: %r", unix_socket)
+        con.close()
+        self._unix_socket = unix_socket
+        return unix_con
+
 
-class HTTPSConnection(http_client.HTTPSConnection):
+def _decompress(encoding, data, size):
+    if encoding:
+        return compression.decompress(encoding, data, size)
+    return data
+
+
+def _create_context(cafile, secure):
+    context = ssl.create_default_context(
+        purpose=ssl.Purpose.SERVER_AUTH, cafile=cafile)
+
+    if not secure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+    return context
+
+
+def _get_options(con, path):
+    """
+    Send OPTIONS request using con, and return options dict.
+    """
+    con.request("OPTIONS", path)
+    res = con.getresponse()
+    body = res.read()
+
+    options = {}
+
+    if res.status == http_client.METHOD_NOT_ALLOWED:
+        # Older daemon did not implement OPTIONS
+        return options
+    elif res.status == http_client.NO_CONTENT:
+        # Older proxy did implement OPTIONS but does not return any
+        # content.
+        return options
+    elif res.status != http_client.OK:
+        raise RuntimeError("Error OPTIONS: {}".format(body))
+
+    # New daemon or proxy provides options dict.
+    try:
+        options = json.loads(body.decode("utf-8"))
+    except ValueError:
+        # Bad response, we must assume we don't support any features or
+        # unix socket.
+        return options
+
+    # Flaten features into options dict to make it easier to consume.  If
+    # we get invalid response without feature list, assume the server does
+    # not support any feature.
+    for feature in options.pop("features", []):
+        options[feature] = True
+
+    return options
+
+
+class PooledConnection(object):
+    """
+    Mixin tracking connection state, allowing reuse of connections from a
+    pool.
+    """
+
+    _busy = False
+    _response = None
+
+    def putrequest(self, *args, **kwargs):
+        self._busy = True
+        return super().putrequest(*args, **kwargs)
+
+    def getresponse(self):
+        res = super().getresponse()
+        self._busy = False
+        self._response = res
+        return res
+
+    def close(self):
+        super().close()
+        self._busy = False
+        self._response = None
+
+    def reusable(self):
+        """
+        Return True if the connection is idle and can send the next request.
+        """
+        # Request was not completed, or the response was not consumed.
+        if self._busy:
+            return False
+        if self._response is not None and not self._response.isclosed():
+            return False
+
+        # Server closed the connection while it was idle.
+        if self.sock is not None:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable:
+                return False
+
+        return True
+
+
+class SessionCache(object):
+    """
+    Cache the last TLS session, allowing new connections to the same server
+    to resume the session instead of performing a full handshake.
+
+    The cache is thread safe, and counts session resumption hits and misses.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        with self._lock:
+            return self._session
+
+    def put(self, session):
+        if session is None:
+            return
+        with self._lock:
+            self._session = session
+
+    def record(self, reused):
+        with self._lock:
+            if reused:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def hit_rate(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return self.hits / total if total else 0.0
+
+
+class HTTPSConnection(PooledConnection, http_client.HTTPSConnection):
     """
     Enhanced HTTPS connection.
     """
 
+    def __init__(self, host, session_cache=None, **kwargs):
+        super().__init__(host, **kwargs)
+        self._session_cache = session_cache
+
+    def connect(self):
+        if self._session_cache is None:
+            return super().connect()
+
+        # Like http.client.HTTPSConnection.connect(), resuming the cached
+        # session if possible.
+        http_client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(
+            self.sock,
+            server_hostname=server_hostname,
+            session=self._session_cache.get())
+        self._session_cache.record(self.sock.session_reused)
+
+    def getresponse(self):
+        res = super().getresponse()
+        # With TLSv1.3 the server sends the session ticket after the
+        # handshake, so the session is resumable only after reading data.
+        if self._session_cache is not None and self.sock is not None:
+            self._session_cache.put(self.sock.session)
+        return res
+
     def is_local(self):
         """
         Return True if connected to the local host.
@@ -475,7 +1058,7 @@ class HTTPSConnection(http_client.HTTPSConnection):
         return self.sock.getpeername()
 
 
-class UnixHTTPConnection(http_client.HTTPConnection):
+class UnixHTTPConnection(PooledConnection, http_client.HTTPConnection):
     """
     HTTP connection over unix domain socket.
     """
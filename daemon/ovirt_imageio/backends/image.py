@@ -8,8 +8,15 @@
 
 from __future__ import absolute_import
 
+import array
+import struct
+import sys
+
 from collections import namedtuple
 
+# Binary extents format header: number of extents.
+_HEADER = struct.Struct("!Q")
+
 
 class ZeroExtent(namedtuple("ZeroExtent", "start,length,zero")):
     """
@@ -38,3 +45,118 @@ class DirtyExtent(namedtuple("DirtyExtent", "start,length,dirty")):
 
     The extent always describes raw guest data.
     """
+
+
+class ExtentList(object):
+    """
+    Compact list of extents for a context ("zero", "dirty").
+
+    Extents are kept in parallel arrays of offsets, lengths and flags, using
+    17 bytes per extent instead of a Python object per extent. Accessing the
+    list returns ZeroExtent or DirtyExtent objects, depending on the context.
+
+    The list can be serialized to a binary format:
+
+        count (u64)
+        starts (u64 * count)
+        lengths (u64 * count)
+        flags (u8 * count)
+
+    All values are in network byte order.
+    """
+
+    def __init__(self, context, extents=()):
+        if context == "zero":
+            self._cls = ZeroExtent
+        elif context == "dirty":
+            self._cls = DirtyExtent
+        else:
+            raise ValueError("Invalid context: {}".format(context))
+
+        self.context = context
+        self._starts = array.array("Q")
+        self._lengths = array.array("Q")
+        self._flags = bytearray()
+
+        for ext in extents:
+            self.append(ext)
+
+    def append(self, ext):
+        self._starts.append(ext.start)
+        self._lengths.append(ext.length)
+        self._flags.append(1 if ext[2] else 0)
+
+    def __len__(self):
+        return len(self._flags)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            result = ExtentList(self.context)
+            result._starts = self._starts[index]
+            result._lengths = self._lengths[index]
+            result._flags = self._flags[index]
+            return result
+
+        return self._cls(
+            self._starts[index],
+            self._lengths[index],
+            bool(self._flags[index]))
+
+    def __iter__(self):
+        cls = self._cls
+        for start, length, flag in zip(
+                self._starts, self._lengths, self._flags):
+            yield cls(start, length, bool(flag))
+
+    def __repr__(self):
+        return "<ExtentList context={} length={} at 0x{:x}>".format(
+            self.context, len(self), id(self))
+
+    def to_bytes(self):
+        """
+        Return the extents in binary format.
+        """
+        starts = array.array("Q", self._starts)
+        lengths = array.array("Q", self._lengths)
+        if sys.byteorder == "little":
+            starts.byteswap()
+            lengths.byteswap()
+
+        return b"".join((
+            _HEADER.pack(len(self)),
+            starts.tobytes(),
+            lengths.tobytes(),
+            bytes(self._flags),
+        ))
+
+    @classmethod
+    def from_bytes(cls, context, data):
+        """
+        Create extent list from extents in binary format.
+
+        Raises ValueError if data is not valid.
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError("Extents data too short: {}".format(len(data)))
+
+        count, = _HEADER.unpack_from(data)
+        expected = _HEADER.size + count * 17
+        if len(data) != expected:
+            raise ValueError(
+                "Invalid extents data size: {}, expecting {}"
+                .format(len(data), expected))
+
+        self = cls(context)
+        with memoryview(data) as view:
+            pos = _HEADER.size
+            self._starts.frombytes(view[pos:pos + count * 8])
+            pos += count * 8
+            self._lengths.frombytes(view[pos:pos + count * 8])
+            pos += count * 8
+            self._flags[:] = view[pos:]
+
+        if sys.byteorder == "little":
+            self._starts.byteswap()
+            self._lengths.byteswap()
+
+        return self
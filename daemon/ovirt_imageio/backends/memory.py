@@ -11,6 +11,7 @@ from __future__ import absolute_import
 import io
 import logging
 import os
+import threading
 
 from .. import errors
 from . import image
@@ -18,7 +19,7 @@ from . import image
 log = logging.getLogger("backends.memory")
 
 
-def open(url, mode, sparse=False, dirty=False):
+def open(url, mode, sparse=False, dirty=False, write_buffer=None):
     """
     Open a memory backend.
 
@@ -27,6 +28,8 @@ def open(url, mode, sparse=False, dirty=False):
         mode: (str): "r" for readonly, "w" for write only, "r+" for read write.
         sparse (bool): ignored, memory backend does not support sparseness.
         dirty (bool): ignored, memory backend does not support dirty extents.
+        write_buffer (file.WriteBuffer): ignored, memory backend does not need
+            to coalesce unaligned writes.
     """
     return Backend(mode)
 
@@ -41,33 +44,63 @@ class Backend(object):
             raise ValueError("Unsupported mode %r" % mode)
         self._mode = mode
         self._buf = io.BytesIO(data)
-        self._dirty = False
+        # Clones share the buffer and the dirty state, each with its own
+        # position.
+        self._lock = threading.Lock()
+        self._position = 0
+        self._shared = False
+        self._dirty = threading.Event()
 
     # io.BaseIO interface
 
     def readinto(self, buf):
         if not self.readable():
             raise IOError("Unsupproted operation: read")
-        return self._buf.readinto(buf)
+        with self._lock:
+            self._buf.seek(self._position)
+            n = self._buf.readinto(buf)
+            self._position = self._buf.tell()
+        return n
 
     def write(self, buf):
         if not self.writable():
             raise IOError("Unsupproted operation: write")
-        self._dirty = True
-        return self._buf.write(buf)
+        self._dirty.set()
+        with self._lock:
+            self._buf.seek(self._position)
+            n = self._buf.write(buf)
+            self._position = self._buf.tell()
+        return n
 
     def tell(self):
-        return self._buf.tell()
+        return self._position
 
     def seek(self, pos, how=os.SEEK_SET):
-        return self._buf.seek(pos, how)
+        with self._lock:
+            self._buf.seek(self._position)
+            self._position = self._buf.seek(pos, how)
+        return self._position
 
     def flush(self):
         self._buf.flush()
-        self._dirty = False
+        self._dirty.clear()
 
     def close(self):
-        self._buf.close()
+        # Closing a clone must not close the shared buffer.
+        if not self._shared:
+            self._buf.close()
+
+    def clone(self):
+        """
+        Return new backend sharing the same buffer and dirty state, with its
+        own position.
+        """
+        backend = self.__class__(self._mode)
+        backend._buf = self._buf
+        backend._lock = self._lock
+        backend._dirty = self._dirty
+        backend._shared = True
+        return backend
 
     def __enter__(self):
         return self
@@ -86,23 +119,30 @@ class Backend(object):
     def zero(self, count):
         if not self.writable():
             raise IOError("Unsupproted operation: truncate")
-        self._dirty = True
-        self._buf.write(b"\0" * count)
+        self._dirty.set()
+        with self._lock:
+            self._buf.seek(self._position)
+            self._buf.write(b"\0" * count)
+            self._position = self._buf.tell()
         return count
 
     @property
     def block_size(self):
         return 1
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", start=0, length=None):
         if context != "zero":
             raise errors.UnsupportedOperation(
                 "Backend {} does not support {} extents"
                 .format(self.name, context))
 
+        end = self.size()
+        if length is not None:
+            end = min(start + length, end)
+
         # TODO: We can detect zeroes in underlying buffer and return more
         # interesting results.
-        yield image.ZeroExtent(0, self.size(), False)
+        yield image.ZeroExtent(start, end - start, False)
 
     # Debugging interface
 
@@ -117,7 +157,7 @@ class Backend(object):
         """
         Returns True if backend was modifed and needs flushing.
         """
-        return self._dirty
+        return self._dirty.is_set()
 
     @property
     def sparse(self):
@@ -128,11 +168,8 @@ class Backend(object):
         return "memory"
 
     def size(self):
-        old_pos = self._buf.tell()
-        self._buf.seek(0, os.SEEK_END)
-        result = self._buf.tell()
-        self._buf.seek(old_pos, os.SEEK_SET)
-        return result
+        with self._lock:
+            return self._buf.seek(0, os.SEEK_END)
 
     def data(self):
         return self._buf.getvalue()
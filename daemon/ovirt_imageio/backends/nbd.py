@@ -22,7 +22,7 @@ log = logging.getLogger("backends.nbd")
 Error = nbd.Error
 
 
-def open(url, mode, sparse=True, dirty=False):
+def open(url, mode, sparse=True, dirty=False, write_buffer=None):
     """
     Open a NBD backend.
 
@@ -37,6 +37,8 @@ def open(url, mode, sparse=True, dirty=False):
             qemu always deallocate space when zeroing.
         dirty (bool): if True, configure the client to report dirty extents.
             Can work only when connecting to qemu during incremental backup.
+        write_buffer (file.WriteBuffer): ignored, NBD backend does not need
+            to coalesce unaligned writes.
     """
     client = nbd.open(url, dirty=dirty)
     try:
@@ -108,6 +110,21 @@ class Backend(object):
     def close(self):
         self._client.close()
 
+    def clone(self):
+        """
+        Return new backend connected to the same export, with its own
+        position.
+        """
+        client = nbd.Client(
+            self._client.address,
+            self._client.export_name,
+            dirty=self._client.dirty_bitmap is not None)
+        try:
+            return Backend(client, self._mode)
+        except:  # noqa: E722
+            client.close()
+            raise
+
     def __enter__(self):
         return self
 
@@ -120,15 +137,23 @@ class Backend(object):
                 raise
             log.exception("Error closing")
 
-    def extents(self, context="zero"):
+    def extents(self, context="zero", start=0, length=None):
+        """
+        Iterate over extents from start to the end of the export, or up to
+        start + length if length is specified.
+        """
         if context not in ("zero", "dirty"):
             raise errors.UnsupportedOperation(
                 "Backend nbd does not support {} extents".format(context))
 
+        end = self._client.export_size
+        if length is not None:
+            end = min(start + length, end)
+
         # If server does not support base:allocation, we can safely report one
         # data extent like other backends.
         if context == "zero" and not self._client.base_allocation:
-            yield image.ZeroExtent(0, self._client.export_size, False)
+            yield image.ZeroExtent(start, end - start, False)
             return
 
         # If dirty extents are not available, client may be able to use zero
@@ -139,8 +164,8 @@ class Backend(object):
                 .format(self._client.export_name))
 
         dirty = context == "dirty"
-        start = 0
-        for ext in nbdutil.extents(self._client, dirty=dirty):
+        for ext in nbdutil.extents(
+                self._client, offset=start, length=end - start, dirty=dirty):
             if dirty:
                 yield image.DirtyExtent(start, ext.length, ext.dirty)
             else:
@@ -156,6 +181,11 @@ class Backend(object):
         # handle unaligned reads and writes.
         return self._client.preferred_block_size
 
+    @property
+    def max_request_size(self):
+        # Larger reads and writes must be split by the caller.
+        return self._client.maximum_block_size
+
     # Debugging interface
 
     def readable(self):
@@ -0,0 +1,251 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+"""
+cache - cache image data read by clients.
+
+Clients reading the same image regions repeatedly, for example when
+browsing file system metadata during file level restore, or when several
+connections read the same image, can be served from memory instead of
+reading from storage again.
+
+The cache keeps aligned blocks of image data, keyed by ticket and block
+offset, evicting the least recently used blocks when the cache is full. All
+tickets share the same cache, bounding the memory used by the daemon.
+Blocks cached for a ticket are dropped when an operation modifying the
+image completes, or when the ticket is removed.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+import os
+import threading
+
+from . import metrics
+from . import util
+
+# Size of cached blocks. Reads are rounded to this size, so small reads
+# read a whole block from storage on the first access.
+BLOCK_SIZE = 64 * 1024
+
+# Reads larger than this bypass the cache. Large sequential reads, like
+# downloading the entire image, are unlikely to be repeated, and would evict
+# the small blocks that are worth caching. Reading them directly from the
+# backend can also use sendfile() or native AIO.
+MAX_READ_SIZE = 4 * BLOCK_SIZE
+
+log = logging.getLogger("cache")
+
+
+class Cache(object):
+    """
+    Bounded cache of image blocks with LRU eviction.
+
+    Blocks are keyed by (owner, offset). The owner is typically an
+    auth.Ticket, so blocks of a removed ticket are never returned for a new
+    ticket using the same id.
+
+    Thread safety: the cache is shared by all connections.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Cached blocks, least recently used first.
+        self._blocks = collections.OrderedDict()
+        # Offsets of cached blocks, keyed by owner.
+        self._owners = {}
+        self._size = 0
+
+    @property
+    def size(self):
+        """
+        Number of bytes cached.
+        """
+        return self._size
+
+    def get(self, owner, offset):
+        """
+        Return the data cached for owner at offset, or None.
+        """
+        key = (owner, offset)
+        with self._lock:
+            data = self._blocks.get(key)
+            if data is not None:
+                self._blocks.move_to_end(key)
+
+        if data is None:
+            metrics.CACHE_MISSES.inc()
+        else:
+            metrics.CACHE_HITS.inc()
+
+        return data
+
+    def put(self, owner, offset, data):
+        """
+        Cache data for owner at offset, evicting the least recently used
+        blocks if the cache is full.
+        """
+        if len(data) > self.max_size:
+            return
+
+        key = (owner, offset)
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            else:
+                self._owners.setdefault(owner, set()).add(offset)
+
+            self._blocks[key] = data
+            self._size += len(data)
+
+            while self._size > self.max_size:
+                (victim, victim_offset), victim_data = self._blocks.popitem(
+                    last=False)
+                self._size -= len(victim_data)
+                self._remove_offset(victim, victim_offset)
+                metrics.CACHE_EVICTIONS.inc()
+
+    def discard(self, owner):
+        """
+        Drop all blocks cached for owner.
+        """
+        with self._lock:
+            offsets = self._owners.pop(owner, ())
+            for offset in offsets:
+                data = self._blocks.pop((owner, offset))
+                self._size -= len(data)
+
+        # Tickets call this while holding the ticket lock, so formatting the
+        # owner would deadlock.
+        if offsets:
+            log.debug("Dropped %d cached blocks", len(offsets))
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self._owners.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def _remove_offset(self, owner, offset):
+        # Must be called while holding the lock.
+        offsets = self._owners[owner]
+        offsets.discard(offset)
+        if not offsets:
+            del self._owners[owner]
+
+    def __repr__(self):
+        return ("<Cache max_size={self.max_size} size={self.size} "
+                "blocks={blocks} at 0x{id}>").format(
+                    self=self, blocks=len(self), id=id(self))
+
+
+class Backend(object):
+    """
+    Backend wrapper reading image data through the ticket cache.
+
+    Reads are served from cached blocks. Missing blocks are read from the
+    wrapped backend and added to the cache. Only the interface used by
+    ops.Send is supported.
+
+    The wrapper does not own the backend; close() releases only the
+    wrapper buffer.
+    """
+
+    def __init__(self, backend, ticket, block_size=BLOCK_SIZE):
+        self._backend = backend
+        self._ticket = ticket
+        self._cache_block_size = block_size
+        self._position = 0
+        self._buf = None
+
+    @property
+    def name(self):
+        return self._backend.name
+
+    @property
+    def block_size(self):
+        return self._backend.block_size
+
+    def size(self):
+        return self._backend.size()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, n, how=os.SEEK_SET):
+        if how == os.SEEK_SET:
+            self._position = n
+        elif how == os.SEEK_CUR:
+            self._position += n
+        elif how == os.SEEK_END:
+            self._position = self._backend.size() + n
+        return self._position
+
+    def readinto(self, buf):
+        """
+        Read data at the current position into buf, returning the number of
+        bytes read. Returns less than len(buf) only at the end of the image.
+        """
+        with memoryview(buf) as view:
+            pos = 0
+            while pos < len(view):
+                with view[pos:] as v:
+                    n = self._read_block(v)
+                if n == 0:
+                    break
+                pos += n
+        return pos
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
+
+    def _read_block(self, view):
+        """
+        Copy data from the block including the current position into view,
+        up to the end of the block.
+        """
+        offset = self._position % self._cache_block_size
+        start = self._position - offset
+        data = self._ticket.cached_block(start, lambda: self._load(start))
+
+        n = max(0, min(len(view), len(data) - offset))
+        if n:
+            with memoryview(data)[offset:offset + n] as src:
+                view[:n] = src
+            self._position += n
+
+        return n
+
+    def _load(self, start):
+        """
+        Read the block at start from the backend. The block may be shorter
+        at the end of the image.
+        """
+        if self._buf is None:
+            self._buf = util.aligned_buffer(self._cache_block_size)
+
+        self._backend.seek(start)
+        with memoryview(self._buf) as view:
+            pos = 0
+            while pos < len(view):
+                with view[pos:] as v:
+                    n = self._backend.readinto(v)
+                pos += n
+                # Short read: we reached the end of the image.
+                if n == 0 or pos % self._backend.block_size:
+                    break
+
+        return self._buf[:pos]
@@ -26,10 +26,12 @@ from . nbd import UnixAddress
 
 # Used by examles to set default value.
 BUFFER_SIZE = io.BUFFER_SIZE
+MAX_WORKERS = io.MAX_WORKERS
 
 
 def upload(filename, url, cafile, buffer_size=BUFFER_SIZE, secure=True,
-           progress=None):
+           progress=None, max_workers=MAX_WORKERS, compression=None,
+           pool=None, adaptive=False):
     """
     Upload filename to url
 
@@ -46,6 +48,19 @@ def upload(filename, url, cafile, buffer_size=BUFFER_SIZE, secure=True,
             progress.update() will be called after every write or zero
             operation with the number bytes transferred. For backward
             compatibility, we still support passing an update callable.
+        max_workers (int): Maximum number of connections used to transfer
+            data in parallel.
+        compression (str): Compress transferred data using this encoding
+            ("zstd" or "gzip"), if the server supports it. Helps when the
+            network is slower than compression. Default is None, sending
+            uncompressed data.
+        pool (http.ConnectionPool): Get connections from this pool. Use the
+            same pool to transfer several disks to the same server, reusing
+            connections and TLS sessions. The pool is not closed when the
+            transfer completes. Default is None, using a private pool.
+        adaptive (bool): Adapt the buffer size of every connection to the
+            measured throughput, starting with buffer_size. Default is
+            False, using buffer_size.
     """
     http_url = urlparse(url)
     if callable(progress):
@@ -55,13 +70,26 @@ def upload(filename, url, cafile, buffer_size=BUFFER_SIZE, secure=True,
     if progress:
         progress.size = info["virtual-size"]
 
-    with _open_nbd(filename, info["format"], read_only=True) as src, \
-            http.open(http_url, "w", cafile=cafile, secure=secure) as dst:
-        io.copy(src, dst, buffer_size=buffer_size, progress=progress)
+    with _open_nbd(filename, info["format"], read_only=True,
+                   shared=max_workers) as src, \
+            http.open(http_url, "w", cafile=cafile, secure=secure,
+                      pool=pool, encoding=compression) as dst:
+        # Images may contain big runs of zeroes that are not reported as
+        # zero extents; zeroing them is much faster than sending them.
+        io.copy(
+            src,
+            dst,
+            buffer_size=buffer_size,
+            progress=progress,
+            max_workers=max_workers,
+            adaptive=adaptive,
+            detect_zeroes=True)
 
 
 def download(url, filename, cafile, fmt="qcow2", incremental=False,
-             buffer_size=BUFFER_SIZE, secure=True, progress=None):
+             buffer_size=BUFFER_SIZE, secure=True, progress=None,
+             max_workers=MAX_WORKERS, compression=None, pool=None,
+             adaptive=False):
     """
     Download url to filename.
 
@@ -82,6 +110,19 @@ def download(url, filename, cafile, fmt="qcow2", incremental=False,
         progress (ui.ProgressBar): an object implementing update(int).
             progress.update() will be called after every write or zero
             operation with the number bytes transferred.
+        max_workers (int): Maximum number of connections used to transfer
+            data in parallel.
+        compression (str): Compress transferred data using this encoding
+            ("zstd" or "gzip"), if the server supports it. Helps when the
+            network is slower than compression. Default is None, sending
+            uncompressed data.
+        pool (http.ConnectionPool): Get connections from this pool. Use the
+            same pool to transfer several disks to the same server, reusing
+            connections and TLS sessions. The pool is not closed when the
+            transfer completes. Default is None, using a private pool.
+        adaptive (bool): Adapt the buffer size of every connection to the
+            measured throughput, starting with buffer_size. Default is
+            False, using buffer_size.
     """
     if incremental and fmt != "qcow2":
         raise ValueError(
@@ -90,14 +131,15 @@ def download(url, filename, cafile, fmt="qcow2", incremental=False,
 
     http_url = urlparse(url)
 
-    with http.open(http_url, "r", cafile=cafile, secure=secure) as src:
+    with http.open(http_url, "r", cafile=cafile, secure=secure,
+                   pool=pool, encoding=compression) as src:
         size = src.size()
         if progress:
             progress.size = size
 
         qemu_img.create(filename, fmt, size=size)
 
-        with _open_nbd(filename, fmt) as dst:
+        with _open_nbd(filename, fmt, shared=max_workers) as dst:
             # We created new empty file, no need to zero.
             io.copy(
                 src,
@@ -105,7 +147,9 @@ def download(url, filename, cafile, fmt="qcow2", incremental=False,
                 dirty=incremental,
                 buffer_size=buffer_size,
                 zero=False,
-                progress=progress)
+                progress=progress,
+                max_workers=max_workers,
+                adaptive=adaptive)
 
 
 class ProgressWrapper:
@@ -119,7 +163,7 @@ class ProgressWrapper:
 
 
 @contextmanager
-def _open_nbd(filename, fmt, read_only=False):
+def _open_nbd(filename, fmt, read_only=False, shared=1):
     with _tmp_dir("imageio-") as base:
         sock = UnixAddress(os.path.join(base, "sock"))
         with qemu_nbd.run(
@@ -127,6 +171,7 @@ def _open_nbd(filename, fmt, read_only=False):
                 fmt,
                 sock,
                 read_only=read_only,
+                shared=shared,
                 cache=None,
                 aio=None,
                 discard=None):
@@ -0,0 +1,197 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+"""
+compression - compress and decompress transferred data.
+
+Data is compressed using HTTP content codings. "gzip" is always available.
+"zstd" is available if the zstandard package is installed, and is preferred
+since it is much faster.
+"""
+
+from __future__ import absolute_import
+
+import gzip
+import zlib
+
+from . import errors
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Use the fastest compression level. Images are typically mostly zeroes or
+# already compressed data, so higher levels give little improvement, and
+# compression must keep up with the network.
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 1
+
+# Like zlib.MAX_WBITS | 16, using gzip header and trailer.
+_GZIP_WBITS = 31
+
+
+def encodings():
+    """
+    Return list of supported encodings, most preferred first.
+    """
+    if zstandard is not None:
+        return ["zstd", "gzip"]
+    return ["gzip"]
+
+
+def negotiate(accept_encoding):
+    """
+    Return the preferred encoding acceptable according to the Accept-Encoding
+    header value, or None if no supported encoding is acceptable.
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name)
+
+    for encoding in encodings():
+        if encoding in accepted:
+            return encoding
+
+    return None
+
+
+def compressor(encoding):
+    """
+    Return a compressor object, implementing compress(data) and flush().
+    """
+    if encoding == "gzip":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError("Unsupported encoding: {!r}".format(encoding))
+
+
+def compress(encoding, data):
+    """
+    Return data compressed using encoding.
+    """
+    c = compressor(encoding)
+    return c.compress(data) + c.flush()
+
+
+def decompress(encoding, data, size):
+    """
+    Return data decompressed using encoding. Raise errors.InvalidData if data
+    is invalid, or the decompressed data is not exactly size bytes.
+    """
+    if encoding == "gzip":
+        d = zlib.decompressobj(_GZIP_WBITS)
+        try:
+            res = d.decompress(data, size)
+            # Process the trailer, or detect extra data.
+            if d.unconsumed_tail and d.decompress(d.unconsumed_tail, 1):
+                raise errors.InvalidData(
+                    encoding, "Expected {} bytes, got more".format(size))
+        except zlib.error as e:
+            raise errors.InvalidData(encoding, e)
+        if not d.eof:
+            raise errors.InvalidData(
+                encoding, "Expected {} bytes, got truncated data"
+                .format(size))
+        if d.unused_data:
+            raise errors.InvalidData(encoding, "Unexpected data after end")
+    elif encoding == "zstd" and zstandard is not None:
+        d = zstandard.ZstdDecompressor()
+        try:
+            res = d.decompress(data, max_output_size=size)
+        except zstandard.ZstdError as e:
+            raise errors.InvalidData(encoding, e)
+    else:
+        raise ValueError("Unsupported encoding: {!r}".format(encoding))
+
+    if len(res) != size:
+        raise errors.InvalidData(
+            encoding, "Expected {} bytes, got {} bytes".format(size, len(res)))
+
+    return res
+
+
+class Reader(object):
+    """
+    File object decompressing data read from fileobj.
+
+    Raises errors.InvalidData if the compressed data is invalid.
+    """
+
+    def __init__(self, encoding, fileobj):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._file = gzip.GzipFile(fileobj=fileobj, mode="rb")
+            self._errors = (EOFError, zlib.error,
+                            getattr(gzip, "BadGzipFile", zlib.error))
+        elif encoding == "zstd" and zstandard is not None:
+            self._file = zstandard.ZstdDecompressor().stream_reader(fileobj)
+            self._errors = (zstandard.ZstdError,)
+        else:
+            raise ValueError("Unsupported encoding: {!r}".format(encoding))
+
+    def readinto(self, buf):
+        try:
+            return self._file.readinto(buf)
+        except self._errors as e:
+            error = str(e)
+
+        # The traceback must not reference buf, which may be a memoryview
+        # of a mmap closed by the caller when handling the error.
+        del buf
+        raise errors.InvalidData(self.encoding, error)
+
+    def read(self, n=-1):
+        try:
+            return self._file.read(n)
+        except self._errors as e:
+            raise errors.InvalidData(self.encoding, e)
+
+
+class Writer(object):
+    """
+    File object compressing written data, writing compressed data to fileobj.
+
+    Data is compressed as it is written, so memory usage is bounded by the
+    size of the written buffers. Call close() to finish the compression and
+    write the remaining compressed data. Closing the writer does not close
+    fileobj.
+    """
+
+    def __init__(self, encoding, fileobj):
+        self._compressor = compressor(encoding)
+        self._file = fileobj
+
+    def write(self, buf):
+        data = self._compressor.compress(buf)
+        if data:
+            self._file.write(data)
+        return len(buf)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Finish compression and write the remaining compressed data.
+        """
+        data = self._compressor.flush()
+        if data:
+            self._file.write(data)
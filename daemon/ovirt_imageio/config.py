@@ -20,6 +20,77 @@ class daemon:
     # slightly, but may also decrease it significantly.
     buffer_size = 8388608
 
+    # Adapt the buffer size to the throughput of every connection. Data
+    # operations start with buffer_size, limited by the backend, and double
+    # or halve the buffer size while the throughput improves, between
+    # min_buffer_size and max_buffer_size. Native AIO operations use the
+    # buffer size selected when the operation starts.
+    adaptive_buffer_size = False
+
+    # Minimum buffer size in bytes when using adaptive_buffer_size.
+    min_buffer_size = 262144
+
+    # Maximum buffer size in bytes when using adaptive_buffer_size.
+    max_buffer_size = 33554432
+
+    # Maximum number of extents returned by a single extents request when
+    # the client specifies a range using the "start" or "length" query
+    # parameters. If there are more extents in the range, the response
+    # includes the "X-Next-Start" header, and clients get the rest of the
+    # extents by sending another request starting at this offset.
+    max_extents = 10000
+
+    # Support compressed transfers. Clients may upload data compressed
+    # with an encoding reported in the OPTIONS features, using the
+    # Content-Encoding header, and download compressed data using the
+    # Accept-Encoding header. Download responses are compressed while
+    # sending them using chunked transfer encoding. The "gzip" encoding is
+    # always available, the "zstd" encoding requires the zstandard package.
+    compression = False
+
+    # Maximum size in bytes of the read cache shared by all tickets.
+    # Image data read by clients is cached in 64 KiB blocks, and evicted
+    # when the cache is full, least recently used first. Requests reading
+    # more than 256 KiB bypass the cache. Cached blocks are
+    # dropped when a ticket is removed or the image is modified using the
+    # ticket. Not supported with workers, since a worker cannot drop
+    # blocks cached by other workers. Use 0 to disable the cache.
+    cache_size = 0
+
+    # Maximum size in bytes of the buffer coalescing small unaligned writes
+    # to file storage, for every ticket. Unaligned writes are merged into
+    # pending blocks, written to storage when the buffer is full, on the
+    # next write after 1 second, or before any other access to the image.
+    # Flushing writes the pending blocks before syncing. Not supported with
+    # workers, since pending blocks are not visible to other workers. Use
+    # 0 to perform a read-modify-write for every unaligned write.
+    write_buffer_size = 0
+
+    # Number of concurrent reads or writes submitted to file storage when
+    # sending or receiving image data, using Linux native AIO. Higher
+    # values help to keep fast storage busy, but every request uses
+    # buffer_size bytes per queued I/O. Values smaller than 2 disable native
+    # AIO.
+    aio_queue_depth = 0
+
+    # Use an asyncio event loop for handling connections, instead of a
+    # thread per connection. Idle connections are watched by the event loop,
+    # and requests are processed by a pool of async_workers threads. This
+    # minimizes resource usage when serving many concurrent connections.
+    async_server = False
+
+    # Maximum number of threads processing requests for every service, when
+    # using async_server.
+    async_workers = 64
+
+    # Number of worker processes serving the remote and local services.
+    # Workers listen on the remote port using SO_REUSEPORT, and share the
+    # local service socket. The daemon process runs the control service and
+    # replicates tickets to all workers. Workers do not cache image
+    # extents, and cannot be used with cache_size or write_buffer_size.
+    # Values smaller than 2 serve everything in the daemon process.
+    workers = 1
+
 
 class tls:
 
@@ -42,6 +113,16 @@ class tls:
     # TLSv1.2.
     enable_tls1_1 = False
 
+    # Enable TLS session tickets, allowing clients opening multiple
+    # connections to resume the TLS session using an abbreviated handshake.
+    session_tickets = True
+
+    # Enable kernel TLS, offloading encryption to the kernel after the
+    # handshake, and allowing zero copy downloads using sendfile(). Requires
+    # Python 3.12, and OpenSSL and kernel with kernel TLS support. If kernel
+    # TLS is not available, userspace TLS is used.
+    enable_ktls = False
+
 
 class remote:
 
@@ -54,6 +135,11 @@ class remote:
     # configuration.
     port = 54322
 
+    # Clock used to time connections: "none" disables timing, "log" logs
+    # the time of every stage when a connection is closed, and "metrics"
+    # also records the times in the daemon metrics.
+    clock = "metrics"
+
 
 class local:
 
@@ -63,6 +149,9 @@ class local:
     # Local service unix socket for accessing images locally.
     socket = "\u0000/org/ovirt/imageio"
 
+    # Clock used to time connections. See remote:clock for details.
+    clock = "metrics"
+
 
 class control:
 
@@ -71,6 +160,9 @@ class control:
     # daemon.
     socket = "/run/ovirt-imageio/sock"
 
+    # Clock used to time connections. See remote:clock for details.
+    clock = "log"
+
 
 class profile:
 
@@ -68,3 +68,11 @@ class TlsConfigurationError(Error):
         self.ca_file = ca_file
         self.cert_file = cert_file
         self.key_file = key_file
+
+
+class InvalidData(Error):
+    msg = "Invalid {self.encoding} data: {self.reason}"
+
+    def __init__(self, encoding, reason):
+        self.encoding = encoding
+        self.reason = reason
@@ -8,12 +8,25 @@
 
 from __future__ import absolute_import
 
+import functools
+import itertools
 import logging
 
 from . import backends
 from . import errors
 from . import http
 from . import validate
+from . backends import image
+
+# Content type used for extents in binary format. See image.ExtentList for
+# the format details.
+BINARY_CONTENT_TYPE = "application/octet-stream"
+
+# Header reporting where the next chunk of extents starts when the client
+# specifies a range and the response was limited to max_extents. The client
+# should use the value as the start of the next request. The header is not
+# sent when the response includes the end of the range or of the image.
+NEXT_START_HEADER = "x-next-start"
 
 log = logging.getLogger("extents")
 
@@ -46,16 +59,130 @@ class Handler(object):
         log.info("[%s] EXTENTS ticket=%s context=%s",
                  req.client_addr, ticket_id, context)
 
+        # If the client specifies a range, return only extents within the
+        # range, limited to max_extents. Otherwise return all extents, for
+        # backward compatibility.
+        start = _query_integer(req.query, "start")
+        length = _query_integer(req.query, "length")
+        paging = start is not None or length is not None
+
         backend = backends.get(req, ticket)
 
         try:
-            extents = [
-                {"start": ext.start,
-                 "length": ext.length,
-                 context: getattr(ext, context)}
-                for ext in backend.extents(context=context)
-            ]
+            if paging:
+                start = start or 0
+                selected = self._get_range(
+                    resp, ticket, backend, context, start, length)
+            else:
+                selected = ticket.extents(
+                    context,
+                    functools.partial(_load_extents, backend, context))
         except errors.UnsupportedOperation as e:
             raise http.Error(http.NOT_FOUND, str(e))
 
+        # Clients supporting the "extents_binary" feature ask for the compact
+        # binary format.
+        if BINARY_CONTENT_TYPE in req.headers.get("accept", ""):
+            body = selected.to_bytes()
+            resp.headers["content-length"] = len(body)
+            resp.headers["content-type"] = BINARY_CONTENT_TYPE
+            resp.write(body)
+            return
+
+        extents = [
+            {"start": ext.start,
+             "length": ext.length,
+             context: getattr(ext, context)}
+            for ext in selected
+        ]
+
         resp.send_json(extents)
+
+    def _get_range(self, resp, ticket, backend, context, start, length):
+        """
+        Return up to max_extents extents from start, up to start + length
+        if length is specified, setting the next start header if there are
+        more extents in the range.
+
+        If the extents are not cached, get only the requested extents from
+        the backend, so memory usage does not depend on the number of
+        extents in the image.
+        """
+        limit = self.config.daemon.max_extents
+        end = backend.size()
+        if length is not None:
+            end = min(start + length, end)
+
+        cached = ticket.cached_extents(context)
+        if start >= end:
+            extents = ()
+        elif cached is not None:
+            extents = _select(cached, start, end, limit)
+        else:
+            extents = itertools.islice(
+                backend.extents(context, start=start, length=end - start),
+                limit)
+
+        selected = image.ExtentList(context, extents)
+
+        if len(selected) == limit:
+            last = selected[-1]
+            next_start = last.start + last.length
+            if next_start < end:
+                resp.headers[NEXT_START_HEADER] = next_start
+
+        return selected
+
+
+def _load_extents(backend, context):
+    return image.ExtentList(context, backend.extents(context=context))
+
+
+def _query_integer(query, name):
+    """
+    Return non-negative integer query parameter, or None if the parameter
+    was not specified.
+    """
+    if name not in query:
+        return None
+
+    try:
+        val = int(query[name])
+    except ValueError:
+        raise http.Error(
+            http.BAD_REQUEST,
+            "Integer required for {!r}: {!r}".format(name, query[name]))
+
+    if val < 0:
+        raise http.Error(
+            http.BAD_REQUEST,
+            "Invalid value for {!r}: {} < 0".format(name, val))
+
+    return val
+
+
+def _select(extents, start, end, limit):
+    """
+    Iterate over up to limit extents overlapping the range start-end,
+    clipping the first and last extents to the range.
+    """
+    # Find the first extent ending after start.
+    lo = 0
+    hi = len(extents)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        ext = extents[mid]
+        if ext.start + ext.length <= start:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    for i in range(lo, min(lo + limit, len(extents))):
+        ext = extents[i]
+        ext_start = max(ext.start, start)
+        if ext_start >= end:
+            break
+
+        ext_end = min(ext.start + ext.length, end)
+
+        yield ext._replace(start=ext_start, length=ext_end - ext_start)
@@ -9,17 +9,28 @@
 from __future__ import absolute_import
 
 import errno
+import functools
 import io
 import json
 import logging
+import os
 import re
 import socket
+import threading
 
 import six
 from six.moves import BaseHTTPServer
 from six.moves import socketserver
 from six.moves import urllib
 
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+from . import metrics
+from . import ssl
 from . import util
 
 log = logging.getLogger("http")
@@ -36,6 +47,7 @@ NOT_FOUND = 404
 METHOD_NOT_ALLOWED = 405
 NOT_ACCEPTABLE = 406
 REQUEST_URI_TOO_LARGE = 414
+UNSUPPORTED_MEDIA_TYPE = 415
 REQUESTED_RANGE_NOT_SATISFIABLE = 416
 INTERNAL_SERVER_ERROR = 500
 
@@ -79,6 +91,225 @@ class Server(socketserver.ThreadingMixIn,
     # profiling.
     clock_class = util.NullClock
 
+    # Set SO_REUSEPORT before binding, allowing several processes to listen
+    # on the same port. The kernel distributes incoming connections between
+    # the listening sockets.
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        BaseHTTPServer.HTTPServer.server_bind(self)
+
+
+class AsyncMixIn(object):
+    """
+    Mixin multiplexing server connections on an asyncio event loop.
+
+    Idle connections are watched by the event loop and do not use a thread.
+    When a request arrives, the connection is handed to a bounded thread
+    pool, processing requests with the server connection class until no
+    more data is available, and then returned to the event loop.
+
+    Handling TLS handshakes and request headers from slow clients occupies a
+    worker thread, like a connection thread in the threading server.
+    """
+
+    # Maximum number of threads processing requests.
+    max_workers = 64
+
+    def __init__(self, *args, **kwargs):
+        if asyncio is None:
+            raise RuntimeError("asyncio server requires python 3")
+        super(AsyncMixIn, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+        self._shutdown_request = False
+        self._loop = None
+        self._executor = None
+        self._connections = set()
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Handle requests until shutdown() is called. poll_interval is
+        ignored, the event loop is woken up by shutdown().
+        """
+        with self._lock:
+            if self._shutdown_request:
+                self._shutdown_request = False
+                return
+            self._is_shut_down.clear()
+            self._loop = asyncio.new_event_loop()
+            self._executor = ThreadPoolExecutor(
+                self.max_workers, thread_name_prefix="http")
+
+        try:
+            self.socket.setblocking(False)
+            self._loop.add_reader(self.socket.fileno(), self._accept)
+            self._loop.run_forever()
+        finally:
+            self._loop.remove_reader(self.socket.fileno())
+            for con in list(self._connections):
+                if not con.busy:
+                    self._loop.remove_reader(con.fileno)
+                    con.close()
+            self._executor.shutdown(wait=False)
+            self._loop.close()
+            with self._lock:
+                self._shutdown_request = False
+                self._loop = None
+                self._executor = None
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        """
+        Stop the serve_forever() loop and wait until it exits. Idle
+        connections are closed, and busy connections are closed after the
+        current request completes.
+        """
+        with self._lock:
+            self._shutdown_request = True
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+        self._is_shut_down.wait()
+
+    @property
+    def shutting_down(self):
+        return self._shutdown_request
+
+    def _accept(self):
+        # Accepting from a TLS socket performs the handshake; do it in a
+        # worker thread instead of blocking the event loop.
+        try:
+            if ssl.is_tls(self.socket):
+                sock, addr = socket.socket.accept(self.socket)
+            else:
+                sock, addr = self.get_request()
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            log.warning("Error accepting connection: %s", e)
+            return
+
+        sock.setblocking(True)
+        con = _AsyncConnection(self, sock, addr)
+        self._connections.add(con)
+        if ssl.is_tls(self.socket):
+            self._submit(con)
+        else:
+            self._wait(con)
+
+    def _wait(self, con):
+        self._loop.add_reader(con.fileno, self._ready, con)
+
+    def _ready(self, con):
+        self._loop.remove_reader(con.fileno)
+        self._submit(con)
+
+    def _submit(self, con):
+        con.busy = True
+        future = self._loop.run_in_executor(self._executor, con.run)
+        future.add_done_callback(functools.partial(self._done, con))
+
+    def _done(self, con, future):
+        con.busy = False
+        if future.result():
+            self._wait(con)
+        else:
+            self._connections.discard(con)
+
+
+class _AsyncConnection(object):
+    """
+    Connection handled by AsyncMixIn.
+    """
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.fileno = sock.fileno()
+        self.busy = False
+        self._handler = None
+
+    def run(self):
+        """
+        Process requests until no more data is available. Called in a
+        worker thread.
+
+        Returns True if the connection should wait for the next request,
+        or False if the connection was closed.
+        """
+        try:
+            if self._handler is None:
+                self._setup()
+
+            while True:
+                # Like BaseHTTPRequestHandler.handle(), the request may
+                # change this to keep the connection open.
+                self._handler.close_connection = True
+                self._handler.handle_one_request()
+
+                if (self._handler.close_connection or
+                        self.server.shutting_down):
+                    self.close()
+                    return False
+
+                if not self._has_buffered_data():
+                    return True
+        except Exception:
+            log.exception("Unhandled error client=%s", self.addr)
+            self.close()
+            return False
+
+    def close(self):
+        try:
+            if self._handler is not None:
+                self._handler.finish()
+        except Exception:
+            log.exception("Error closing connection client=%s", self.addr)
+        finally:
+            self.server.shutdown_request(self.sock)
+
+    def _setup(self):
+        if ssl.is_tls(self.server.socket):
+            self.sock = self.server.socket.context.wrap_socket(
+                self.sock, server_side=True)
+
+        # Like BaseRequestHandler.__init__(), without handling the requests.
+        cls = self.server.RequestHandlerClass
+        handler = cls.__new__(cls)
+        handler.request = self.sock
+        handler.client_address = self.addr
+        handler.server = self.server
+        handler.setup()
+        self._handler = handler
+
+    def _has_buffered_data(self):
+        """
+        Return True if the next request is already available. The data may
+        be buffered in the connection read buffer or in the TLS layer, so
+        the socket will not become readable.
+        """
+        self.sock.setblocking(False)
+        try:
+            return len(self._handler.rfile.peek(1)) > 0
+        except (BlockingIOError, ssl.WantReadError):
+            return False
+        except socket.error:
+            # Let the next request handle the error.
+            return True
+        finally:
+            self.sock.setblocking(True)
+
+
+class AsyncServer(AsyncMixIn, Server):
+    """
+    HTTP server using an asyncio event loop and a bounded thread pool.
+    """
+
 
 class Connection(BaseHTTPServer.BaseHTTPRequestHandler):
     """
@@ -108,8 +339,10 @@ class Connection(BaseHTTPServer.BaseHTTPRequestHandler):
         self.context = Context()
         self.clock = self.server.clock_class()
         self.clock.start("connection")
+        metrics.CONNECTIONS.inc()
 
     def finish(self):
+        metrics.CONNECTIONS.dec()
         self.clock.stop("connection")
         log.info("CLOSE client=%s %s", self.address_string(), self.clock)
         self.context.close()
@@ -200,6 +433,7 @@ class Request(object):
         self._content_length = _UNKNOWN
         self._length = _UNKNOWN
         self._range = _UNKNOWN
+        self._ranges = _UNKNOWN
         self._content_range = _UNKNOWN
 
     @property
@@ -317,6 +551,22 @@ class Request(object):
                 self._range = None
         return self._range
 
+    @property
+    def ranges(self):
+        """
+        Return list of ranges in the Range header, or None if the request
+        does not have a Range header.
+
+        Unlike range, accepts multiple ranges.
+        """
+        if self._ranges is _UNKNOWN:
+            value = self.headers.get("range")
+            if value is not None:
+                self._ranges = Range.parse_multiple(value)
+            else:
+                self._ranges = None
+        return self._ranges
+
     @property
     def content_range(self):
         if self._content_range is _UNKNOWN:
@@ -454,6 +704,27 @@ class Response(object):
         # This avoids name lookup on the next calls to write.
         self.write = self._con.wfile.write
 
+    def can_sendfile(self):
+        """
+        Return True if the response body can be sent using sendfile().
+        """
+        # With TLS the data must be encrypted in userspace, unless the
+        # connection uses kernel TLS.
+        return (hasattr(os, "sendfile") and
+                ssl.can_sendfile(self._con.connection))
+
+    def sendfile(self, fd, offset, count):
+        """
+        Send up to count bytes from file descriptor fd starting at offset to
+        the response body, without copying the data to userspace. Returns
+        the number of bytes sent, or 0 at end of file.
+        """
+        if not self._started:
+            self.write(b"")
+
+        return util.uninterruptible(
+            os.sendfile, self._con.connection.fileno(), fd, offset, count)
+
     def _write_header(self, b):
         """
         Write HTTP header to buffer b, avoiding one syscall per line in python
@@ -502,6 +773,48 @@ class Context(dict):
                     log.exception("Error closing %s", v)
 
 
+class ChunkedWriter(object):
+    """
+    File object writing data to the response body using chunked transfer
+    encoding. Used when the size of the body is not known when sending the
+    headers.
+
+    The caller must set the "transfer-encoding: chunked" header, and call
+    close() to terminate the body.
+    """
+
+    def __init__(self, resp):
+        self._resp = resp
+
+    def write(self, data):
+        n = len(data)
+        # An empty chunk terminates the body.
+        if n == 0:
+            return 0
+
+        header = b"%x\r\n" % n
+
+        # For small chunks, it is faster to copy the data and write in one
+        # syscall.
+        if n < 4096:
+            self._resp.write(header + bytes(data) + b"\r\n")
+        else:
+            self._resp.write(header)
+            self._resp.write(data)
+            self._resp.write(b"\r\n")
+
+        return n
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Write the last chunk, terminating the body.
+        """
+        self._resp.write(b"0\r\n\r\n")
+
+
 class Headers(dict):
     """
     Dictionarry optimized for keeping HTTP headers.
@@ -595,6 +908,26 @@ class Range(object):
         # "bytes=0-99"
         return cls(first, last)
 
+    @classmethod
+    def parse_multiple(cls, header):
+        """
+        Parse Range header with one or more ranges, returning list of Range.
+
+        Ranges are separated by a comma and optional whitespace, and parsed
+        like parse().
+
+        Raise:
+            http.Error(REQUESTED_RANGE_NOT_SATISFIABLE) if any of the ranges is
+            invalid.
+        """
+        if not header.startswith("bytes="):
+            raise Error(
+                REQUESTED_RANGE_NOT_SATISFIABLE,
+                "Cannot satisfy range {!r}, invalid range".format(header))
+
+        return [cls.parse("bytes=" + spec.strip())
+                for spec in header[len("bytes="):].split(",")]
+
 
 class ContentRange(object):
     """
@@ -697,6 +1030,7 @@ class Router(object):
                 elif resp.started:
                     # Already started the response, close the connection.
                     log.exception("Request aborted after starting response")
+                    metrics.ERRORS.inc(code="aborted")
                     resp.close_connection()
                 else:
                     # Don't expose internal errors to client.
@@ -712,6 +1046,7 @@ class Router(object):
                     # Did we read the entire request content?
                     if req.length and req.length > 0:
                         resp.close_connection()
+                    metrics.ERRORS.inc(code=e.code)
                     resp.send_error(e)
 
     def dispatch(self, req, resp):
@@ -10,12 +10,23 @@ from __future__ import absolute_import
 
 import json
 import logging
+import uuid
 
 from . import backends
+from . import cache
+from . import compression
 from . import ops
 from . import errors
 from . import http
+from . import sizing
 from . import validate
+from . backends import image
+
+# Maximum number of ranges in a multiple ranges GET request.
+MAX_RANGES = 128
+
+# Maximum number of operations in a batched PATCH request.
+MAX_BATCH = 1024
 
 log = logging.getLogger("images")
 
@@ -40,6 +51,18 @@ class Handler(object):
 
         offset = req.content_range.first if req.content_range else 0
 
+        src = req
+        encoding = self._content_encoding(req)
+        if encoding:
+            # Content-Length is the size of the compressed data, the range
+            # specifies the size of the data written to the image.
+            if req.content_range is None or req.content_range.last is None:
+                raise http.Error(
+                    http.BAD_REQUEST,
+                    "Content-Range header is required with Content-Encoding")
+            size = req.content_range.last - offset + 1
+            src = compression.Reader(encoding, req)
+
         # For backward compatibility, we flush by default.
         flush = validate.enum(req.query, "flush", ("y", "n"), default="y")
         flush = (flush == "y")
@@ -52,26 +75,45 @@ class Handler(object):
         validate.allowed_range(offset, size, ticket)
 
         log.info(
-            "[%s] WRITE size=%d offset=%d flush=%s ticket=%s",
-            req.client_addr, size, offset, flush, ticket_id)
+            "[%s] WRITE size=%d offset=%d flush=%s encoding=%s ticket=%s",
+            req.client_addr, size, offset, flush, encoding, ticket_id)
+
+        backend = backends.get(req, ticket)
 
         op = ops.Receive(
-            backends.get(req, ticket),
-            req,
+            backend,
+            src,
             size,
             offset=offset,
             flush=flush,
             buffersize=self.config.daemon.buffer_size,
-            clock=req.clock)
+            clock=req.clock,
+            queue_depth=self.config.daemon.aio_queue_depth,
+            sizer=self._sizer(req, ticket, backend))
         try:
             ticket.run(op)
-        except errors.PartialContent as e:
+        except (errors.PartialContent, errors.InvalidData) as e:
             raise http.Error(http.BAD_REQUEST, str(e))
 
+        if encoding:
+            # Consume the end of the compressed data, so the connection can
+            # be used for the next request.
+            try:
+                extra = src.read(1)
+            except errors.InvalidData as e:
+                raise http.Error(http.BAD_REQUEST, str(e))
+            if extra or req.length:
+                raise http.Error(
+                    http.BAD_REQUEST,
+                    "Compressed data is larger than Content-Range")
+
     def get(self, req, resp, ticket_id):
         if not ticket_id:
             raise http.Error(http.BAD_REQUEST, "Ticket id is required")
 
+        if req.ranges and len(req.ranges) > 1:
+            return self._get_ranges(req, resp, ticket_id)
+
         offset = 0
         size = None
         if req.range:
@@ -105,6 +147,8 @@ class Handler(object):
             "[%s] READ size=%d offset=%d ticket=%s",
             req.client_addr, size, offset, ticket_id)
 
+        encoding = self._accept_encoding(req)
+
         content_disposition = "attachment"
         if ticket.filename:
             content_disposition += "; filename=%s" % ticket.filename
@@ -118,18 +162,124 @@ class Handler(object):
             resp.headers["content-range"] = "bytes %d-%d/%d" % (
                 offset, offset + size - 1, ticket.size)
 
+        if encoding:
+            # The size of the compressed data is not known, so the data is
+            # compressed while sending it using chunked transfer encoding.
+            del resp.headers["content-length"]
+            resp.headers["content-encoding"] = encoding
+            resp.headers["transfer-encoding"] = "chunked"
+            body = http.ChunkedWriter(resp)
+            dst = compression.Writer(encoding, body)
+        else:
+            dst = resp
+
         op = ops.Send(
-            backends.get(req, ticket),
-            resp,
+            self._reader(req, ticket, backend, size),
+            dst,
             size,
             offset=offset,
             buffersize=self.config.daemon.buffer_size,
-            clock=req.clock)
+            clock=req.clock,
+            queue_depth=self.config.daemon.aio_queue_depth,
+            sizer=self._sizer(req, ticket, backend),
+            extents=self._zero_extents(ticket, backend, offset, size))
         try:
             ticket.run(op)
         except errors.PartialContent as e:
             raise http.Error(http.BAD_REQUEST, str(e))
 
+        if encoding:
+            dst.close()
+            body.close()
+
+    def _get_ranges(self, req, resp, ticket_id):
+        """
+        Send multiple ranges in a multipart/byteranges response.
+
+        Overlapping and adjacent ranges are coalesced, and the parts are sent
+        sorted by offset, so the backend reads the image sequentially.
+        """
+        if len(req.ranges) > MAX_RANGES:
+            raise http.Error(
+                http.REQUESTED_RANGE_NOT_SATISFIABLE,
+                "Too many ranges: {}, maximum {}"
+                .format(len(req.ranges), MAX_RANGES))
+
+        try:
+            ticket = self.auth.authorize(ticket_id, "read")
+        except errors.AuthorizationError as e:
+            raise http.Error(http.FORBIDDEN, str(e))
+
+        backend = backends.get(req, ticket)
+        image_size = min(ticket.size, backend.size())
+
+        parts = []
+        for r in req.ranges:
+            if r.first < 0:
+                # TODO: support suffix-byte-range-spec "bytes=-last".
+                raise http.Error(
+                    http.REQUESTED_RANGE_NOT_SATISFIABLE,
+                    "suffix-byte-range-spec not supported yet")
+            if r.last is not None:
+                size = r.last - r.first + 1
+            elif r.first < image_size:
+                size = image_size - r.first
+            else:
+                raise http.Error(
+                    http.REQUESTED_RANGE_NOT_SATISFIABLE,
+                    "Requested range {}- after end of image".format(r.first),
+                    content_range="bytes */{}".format(image_size))
+            validate.allowed_range(r.first, size, ticket)
+            validate.available_range(r.first, size, ticket, backend)
+            parts.append((r.first, size))
+
+        parts = _coalesce(parts)
+
+        boundary = uuid.uuid4().hex
+        part_headers = [
+            ("\r\n--{}\r\n"
+             "Content-Type: application/octet-stream\r\n"
+             "Content-Range: bytes {}-{}/{}\r\n"
+             "\r\n").format(boundary, offset, offset + size - 1, ticket.size)
+            .encode("ascii")
+            for offset, size in parts
+        ]
+        trailer = "\r\n--{}--\r\n".format(boundary).encode("ascii")
+        data_size = sum(size for offset, size in parts)
+
+        log.info(
+            "[%s] READ ranges=%d parts=%d size=%d ticket=%s",
+            req.client_addr, len(req.ranges), len(parts), data_size,
+            ticket_id)
+
+        resp.status_code = http.PARTIAL_CONTENT
+        resp.headers["content-type"] = (
+            "multipart/byteranges; boundary=" + boundary)
+        resp.headers["content-length"] = (
+            sum(len(h) for h in part_headers) + data_size + len(trailer))
+
+        sizer = self._sizer(req, ticket, backend)
+
+        for header, (offset, size) in zip(part_headers, parts):
+            resp.write(header)
+            extents = self._zero_extents(ticket, backend, offset, size)
+            op = ops.Send(
+                self._reader(req, ticket, backend, size),
+                resp,
+                size,
+                offset=offset,
+                buffersize=self.config.daemon.buffer_size,
+                clock=req.clock,
+                queue_depth=self.config.daemon.aio_queue_depth,
+                sizer=sizer,
+                extents=extents)
+            try:
+                ticket.run(op)
+            except errors.PartialContent as e:
+                raise http.Error(http.BAD_REQUEST, str(e))
+
+        resp.write(trailer)
+
     def patch(self, req, resp, ticket_id):
         if not ticket_id:
             raise http.Error(http.BAD_REQUEST, "Ticket id is required")
@@ -142,6 +292,9 @@ class Handler(object):
             raise http.Error(
                 http.BAD_REQUEST, "Invalid JSON message {}" .format(e))
 
+        if isinstance(msg, list):
+            return self._batch(req, resp, ticket_id, msg)
+
         op = validate.enum(msg, "op", ("zero", "flush"))
         if op == "zero":
             return self._zero(req, resp, ticket_id, msg)
@@ -151,9 +304,7 @@ class Handler(object):
             raise RuntimeError("Unreachable")
 
     def _zero(self, req, resp, ticket_id, msg):
-        size = validate.integer(msg, "size", minval=0)
-        offset = validate.integer(msg, "offset", minval=0, default=0)
-        flush = validate.boolean(msg, "flush", default=False)
+        size, offset, flush = self._zero_args(msg)
 
         try:
             ticket = self.auth.authorize(ticket_id, "write")
@@ -178,6 +329,71 @@ class Handler(object):
         except errors.PartialContent as e:
             raise http.Error(http.BAD_REQUEST, str(e))
 
+    def _zero_args(self, msg):
+        size = validate.integer(msg, "size", minval=0)
+        offset = validate.integer(msg, "offset", minval=0, default=0)
+        flush = validate.boolean(msg, "flush", default=False)
+        return size, offset, flush
+
+    def _batch(self, req, resp, ticket_id, msgs):
+        """
+        Run a list of zero and flush operations in order, as a single
+        operation.
+        """
+        if not msgs:
+            raise http.Error(http.BAD_REQUEST, "Empty operations list")
+
+        if len(msgs) > MAX_BATCH:
+            raise http.Error(
+                http.BAD_REQUEST,
+                "Too many operations: {}, maximum {}"
+                .format(len(msgs), MAX_BATCH))
+
+        # Validate all operations before modifying the image.
+        parsed = []
+        for msg in msgs:
+            if not isinstance(msg, dict):
+                raise http.Error(
+                    http.BAD_REQUEST, "Invalid operation {!r}".format(msg))
+            op = validate.enum(msg, "op", ("zero", "flush"))
+            args = self._zero_args(msg) if op == "zero" else None
+            parsed.append((op, args))
+
+        try:
+            ticket = self.auth.authorize(ticket_id, "write")
+        except errors.AuthorizationError as e:
+            raise http.Error(http.FORBIDDEN, str(e))
+
+        for op, args in parsed:
+            if op == "zero":
+                size, offset, _ = args
+                validate.allowed_range(offset, size, ticket)
+
+        log.info(
+            "[%s] BATCH operations=%d ticket=%s",
+            req.client_addr, len(parsed), ticket_id)
+
+        backend = backends.get(req, ticket)
+
+        operations = []
+        for op, args in parsed:
+            if op == "zero":
+                size, offset, flush = args
+                operations.append(ops.Zero(
+                    backend,
+                    size,
+                    offset=offset,
+                    flush=flush,
+                    buffersize=self.config.daemon.buffer_size,
+                    clock=req.clock))
+            else:
+                operations.append(ops.Flush(backend, clock=req.clock))
+
+        try:
+            ticket.run(ops.Batch(operations))
+        except errors.PartialContent as e:
+            raise http.Error(http.BAD_REQUEST, str(e))
+
     def _flush(self, req, resp, ticket_id, msg):
         try:
             ticket = self.auth.authorize(ticket_id, "write")
@@ -189,6 +405,101 @@ class Handler(object):
         op = ops.Flush(backends.get(req, ticket), clock=req.clock)
         ticket.run(op)
 
+    def _content_encoding(self, req):
+        """
+        Return the encoding of the request body, or None if the body is not
+        compressed.
+        """
+        encoding = req.headers.get("content-encoding", "identity").lower()
+        if encoding == "identity":
+            return None
+
+        if (not self.config.daemon.compression or
+                encoding not in compression.encodings()):
+            raise http.Error(
+                http.UNSUPPORTED_MEDIA_TYPE,
+                "Unsupported Content-Encoding {!r}".format(encoding))
+
+        return encoding
+
+    def _accept_encoding(self, req):
+        """
+        Return the encoding for compressing the data sent to the client, or
+        None if the response should not be compressed.
+
+        Compressed data is sent using chunked transfer encoding, so only
+        HTTP/1.1 clients get compressed responses.
+        """
+        if not self.config.daemon.compression or req.version != "HTTP/1.1":
+            return None
+
+        return compression.negotiate(req.headers.get("accept-encoding"))
+
+    def _sizer(self, req, ticket, backend):
+        """
+        Return a sizer for sending or receiving data using backend.
+
+        Adaptive sizers are cached in the connection context, so requests
+        on the same connection continue with the buffer size selected by
+        previous requests.
+        """
+        cfg = self.config.daemon
+        if not cfg.adaptive_buffer_size:
+            return sizing.Fixed(cfg.buffer_size)
+
+        key = ("sizer", ticket.uuid)
+        if key not in req.context:
+            req.context[key] = sizing.create(
+                [backend],
+                cfg.buffer_size,
+                adaptive=True,
+                minimum=cfg.min_buffer_size,
+                maximum=cfg.max_buffer_size)
+
+        return req.context[key]
+
+    def _reader(self, req, ticket, backend, size):
+        """
+        Return a backend for reading size bytes of image data, reading
+        through the cache if caching is enabled and the read is small.
+        Larger reads use the backend directly, so they do not evict cached
+        blocks, and can use sendfile() or native AIO.
+
+        Cache readers are cached in the connection context, so requests on
+        the same connection reuse the reader buffer.
+        """
+        if ticket.cache is None or size > cache.MAX_READ_SIZE:
+            return backend
+
+        key = ("cache", ticket.uuid)
+        if key not in req.context:
+            req.context[key] = cache.Backend(backend, ticket)
+
+        return req.context[key]
+
+    def _zero_extents(self, ticket, backend, offset, size):
+        """
+        Return zero extents for the requested range, used to skip reading
+        holes when sending data, or None if the range is too small to skip
+        holes, or the backend does not support extents.
+
+        Use the extents cached in the ticket if available. Otherwise get only
+        the extents in the requested range from the backend, so reading a
+        small range does not scan the entire image.
+        """
+        if size < ops.Send.MIN_HOLE_SIZE:
+            return None
+
+        extents = ticket.cached_extents("zero")
+        if extents is not None:
+            return extents
+
+        try:
+            return image.ExtentList(
+                "zero", backend.extents("zero", start=offset, length=size))
+        except errors.UnsupportedOperation:
+            return None
+
     def options(self, req, resp, ticket_id):
         if not ticket_id:
             raise http.Error(http.BAD_REQUEST, "Ticket id is required")
@@ -198,7 +509,11 @@ class Handler(object):
         if ticket_id == "*":
             # Reporting the meta-capabilities for all images.
             allow = ["OPTIONS", "GET", "PUT", "PATCH"]
-            features = ["extents", "zero", "flush"]
+            features = [
+                "extents", "extents_range", "extents_binary", "zero", "flush",
+                "batch"]
+            if self.config.daemon.compression:
+                features.extend(compression.encodings())
         else:
             # Reporting real image capabilities per ticket.
             try:
@@ -210,15 +525,35 @@ class Handler(object):
             ticket.touch()
 
             allow = ["OPTIONS"]
-            features = ["extents"]
+            features = ["extents", "extents_range", "extents_binary"]
             if ticket.may("read"):
                 allow.append("GET")
             if ticket.may("write"):
                 allow.extend(("PUT", "PATCH"))
-                features.extend(("zero", "flush"))
+                features.extend(("zero", "flush", "batch"))
+            if self.config.daemon.compression:
+                features.extend(compression.encodings())
 
         resp.headers["allow"] = ",".join(allow)
         msg = {"features": features}
         if self.config.local.enable:
             msg["unix_socket"] = self.config.local.socket
         resp.send_json(msg)
+
+
+def _coalesce(ranges):
+    """
+    Return sorted list of (offset, size) tuples, merging overlapping and
+    adjacent ranges.
+    """
+    res = []
+    for offset, size in sorted(ranges):
+        if res:
+            last_offset, last_size = res[-1]
+            last_end = last_offset + last_size
+            if offset <= last_end:
+                end = max(last_end, offset + size)
+                res[-1] = (last_offset, end - last_offset)
+                continue
+        res.append((offset, size))
+    return res
@@ -12,6 +12,17 @@ io - I/O operations on backends.
 from __future__ import absolute_import
 
 import logging
+import sys
+import threading
+
+from collections import deque, namedtuple
+
+import six
+from six.moves import queue
+
+from . import ioutil
+from . import sizing
+from . import util
 
 # Limit maximum zero and copy size to ensure frequent progress updates when
 # handling large extents.
@@ -24,79 +35,642 @@ MAX_BUFFER_SIZE = 32 * 1024**2
 # TODO: Needs testing.
 BUFFER_SIZE = 4 * 1024**2
 
+# Number of connections used to copy data in parallel, when both backends
+# support clone().
+MAX_WORKERS = 4
+
+# Number of buffers in flight between the reader and the writer of every
+# worker.
+QUEUE_DEPTH = 4
+
+# Block size used to detect zeroes in copied data.
+ZERO_BLOCK_SIZE = 4096
+
+# Smaller runs of zero blocks are written as data, to avoid sending many
+# tiny zero requests.
+MIN_ZERO_RUN = 64 * 1024
+
 log = logging.getLogger("io")
 
 
 def copy(src, dst, dirty=False, buffer_size=BUFFER_SIZE, zero=True,
-         progress=None):
+         progress=None, max_workers=MAX_WORKERS, queue_depth=QUEUE_DEPTH,
+         adaptive=False, detect_zeroes=False):
+    """
+    Copy extents from src backend to dst backend.
+
+    If both backends support clone(), split the work between max_workers
+    workers, each using its own src and dst backends. Otherwise copy using a
+    single worker.
+
+    Every worker reads from src and writes to dst in parallel, keeping up to
+    queue_depth buffers in flight. If queue_depth is 0, every worker reads
+    and writes in turn.
+
+    If adaptive is True, every worker starts with buffer_size, limited by
+    the backends, and adapts the buffer size to the measured throughput.
+
+    If detect_zeroes is True, data read from src is checked for runs of zero
+    blocks, and the runs are zeroed on dst instead of written. If zero is
+    False, dst is assumed to be zeroed, and the runs are skipped.
+    """
     buffer_size = min(buffer_size, MAX_BUFFER_SIZE)
-    buf = bytearray(buffer_size)
 
-    if dirty:
-        _copy_dirty(src, dst, buf, progress)
-    else:
-        _copy_data(src, dst, buf, zero, progress)
+    if not (hasattr(src, "clone") and hasattr(dst, "clone")):
+        max_workers = 1
 
-    dst.flush()
+    # Progress is updated by both reader and writer threads.
+    if progress and (max_workers > 1 or queue_depth > 0):
+        progress = _SyncProgress(progress)
 
+    requests = _requests(src, dirty, zero)
 
-def _copy_data(src, dst, buf, zero, progress):
-    for ext in src.extents("zero"):
-        if not ext.zero:
-            _copy_extent(src, dst, ext, buf, progress)
-        elif zero:
-            _zero_extent(dst, ext, progress)
-        elif progress:
-            progress.update(ext.length)
+    # When copying dirty extents, the destination is not zeroed.
+    skip_zeroes = detect_zeroes and not zero and not dirty
 
+    options = dict(
+        adaptive=adaptive,
+        detect_zeroes=detect_zeroes,
+        skip_zeroes=skip_zeroes)
 
-def _copy_dirty(src, dst, buf, progress):
-    for ext in src.extents("dirty"):
-        if ext.dirty:
-            _copy_extent(src, dst, ext, buf, progress)
-        elif progress:
-            progress.update(ext.length)
+    if max_workers > 1:
+        _parallel_copy(
+            src, dst, requests, max_workers, buffer_size, queue_depth,
+            progress, **options)
+    else:
+        worker = Worker(
+            src, dst, buffer_size, queue_depth, progress, **options)
+        with worker:
+            for req in requests:
+                worker.process(req)
 
+    dst.flush()
 
-def _copy_extent(src, dst, ext, buf, progress):
-    for start, length in _split(ext.start, ext.length, MAX_COPY_SIZE):
-        src.seek(start)
-        dst.seek(start)
 
-        if hasattr(dst, "read_from"):
-            dst.read_from(src, length, buf)
-        elif hasattr(src, "write_to"):
-            src.write_to(dst, length, buf)
-        else:
-            _generic_copy(src, dst, start, length, buf)
+# Request ops.
+COPY = "copy"
+ZERO = "zero"
+SKIP = "skip"
 
-        if progress:
-            progress.update(length)
 
+class Request(namedtuple("Request", "op,start,length")):
+    __slots__ = ()
 
-def _zero_extent(dst, ext, progress):
-    # TODO: Assumes complete zero(); works with the nbd and http backends but
-    # not with the file backend.
-    for start, length in _split(ext.start, ext.length, MAX_ZERO_SIZE):
-        dst.seek(start)
-        dst.zero(length)
-        if progress:
-            progress.update(length)
 
+def _requests(src, dirty, zero):
+    """
+    Iterate over source extents, and yield requests for copying or zeroing
+    the extents.
 
-def _split(start, length, max_length):
+    Requests are limited to MAX_COPY_SIZE and MAX_ZERO_SIZE to ensure
+    frequent progress updates, and allow workers to split large extents.
+    """
+    if dirty:
+        for ext in src.extents("dirty"):
+            if ext.dirty:
+                for req in _split(COPY, ext.start, ext.length, MAX_COPY_SIZE):
+                    yield req
+            else:
+                yield Request(SKIP, ext.start, ext.length)
+    else:
+        for ext in src.extents("zero"):
+            if not ext.zero:
+                for req in _split(COPY, ext.start, ext.length, MAX_COPY_SIZE):
+                    yield req
+            elif zero:
+                for req in _split(ZERO, ext.start, ext.length, MAX_ZERO_SIZE):
+                    yield req
+            else:
+                yield Request(SKIP, ext.start, ext.length)
+
+
+def _split(op, start, length, max_length):
     """
     Split big range to smaller ones.
     """
     while length > max_length:
-        yield start, max_length
+        yield Request(op, start, max_length)
         length -= max_length
         start += max_length
 
-    yield start, length
+    yield Request(op, start, length)
+
+
+def _parallel_copy(src, dst, requests, max_workers, buffer_size, queue_depth,
+                   progress, **options):
+    # The first worker uses the original backends, the others use clones.
+    workers = [
+        Worker(src, dst, buffer_size, queue_depth, progress, **options)
+    ]
+    try:
+        for _ in range(max_workers - 1):
+            workers.append(
+                Worker.clone(src, dst, buffer_size, queue_depth, progress,
+                             **options))
+
+        queue_size = max_workers * 2
+        reqs = queue.Queue(queue_size)
+        errors = []
+
+        threads = []
+        try:
+            for i, worker in enumerate(workers):
+                t = util.start_thread(
+                    _run_worker,
+                    args=(worker, reqs, errors),
+                    name="copy/{}".format(i))
+                threads.append(t)
+
+            for req in requests:
+                # Stop sending requests after a failure. Workers that failed
+                # keep consuming requests, so we cannot block here.
+                if errors:
+                    break
+                reqs.put(req)
+        finally:
+            for _ in threads:
+                reqs.put(None)
+            log.debug("Waiting for workers")
+            for t in threads:
+                t.join()
+    finally:
+        for worker in workers[1:]:
+            worker.close()
+
+    if errors:
+        six.reraise(*errors[0])
+
+
+def _run_worker(worker, reqs, errors):
+    log.debug("Worker started")
+    done = False
+    try:
+        with worker:
+            while True:
+                req = reqs.get()
+                if req is None:
+                    done = True
+                    break
+
+                # Another worker failed; consume the request so the producer
+                # is not blocked, but do not process it.
+                if errors:
+                    continue
+
+                worker.process(req)
+
+            if not errors:
+                worker.flush()
+    except Exception:
+        log.debug("Worker failed")
+        errors.append(sys.exc_info())
+        while not done:
+            done = reqs.get() is None
+
+    log.debug("Worker finished")
+
+
+# Pipeline request ops.
+WRITE = "write"
+STREAM = "stream"
+FLUSH = "flush"
+# Sent after the data of a copy request, to measure the time to complete
+# the copy request after the writer thread wrote all data.
+DONE = "done"
+
+
+class Worker(object):
+    """
+    Process copy requests using one pair of src and dst backends.
+
+    When queue_depth is not 0, the worker reads from src in the calling
+    thread, and writes to dst in a writer thread, using a pool of queue_depth
+    buffers. The worker must be used as a context manager to start and stop
+    the writer thread.
+
+    If adaptive is True, the worker adapts the buffer size to the throughput
+    of its connections. When using a writer thread, copy requests are
+    measured when the writer thread completed the write.
+
+    If detect_zeroes is True, runs of zero blocks in the data are zeroed
+    instead of written, or skipped if skip_zeroes is True. Consecutive runs
+    are merged to a single zero request.
+    """
+
+    def __init__(self, src, dst, buffer_size, queue_depth=QUEUE_DEPTH,
+                 progress=None, owner=False, adaptive=False,
+                 detect_zeroes=False, skip_zeroes=False):
+        self._src = src
+        self._dst = dst
+        self._detect_zeroes = detect_zeroes
+        self._skip_zeroes = skip_zeroes
+        # Detected zero run not zeroed yet, [start, length].
+        self._pending_zero = None
+        if adaptive:
+            self._sizer = sizing.create(
+                [src, dst], buffer_size, adaptive=True,
+                maximum=MAX_BUFFER_SIZE)
+        else:
+            self._sizer = sizing.Fixed(buffer_size)
+        self._queue_depth = queue_depth
+        # Used by the calling thread. The writer thread uses its own buffer
+        # for streaming, since both threads copy data at the same time.
+        self._buf = bytearray(self._sizer.size)
+        self._stream_buf = None
+        self._progress = progress
+        # True if the worker owns the backends, and must close them.
+        self._owner = owner
+        self._writer = None
+        self._requests = None
+        self._buffers = None
+        self._error = None
+        # Start time of copy requests not completed yet by the writer
+        # thread, and completion time of the last copy request.
+        self._started = deque()
+        self._completed = None
+
+    @classmethod
+    def clone(cls, src, dst, buffer_size, queue_depth=QUEUE_DEPTH,
+              progress=None, **options):
+        """
+        Create a worker using clones of src and dst backends.
+        """
+        src = src.clone()
+        try:
+            dst = dst.clone()
+        except:  # noqa: E722
+            src.close()
+            raise
+        return cls(src, dst, buffer_size, queue_depth, progress, owner=True,
+                   **options)
+
+    def process(self, req):
+        if req.op is COPY:
+            start = util.monotonic_time()
+            if self._writer:
+                self._started.append(start)
+                self._read(req.start, req.length)
+                self._put(Request(DONE, req.start, req.length))
+            else:
+                self._copy(req.start, req.length)
+                self._sizer.update(
+                    req.length, util.monotonic_time() - start)
+        elif req.op is ZERO:
+            if self._writer:
+                self._put(Request(ZERO, req.start, req.length))
+            else:
+                self._zero(req.start, req.length)
+        elif req.op is SKIP:
+            if self._progress:
+                self._progress.update(req.length)
+        else:
+            raise RuntimeError("Unknown request: {}".format(req))
+
+    def flush(self):
+        # Writes done by this worker are flushed by the main thread when
+        # the worker uses the original dst backend.
+        if self._owner:
+            if self._writer:
+                self._put(Request(FLUSH, 0, 0))
+            else:
+                self._dst.flush()
+
+    def close(self):
+        if self._owner:
+            self._src.close()
+            self._dst.close()
+
+    def __enter__(self):
+        if self._queue_depth > 0:
+            self._start_writer()
+        return self
+
+    def __exit__(self, t, v, tb):
+        if self._writer:
+            self._stop_writer()
+            # Do not hide the original error.
+            if t is None and self._error:
+                six.reraise(*self._error)
+
+    # Serial copy.
+
+    def _copy(self, start, length):
+        if len(self._buf) != self._sizer.size:
+            self._buf = bytearray(self._sizer.size)
+
+        self._src.seek(start)
+
+        if self._detect_zeroes:
+            self._copy_detecting_zeroes(start, length)
+        else:
+            self._dst.seek(start)
+            if hasattr(self._dst, "read_from"):
+                self._dst.read_from(self._src, length, self._buf)
+            elif hasattr(self._src, "write_to"):
+                self._src.write_to(self._dst, length, self._buf)
+            else:
+                _generic_copy(self._src, self._dst, length, self._buf)
+
+        if self._progress:
+            self._progress.update(length)
+
+    def _copy_detecting_zeroes(self, start, length):
+        # TODO: Assumes complete readinto(); works with the nbd and http
+        # backends but not with the file backend.
+        offset = start
+        todo = length
+        while todo:
+            step = min(todo, len(self._buf))
+            with memoryview(self._buf)[:step] as view:
+                self._src.readinto(view)
+                self._write_data(offset, view)
+            offset += step
+            todo -= step
+
+        self._flush_zero()
+
+    def _zero(self, start, length):
+        # TODO: Assumes complete zero(); works with the nbd and http backends
+        # but not with the file backend.
+        self._flush_zero()
+        self._dst.seek(start)
+        self._dst.zero(length)
+
+        if self._progress:
+            self._progress.update(length)
+
+    # Zero detection.
+
+    def _write_data(self, start, buf):
+        """
+        Write buf to dst at offset start. If detecting zeroes, write only
+        the data runs, and zero the zero runs later.
+        """
+        if not self._detect_zeroes:
+            self._dst.seek(start)
+            self._dst.write(buf)
+            return
+
+        for run_start, run_length, zero in _zero_runs(buf):
+            if zero:
+                self._add_zero(start + run_start, run_length)
+            else:
+                self._flush_zero()
+                self._dst.seek(start + run_start)
+                with memoryview(buf)[run_start:run_start + run_length] as v:
+                    self._dst.write(v)
+
+    def _add_zero(self, start, length):
+        p = self._pending_zero
+        if p and p[0] + p[1] == start and p[1] + length <= MAX_ZERO_SIZE:
+            p[1] += length
+        else:
+            self._flush_zero()
+            self._pending_zero = [start, length]
+
+    def _flush_zero(self):
+        if self._pending_zero is None:
+            return
+
+        start, length = self._pending_zero
+        self._pending_zero = None
+
+        if not self._skip_zeroes:
+            self._dst.seek(start)
+            self._dst.zero(length)
+
+    # Pipelined copy - reader side.
+
+    def _start_writer(self):
+        self._buffers = queue.Queue()
+        for _ in range(self._queue_depth):
+            self._buffers.put(bytearray(self._sizer.size))
+
+        # Keep room for queue_depth write requests (have buffer) and
+        # queue_depth zero or stream requests (have no buffer).
+        self._requests = queue.Queue(self._queue_depth * 2)
+
+        log.debug("Starting writer thread")
+        self._writer = util.start_thread(self._write, name="writer")
+
+    def _stop_writer(self):
+        self._requests.put(None)
+        log.debug("Waiting for writer thread")
+        self._writer.join()
+        self._writer = None
+
+    def _read(self, start, length):
+        if len(self._buf) != self._sizer.size:
+            self._buf = bytearray(self._sizer.size)
+
+        self._src.seek(start)
+
+        # Let the destination stream the data in one request, unless we
+        # need to check the data for zeroes.
+        if hasattr(self._dst, "read_from") and not self._detect_zeroes:
+            self._put(Request(STREAM, start, length))
+
+        if hasattr(self._src, "write_to"):
+            self._src.write_to(_PipeWriter(self, start), length, self._buf)
+        else:
+            # TODO: Assumes complete readinto(); works with the nbd and http
+            # backends but not with the file backend.
+            offset = start
+            todo = length
+            while todo:
+                buf = self._get_buffer()
+                step = min(todo, len(buf))
+                with memoryview(buf)[:step] as view:
+                    self._src.readinto(view)
+                self._put(Request(WRITE, offset, step), buf)
+                offset += step
+                todo -= step
+
+    def _get_buffer(self):
+        if self._error:
+            six.reraise(*self._error)
+        buf = self._buffers.get()
+        if self._error:
+            six.reraise(*self._error)
+        # Replace buffers allocated before the buffer size was changed.
+        if len(buf) != self._sizer.size:
+            buf = bytearray(self._sizer.size)
+        return buf
+
+    def _put(self, req, buf=None):
+        if self._error:
+            six.reraise(*self._error)
+        self._requests.put((req, buf))
+
+    # Pipelined copy - writer side.
+
+    def _write(self):
+        log.debug("Writer started")
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+
+            req, buf = item
+
+            # After a failure, keep consuming requests so the reader is not
+            # blocked, but do not process them.
+            if self._error:
+                if buf is not None:
+                    self._buffers.put(buf)
+                continue
+
+            try:
+                self._handle(req, buf)
+            except Exception:
+                log.debug("Writer failed")
+                self._error = sys.exc_info()
+                if buf is not None:
+                    self._buffers.put(buf)
+                # Wake up the reader if it is waiting for a buffer.
+                self._buffers.put(None)
+
+        if not self._error:
+            try:
+                self._flush_zero()
+            except Exception:
+                log.debug("Writer failed")
+                self._error = sys.exc_info()
+
+        log.debug("Writer finished")
+
+    def _handle(self, req, buf):
+        if req.op is WRITE:
+            with memoryview(buf)[:req.length] as view:
+                self._write_data(req.start, view)
+            self._buffers.put(buf)
+        elif req.op is STREAM:
+            if (self._stream_buf is None or
+                    len(self._stream_buf) != self._sizer.size):
+                self._stream_buf = bytearray(self._sizer.size)
+            self._dst.seek(req.start)
+            self._dst.read_from(
+                _PipeReader(self), req.length, self._stream_buf)
+        elif req.op is ZERO:
+            self._zero(req.start, req.length)
+            return
+        elif req.op is DONE:
+            # The request was read while the previous requests were
+            # written, so measure the time since the previous request
+            # completed, to get the throughput of the pipeline.
+            start = self._started.popleft()
+            if self._completed is not None and self._completed > start:
+                start = self._completed
+            self._completed = util.monotonic_time()
+            self._sizer.update(req.length, self._completed - start)
+            return
+        elif req.op is FLUSH:
+            self._flush_zero()
+            self._dst.flush()
+            return
+        else:
+            raise RuntimeError("Unknown request: {}".format(req))
+
+        if self._progress:
+            self._progress.update(req.length)
+
+
+class _PipeWriter(object):
+    """
+    Writer queuing data written by src.write_to() to the worker writer
+    thread.
+    """
+
+    def __init__(self, worker, offset):
+        self._worker = worker
+        self._offset = offset
+
+    def write(self, data):
+        with memoryview(data) as src:
+            while len(src):
+                buf = self._worker._get_buffer()
+                n = min(len(src), len(buf))
+                buf[:n] = src[:n]
+                self._worker._put(Request(WRITE, self._offset, n), buf)
+                self._offset += n
+                src = src[n:]
+        return len(data)
+
+
+class _PipeReader(object):
+    """
+    Reader feeding dst.read_from() with data queued by the worker reader.
+    Used only in the writer thread.
+    """
+
+    def __init__(self, worker):
+        self._worker = worker
+        self._buf = None
+        self._pos = 0
+        self._end = 0
+
+    def readinto(self, view):
+        if self._buf is None:
+            item = self._worker._requests.get()
+            if item is None:
+                # Leave the stop request for the writer loop.
+                self._worker._requests.put(None)
+                raise RuntimeError("Reader stopped during stream")
+
+            req, buf = item
+            if req.op is not WRITE:
+                raise RuntimeError(
+                    "Unexpected request in stream: {}".format(req))
+
+            self._buf = buf
+            self._pos = 0
+            self._end = req.length
+
+        n = min(len(view), self._end - self._pos)
+        view[:n] = memoryview(self._buf)[self._pos:self._pos + n]
+        self._pos += n
+
+        if self._pos == self._end:
+            self._worker._buffers.put(self._buf)
+            self._buf = None
+
+        return n
+
+
+class _SyncProgress(object):
+    """
+    Serialize progress updates from multiple threads.
+    """
+
+    def __init__(self, progress):
+        self._progress = progress
+        self._lock = threading.Lock()
+
+    def update(self, n):
+        with self._lock:
+            self._progress.update(n)
+
+
+def _zero_runs(buf):
+    """
+    Iterate over (start, length, zero) runs of blocks in buf, merging zero
+    runs smaller than MIN_ZERO_RUN into the data runs around them.
+    """
+    cur = None
+    for start, length, zero in ioutil.zero_runs(buf, ZERO_BLOCK_SIZE):
+        zero = zero and length >= MIN_ZERO_RUN
+        if cur and cur[2] == zero:
+            cur[1] += length
+        else:
+            if cur:
+                yield tuple(cur)
+            cur = [start, length, zero]
+
+    if cur:
+        yield tuple(cur)
 
 
-def _generic_copy(src, dst, start, length, buf):
+def _generic_copy(src, dst, length, buf):
     # TODO: Assumes complete readinto() and write(); works with the nbd and
     # http backends but not with the file backend.
     step = len(buf)
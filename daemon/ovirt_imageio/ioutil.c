@@ -143,6 +143,114 @@ out:
     return PyBool_FromLong(res);
 }
 
+/* Return 1 if len bytes at p are zero. See is_zero() for details. */
+static int
+is_zero_block(const unsigned char *p, size_t len)
+{
+    size_t i;
+
+    for (i = 0; i < 16; i++) {
+        if (i == len)
+            return 1;
+        if (p[i])
+            return 0;
+    }
+
+    return memcmp(p, p + 16, len - 16) == 0;
+}
+
+PyDoc_STRVAR(zero_runs_doc, "\
+zero_runs(buf, block_size)\n\
+Split buf to runs of zero and non-zero blocks.\n\
+\n\
+Arguments\n\
+  buf (buffer):       buffer to check\n\
+  block_size (int):   size of checked blocks; the last block may be\n\
+                      shorter\n\
+\n\
+Returns\n\
+  list of (start, length, zero) tuples covering buf, where consecutive\n\
+  blocks with the same state are merged.\n\
+");
+
+static PyObject *
+zero_runs(PyObject *self, PyObject *args)
+{
+    Py_buffer b;
+    Py_ssize_t block_size;
+    const unsigned char *p;
+    size_t *starts = NULL;
+    unsigned char *zeros = NULL;
+    size_t count = 0;
+    size_t max_runs;
+    size_t pos;
+    size_t i;
+    PyObject *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "s*n:zero_runs", &b, &block_size))
+        return NULL;
+
+    if (block_size < 1) {
+        PyErr_SetString(PyExc_ValueError, "block_size must be positive");
+        goto out;
+    }
+
+    max_runs = b.len / block_size + 1;
+    starts = PyMem_RawMalloc(max_runs * sizeof(*starts));
+    zeros = PyMem_RawMalloc(max_runs);
+    if (starts == NULL || zeros == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+
+    p = b.buf;
+
+    Py_BEGIN_ALLOW_THREADS
+
+    for (pos = 0; pos < (size_t)b.len; pos += block_size) {
+        size_t len = (size_t)b.len - pos;
+        int zero;
+
+        if (len > (size_t)block_size)
+            len = block_size;
+
+        zero = is_zero_block(p + pos, len);
+
+        if (count == 0 || zeros[count - 1] != zero) {
+            starts[count] = pos;
+            zeros[count] = zero;
+            count++;
+        }
+    }
+
+    Py_END_ALLOW_THREADS
+
+    result = PyList_New(count);
+    if (result == NULL)
+        goto out;
+
+    for (i = 0; i < count; i++) {
+        size_t end = i + 1 < count ? starts[i + 1] : (size_t)b.len;
+        PyObject *item = Py_BuildValue(
+            "(nnO)", (Py_ssize_t)starts[i], (Py_ssize_t)(end - starts[i]),
+            zeros[i] ? Py_True : Py_False);
+
+        if (item == NULL) {
+            Py_CLEAR(result);
+            goto out;
+        }
+
+        PyList_SET_ITEM(result, i, item);
+    }
+
+out:
+    PyMem_RawFree(starts);
+    PyMem_RawFree(zeros);
+    PyBuffer_Release(&b);
+
+    return result;
+}
+
 PyDoc_STRVAR(py_fallocate_doc, "\
 fallocate(fd, mode, offset, length)\n\
 Allows the caller to directly manipulate the allocated disk space for\n\
@@ -197,6 +305,7 @@ static PyMethodDef module_methods[] = {
         blkzeroout_doc},
     {"blksszget", (PyCFunction) blksszget, METH_VARARGS, blksszget_doc},
     {"is_zero", (PyCFunction) is_zero, METH_VARARGS, is_zero_doc},
+    {"zero_runs", (PyCFunction) zero_runs, METH_VARARGS, zero_runs_doc},
     {"fallocate", (PyCFunction) py_fallocate, METH_VARARGS, py_fallocate_doc},
     {NULL}  /* Sentinel */
 };
@@ -0,0 +1,294 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+"""
+metrics - daemon metrics
+
+Counters, gauges and summaries aggregated over all connections, exposed by
+the control service /metrics resource in Prometheus text format:
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+from . import util
+
+# Content type of Prometheus text format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric(object):
+    """
+    Base class for metrics with optional labels, keeping a value for every
+    set of label values.
+
+    Subclasses implement updating the values, format(values, value)
+    returning the lines of a sample in Prometheus text format, and
+    merge(value, other) merging a sample value from another process.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self):
+        """
+        Return list of (label values, value) tuples.
+        """
+        with self._lock:
+            return sorted(self._values.items())
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                "Invalid labels {} for metric {}, expecting {}"
+                .format(sorted(labels), self.name, self.labels))
+        return tuple(str(labels[name]) for name in self.labels)
+
+
+class Number(Metric):
+    """
+    Metric keeping a number for every set of label values.
+    """
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def format(self, values, value):
+        """
+        Return list of lines formatting a sample in Prometheus text format.
+        """
+        return ["{}{} {}".format(
+            self.name, _format_labels(self.labels, values), value)]
+
+    def merge(self, value, other):
+        """
+        Merge sample value from another process. All numbers are sums, so
+        adding values from all processes gives the value for the entire
+        daemon.
+        """
+        return value + other
+
+
+class Counter(Number):
+    """
+    Value that can only increase.
+    """
+
+    type = "counter"
+
+
+class Gauge(Number):
+    """
+    Value that can go up and down.
+    """
+
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Summary(Metric):
+    """
+    Distribution of durations, reporting quantiles, sum, and count of
+    observations.
+
+    The quantiles are cumulative since the process started, not computed
+    over a sliding time window, so they change slowly in a long running
+    daemon. To see recent behavior, compute the rate of the sum and count
+    between scrapes.
+    """
+
+    type = "summary"
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                h = self._values[key] = util.Histogram()
+            h.record(value)
+
+    def get(self, **labels):
+        """
+        Return copy of the histogram for labels.
+        """
+        key = self._key(labels)
+        h = util.Histogram()
+        with self._lock:
+            if key in self._values:
+                h.merge(self._values[key])
+        return h
+
+    def samples(self):
+        with self._lock:
+            return sorted(
+                (key, h.state()) for key, h in self._values.items())
+
+    def format(self, values, state):
+        h = util.Histogram.from_state(state)
+        lines = []
+        for q in self.QUANTILES:
+            lines.append("{}{} {}".format(
+                self.name,
+                _format_labels(self.labels + ("quantile",), values + (q,)),
+                h.percentile(q * 100)))
+        labels = _format_labels(self.labels, values)
+        lines.append("{}_sum{} {}".format(self.name, labels, h.sum))
+        lines.append("{}_count{} {}".format(self.name, labels, h.count))
+        return lines
+
+    def merge(self, value, other):
+        h = util.Histogram.from_state(value)
+        h.merge(util.Histogram.from_state(other))
+        return h.state()
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def summary(self, name, help, labels=()):
+        return self._register(Summary(name, help, labels))
+
+    def collect(self):
+        """
+        Return dict of metric name: list of (label values, value) tuples.
+        """
+        return {m.name: m.samples() for m in self._metrics}
+
+    def format(self, samples):
+        """
+        Format samples returned by collect() in Prometheus text format.
+        """
+        lines = []
+        for m in self._metrics:
+            lines.append("# HELP {} {}".format(m.name, m.help))
+            lines.append("# TYPE {} {}".format(m.name, m.type))
+            for values, value in samples.get(m.name, ()):
+                lines.extend(m.format(tuple(values), value))
+        lines.append("")
+        return "\n".join(lines)
+
+    def merge(self, samples, other):
+        """
+        Merge samples from another process into samples returned by
+        collect().
+        """
+        for m in self._metrics:
+            if m.name not in other:
+                continue
+            values = dict(samples.get(m.name, ()))
+            for label_values, value in other[m.name]:
+                key = tuple(label_values)
+                if key in values:
+                    values[key] = m.merge(values[key], value)
+                else:
+                    values[key] = value
+            samples[m.name] = sorted(values.items())
+
+    def clear(self):
+        for m in self._metrics:
+            m.clear()
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    labels = ",".join(
+        '{}="{}"'.format(name, _escape(str(value)))
+        for name, value in zip(names, values))
+    return "{" + labels + "}"
+
+
+def _escape(value):
+    return (value.replace("\\", "\\\\")
+                 .replace("\"", "\\\"")
+                 .replace("\n", "\\n"))
+
+
+REGISTRY = Registry()
+
+BYTES = REGISTRY.counter(
+    "ovirt_imageio_bytes_total",
+    "Number of bytes read, written or zeroed.",
+    ("op", "backend"))
+
+CONNECTIONS = REGISTRY.gauge(
+    "ovirt_imageio_connections",
+    "Number of open client connections.")
+
+OPERATIONS = REGISTRY.gauge(
+    "ovirt_imageio_operations",
+    "Number of running operations.",
+    ("op",))
+
+STAGE_SECONDS = REGISTRY.summary(
+    "ovirt_imageio_stage_seconds",
+    "Time spent in every stage of processing requests. Quantiles are "
+    "computed over all observations since the daemon started.",
+    ("stage",))
+
+CACHE_HITS = REGISTRY.counter(
+    "ovirt_imageio_cache_hits_total",
+    "Number of image blocks read from the cache.")
+
+CACHE_MISSES = REGISTRY.counter(
+    "ovirt_imageio_cache_misses_total",
+    "Number of image blocks not found in the cache.")
+
+CACHE_EVICTIONS = REGISTRY.counter(
+    "ovirt_imageio_cache_evictions_total",
+    "Number of image blocks evicted from the full cache.")
+
+ERRORS = REGISTRY.counter(
+    "ovirt_imageio_errors_total",
+    "Number of failed requests, by response status code. Requests failing "
+    "after sending the response headers are counted as \"aborted\".",
+    ("code",))
+
+
+class Clock(util.Clock):
+    """
+    Clock recording the time of every stage in the metrics.
+    """
+
+    def stop(self, name):
+        elapsed = super(Clock, self).stop(name)
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        return elapsed
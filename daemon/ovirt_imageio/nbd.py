@@ -376,6 +376,9 @@ def _parse_url(url):
     raise Error("Unsupported URL: {}".format(url))
 
 
+# Default maximum number of commands in flight.
+QUEUE_DEPTH = 16
+
 # Client states
 
 CONNECTING = 0
@@ -386,7 +389,9 @@ CLOSED = 3
 
 class Client(object):
 
-    def __init__(self, address, export_name=None, dirty=False):
+    def __init__(self, address, export_name=None, dirty=False,
+                 queue_depth=QUEUE_DEPTH):
+        self.address = address
         self.export_name = export_name or ""
         self.export_size = None
         self.transmission_flags = None
@@ -410,6 +415,20 @@ class Client(object):
         self._structured_reply = False
         self._meta_context = {}
 
+        # Maximum number of commands in flight. When the in-flight command
+        # table is full, sending a new command waits until the server replies
+        # to one of the in-flight commands. Limiting the queue depth avoids a
+        # deadlock when the server is blocked sending replies that we don't
+        # read, while we are blocked sending a command.
+        self.queue_depth = queue_depth
+
+        # Commands sent to the server, waiting for a reply.
+        self._in_flight = {}
+
+        # Commands completed while waiting for another command, not waited
+        # yet.
+        self._completed = {}
+
         self._counter = itertools.count()
         self._state = CONNECTING
 
@@ -434,42 +453,126 @@ class Client(object):
         return buf
 
     def readinto(self, offset, buf):
+        handle = self.aio_readinto(offset, buf)
+        self.wait(handle)
+        return len(buf)
+
+    def write(self, offset, data):
+        handle = self.aio_write(offset, data)
+        self.wait(handle)
+
+    def zero(self, offset, length):
+        handle = self.aio_zero(offset, length)
+        self.wait(handle)
+
+    def flush(self):
+        handle = self.aio_flush()
+        if handle is not None:
+            self.wait(handle)
+
+    def extents(self, offset, length):
+        cmd = BlockStatus(self._next_handle(), offset, length)
+        self._submit(cmd)
+        self._wait_for(cmd.handle)
+        return cmd.reply
+
+    # Asynchronous interface.
+    #
+    # The aio_xxx methods send a command to the server and return the command
+    # handle without waiting for the reply. The NBD protocol allows multiple
+    # commands in flight on the same connection; the server may reply in any
+    # order, and replies are matched to commands using the in-flight command
+    # table.
+    #
+    # Every handle returned by aio_xxx must be waited for using wait() or
+    # wait_all(). Buffers passed to aio_readinto() and aio_write() must not be
+    # modified or released until the command was waited for.
+    #
+    # The client is not thread safe; all calls must be done from the same
+    # thread.
+
+    def aio_readinto(self, offset, buf):
+        """
+        Start reading len(buf) bytes at offset into buf. Return the command
+        handle.
+        """
         # If structured reply was negotiated, the server must send structured
         # reply to NBD_CMD_READ.
         cmd = Read(
             self._next_handle(), offset, buf,
             only_structured=self._structured_reply)
-        self._send_command(cmd)
-        self._recv_reply(cmd)
-        return len(buf)
+        self._submit(cmd)
+        return cmd.handle
 
-    def write(self, offset, data):
+    def aio_write(self, offset, data):
+        """
+        Start writing data at offset. Return the command handle.
+        """
         cmd = Write(self._next_handle(), offset, len(data))
-        self._send_command(cmd)
-        self._send(data)
-        self._recv_reply(cmd)
+        self._submit(cmd, data)
+        return cmd.handle
 
-    def zero(self, offset, length):
+    def aio_zero(self, offset, length):
+        """
+        Start zeroing length bytes at offset. Return the command handle.
+        """
         if self.transmission_flags & FLAG_SEND_WRITE_ZEROES == 0:
             raise UnsupportedRequest(
                 "Server does not support CMD_WRITE_ZEROES")
         cmd = WriteZeroes(self._next_handle(), offset, length)
-        self._send_command(cmd)
-        self._recv_reply(cmd)
+        self._submit(cmd)
+        return cmd.handle
 
-    def flush(self):
+    def aio_flush(self):
+        """
+        Start flushing data to storage. Return the command handle, or None if
+        the server does not support flush.
+
+        The server completes the flush only after all write commands that
+        were completed before the flush was sent are on stable storage. Wait
+        for in-flight writes before starting a flush.
+        """
         # TODO: is this the best way to handle this?
         if self.transmission_flags & FLAG_SEND_FLUSH == 0:
-            return
+            return None
         cmd = Flush(self._next_handle())
-        self._send_command(cmd)
-        self._recv_reply(cmd)
+        self._submit(cmd)
+        return cmd.handle
 
-    def extents(self, offset, length):
-        cmd = BlockStatus(self._next_handle(), offset, length)
-        self._send_command(cmd)
-        self._recv_reply(cmd)
-        return cmd.reply
+    def wait(self, handle):
+        """
+        Wait until command handle is completed, receiving replies for other
+        in-flight commands as they arrive.
+
+        Raises RequestError if the server failed to process the command.
+        """
+        self._wait_for(handle)
+
+    def wait_all(self):
+        """
+        Wait until all in-flight commands are completed.
+
+        If some commands failed, raise the error of the first failed command
+        after receiving all replies, so the connection can be used normally
+        after the failure.
+        """
+        error = None
+        for handle in sorted(set(self._in_flight) | set(self._completed)):
+            try:
+                self._wait_for(handle)
+            except RequestError as e:
+                if error is None:
+                    error = e
+        if error:
+            raise error
+
+    @property
+    def in_flight(self):
+        """
+        Return the number of commands sent to the server and not completed
+        yet.
+        """
+        return len(self._in_flight)
 
     def close(self):
         if self._state in (HANDSHAKE, TRASMISSION):
@@ -953,48 +1056,89 @@ class Client(object):
         log.debug("Sending %s", cmd)
         self._send(cmd.to_bytes())
 
-    def _recv_reply(self, cmd):
+    def _submit(self, cmd, data=None):
         """
-        Receive either a simple reply or structured reply for cmd.
+        Send cmd and optional payload to the server, and add cmd to the
+        in-flight command table.
+
+        If the table is full, receive replies until one of the in-flight
+        commands is completed.
         """
-        while True:
-            magic = self._recv_fmt("!I")[0]
+        while len(self._in_flight) >= self.queue_depth:
+            self._recv_reply()
 
-            if magic == SIMPLE_REPLY_MAGIC:
-                if cmd.only_structured:
-                    raise ProtocolError(
-                        "Unexpected simple reply magic {:x}, expecting "
-                        "structured reply magic {:x}"
-                        .format(magic, STRUCTURED_REPLY_MAGIC))
+        self._send_command(cmd)
+        if data is not None:
+            self._send(data)
 
-                self._recv_simple_reply(cmd)
-                return
+        self._in_flight[cmd.handle] = cmd
 
-            elif magic == STRUCTURED_REPLY_MAGIC:
-                if not self._structured_reply:
-                    raise ProtocolError(
-                        "Unexpected structured reply magic {:x}, expecting "
-                        "simple reply magic {:x}"
-                        .format(magic, SIMPLE_REPLY_MAGIC))
+    def _wait_for(self, handle):
+        """
+        Receive replies until command handle is completed, and return the
+        command. If the server failed to process the command, raise the
+        command error.
+        """
+        while handle not in self._completed:
+            if handle not in self._in_flight:
+                raise Error("No such command handle {}".format(handle))
+            self._recv_reply()
 
-                # We started to received structured reply chunks, so simple
-                # reply is not allowed.
-                cmd.only_structured = True
+        cmd = self._completed.pop(handle)
+        if cmd.error:
+            raise cmd.error
 
-                if self._recv_reply_chunk(cmd):
-                    break
+        return cmd
 
-            else:
-                raise ProtocolError("Unexpected reply magic {:x}"
-                                    .format(magic))
+    def _lookup_command(self, handle):
+        try:
+            return self._in_flight[handle]
+        except KeyError:
+            raise UnexpectedHandle(handle, sorted(self._in_flight))
+
+    def _complete_command(self, cmd):
+        """
+        Move cmd from the in-flight table to the completed table.
+        """
+        del self._in_flight[cmd.handle]
 
-        if cmd.errors:
+        if cmd.errors and cmd.error is None:
             # Some chunks failed. We don't have a good way to report
             # partial failures since content chunks may be fragmented, so
             # fail the entire request.
-            raise RequestError("Errors receiving reply: {}".format(cmd.errors))
+            cmd.error = RequestError(
+                "Errors receiving reply: {}".format(cmd.errors))
+
+        self._completed[cmd.handle] = cmd
+
+    def _recv_reply(self):
+        """
+        Receive either a simple reply or a structured reply chunk for one of
+        the in-flight commands.
+
+        The server may reply to commands in any order, and may interleave
+        structured reply chunks of different commands, so every reply is
+        dispatched to the command with the same handle.
+        """
+        magic = self._recv_fmt("!I")[0]
+
+        if magic == SIMPLE_REPLY_MAGIC:
+            self._recv_simple_reply()
+
+        elif magic == STRUCTURED_REPLY_MAGIC:
+            if not self._structured_reply:
+                raise ProtocolError(
+                    "Unexpected structured reply magic {:x}, expecting "
+                    "simple reply magic {:x}"
+                    .format(magic, SIMPLE_REPLY_MAGIC))
 
-    def _recv_simple_reply(self, cmd):
+            self._recv_reply_chunk()
+
+        else:
+            raise ProtocolError("Unexpected reply magic {:x}"
+                                .format(magic))
+
+    def _recv_simple_reply(self):
         """
         Receive a simple reply (magic was already read).
 
@@ -1005,19 +1149,25 @@ class Client(object):
         """
         error, handle = self._recv_fmt("!IQ")
 
-        if error != 0:
-            raise ReplyError(error)
+        cmd = self._lookup_command(handle)
 
-        if handle != cmd.handle:
-            raise UnexpectedHandle(handle, cmd.handle)
+        if cmd.only_structured:
+            raise ProtocolError(
+                "Unexpected simple reply magic {:x}, expecting "
+                "structured reply magic {:x}"
+                .format(SIMPLE_REPLY_MAGIC, STRUCTURED_REPLY_MAGIC))
 
-        if cmd.buf:
+        if error != 0:
+            cmd.error = ReplyError(error)
+        elif cmd.buf:
             self._recv_into(cmd.buf)
 
-    def _recv_reply_chunk(self, cmd):
+        self._complete_command(cmd)
+
+    def _recv_reply_chunk(self):
         """
-        Receive a structured reply chunk (magic was already read). Return True
-        if this was the last chunk.
+        Receive a structured reply chunk (magic was already read). If this was
+        the last chunk, complete the command.
 
         S: 16 bits, flags
         S: 16 bits, type
@@ -1027,13 +1177,15 @@ class Client(object):
         """
         flags, type, handle, length = self._recv_fmt("!HHQI")
 
-        if handle != cmd.handle:
-            raise UnexpectedHandle(handle, cmd.handle)
+        cmd = self._lookup_command(handle)
 
-        if type == REPLY_TYPE_ERROR:
-            self._handle_error_chunk(length, flags)
+        # We started to received structured reply chunks, so simple reply is
+        # not allowed.
+        cmd.only_structured = True
 
-        if type == REPLY_TYPE_ERROR_OFFSET:
+        if type == REPLY_TYPE_ERROR:
+            self._handle_error_chunk(length, flags, cmd)
+        elif type == REPLY_TYPE_ERROR_OFFSET:
             self._handle_error_offset_chunk(length, cmd)
         elif type == REPLY_TYPE_NONE:
             self._handle_none_chunk(flags, length)
@@ -1048,7 +1200,8 @@ class Client(object):
                 "Received unknown chunk type={} flags={} length={}"
                 .format(type, flags, length))
 
-        return flags & REPLY_FLAG_DONE
+        if flags & REPLY_FLAG_DONE:
+            self._complete_command(cmd)
 
     def _handle_block_status_chunk(self, length, cmd):
         """
@@ -1122,12 +1275,12 @@ class Client(object):
         if length != 0:
             raise InvalidLength(REPLY_TYPE_NONE, length, 0)
 
-    def _handle_error_chunk(self, length, flags):
+    def _handle_error_chunk(self, length, flags, cmd):
         """
         Handle general error (entire request failed).
 
-        If this the last chunk raise ReplyError, failing this request.
-        Otherwise raise ProtocolError failing entire connection.
+        If this the last chunk fail cmd with ReplyError. Otherwise raise
+        ProtocolError failing entire connection.
 
         32 bits: error (MUST be nonzero)
         16 bits: message length (no more than header length - 6)
@@ -1137,7 +1290,7 @@ class Client(object):
         code, message = self._recv_error_chunk(length)
 
         if flags & REPLY_FLAG_DONE:
-            raise ReplyError(code, message)
+            cmd.error = ReplyError(code, message)
         else:
             raise ProtocolError(
                 "Unrecoverable error chunk code={} message={!r}"
@@ -1282,6 +1435,8 @@ class Command(object):
         # NBD_REPLY_TYPE_ERROR_OFFSET chunks received when handling structued
         # reply. Can happen only in Read, Write, and BlockStatus.
         self.errors = []
+        # Set to RequestError if the server failed to process the command.
+        self.error = None
 
     def to_bytes(self):
         return self.wire_format.pack(
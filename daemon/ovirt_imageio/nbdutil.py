@@ -172,10 +172,14 @@ def copy(src_client, dst_client, block_size=4 * 1024**2, queue_depth=4,
     Both exports must have identical size, but can have different format.
     """
 
-    # Consider both requested block size and clients limits.
+    # Consider both requested block size and clients limits, using a
+    # multiple of the preferred block size of both clients.
     buf_size = min(
         block_size,
         min(src_client.maximum_block_size, dst_client.maximum_block_size))
+    preferred = max(
+        src_client.preferred_block_size, dst_client.preferred_block_size)
+    buf_size = max(util.round_down(buf_size, preferred), preferred)
 
     # Leave extra room for None buffer signaling that the writer failed.
     buffers = queue.Queue(queue_depth + 1)
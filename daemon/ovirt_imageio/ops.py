@@ -8,17 +8,32 @@
 
 from __future__ import absolute_import
 
+import collections
+import errno
 import logging
+import mmap
+import os
 
 from contextlib import closing
 
 from . import errors
+from . import metrics
+from . import sizing
 from . import util
 
+try:
+    from . import aio
+except ImportError:
+    aio = None
+
 # This value is used by vdsm when copying image data using dd. Smaller values
 # save memory, and larger values minimize syscall and python calls overhead.
 BUFFERSIZE = 1024 * 1024
 
+# Read only buffer used to send zero extents. Reading an anonymous private
+# mapping maps the kernel zero page, so this buffer does not use memory.
+ZERO_BUFFER = mmap.mmap(-1, 8 * 1024**2, mmap.MAP_PRIVATE, mmap.PROT_READ)
+
 log = logging.getLogger("ops")
 
 
@@ -28,14 +43,26 @@ class EOF(Exception):
 
 class Operation(object):
 
+    # Operation name used in metrics.
+    name = None
+
+    # True if the operation modifies the image, invalidating cached image
+    # state such as the ticket extents.
+    modifies_image = False
+
     def __init__(self, size=None, offset=0, buffersize=BUFFERSIZE,
-                 clock=util.NullClock()):
+                 clock=util.NullClock(), sizer=None):
         self._size = size
         self._offset = offset
+        if sizer is None:
+            sizer = sizing.Fixed(buffersize)
+        self._sizer = sizer
+        # Buffers are allocated using the maximum size, but every step uses
+        # only the current sizer size.
         if self._size:
-            self._buffersize = min(util.round_up(size, 4096), buffersize)
+            self._buffersize = min(util.round_up(size, 4096), sizer.maximum)
         else:
-            self._buffersize = buffersize
+            self._buffersize = sizer.maximum
         self._done = 0
         self._clock = clock
 
@@ -57,9 +84,35 @@ class Operation(object):
             return self._buffersize
         return self._size - self._done
 
+    @property
+    def _step(self):
+        """
+        The number of bytes to transfer in the next step.
+        """
+        return min(self._sizer.size, self._buffersize)
+
+    @property
+    def _backend(self):
+        """
+        The backend accessed by this operation.
+        """
+        return self._dst
+
+    def done_ranges(self):
+        """
+        Return list of (start, end) byte ranges transferred so far.
+        """
+        return [(self._offset, self._offset + self._done)]
+
     def run(self):
-        with self._clock.run("operation"):
-            self._run()
+        backend = self._backend.name
+        metrics.OPERATIONS.inc(op=self.name)
+        try:
+            with self._clock.run("operation"):
+                self._run()
+        finally:
+            metrics.OPERATIONS.dec(op=self.name)
+            metrics.BYTES.inc(self._done, op=self.name, backend=backend)
 
     def __repr__(self):
         return ("<{self.__class__.__name__} "
@@ -71,35 +124,283 @@ class Operation(object):
 class Send(Operation):
     """
     Send data source backend to file object.
+
+    If queue_depth is larger than 1 and the source backend is a file,
+    read ahead up to queue_depth buffers using native AIO.
+
+    If extents is specified, zero extents in the requested range are sent
+    from a zero buffer without reading from the source. Extents must be a
+    sorted sequence of image.ZeroExtent, like the image.ExtentList returned
+    by Ticket.extents().
     """
 
+    name = "read"
+
+    # Smaller zero extents are read from storage, to avoid splitting reads
+    # into small requests.
+    MIN_HOLE_SIZE = 1024**2
+
     def __init__(self, src, dst, size=None, offset=0, buffersize=BUFFERSIZE,
-                 clock=util.NullClock()):
+                 clock=util.NullClock(), queue_depth=0, sizer=None,
+                 extents=None):
         super(Send, self).__init__(size=size, offset=offset,
-                                   buffersize=buffersize, clock=clock)
+                                   buffersize=buffersize, clock=clock,
+                                   sizer=sizer)
         self._src = src
         self._dst = dst
+        self._queue_depth = queue_depth
+        self._extents = extents
+        # The value of done at the end of the current range, or None if
+        # size is not specified.
+        self._end = size
+
+    @property
+    def _backend(self):
+        return self._src
+
+    @property
+    def _todo(self):
+        if self._end is None:
+            return self._buffersize
+        return self._end - self._done
 
     def _run(self):
         with closing(util.aligned_buffer(self._buffersize)) as buf:
             try:
-                skip = self._offset % self._src.block_size
-                self._src.seek(self._offset - skip)
-                if skip:
-                    self._send_chunk(buf, skip)
-                while self._todo:
-                    self._send_chunk(buf)
+                if self._extents is None or self._size is None:
+                    self._send_data(buf, self._offset, self._size)
+                else:
+                    for zero, start, length in self._ranges():
+                        if zero:
+                            self._send_zero(length)
+                        else:
+                            self._send_data(buf, start, length)
             except EOF:
                 pass
 
+    def _ranges(self):
+        """
+        Iterate over (zero, start, length) tuples covering the requested
+        range. Zero extents smaller than MIN_HOLE_SIZE are merged into the
+        data ranges around them. Ranges not covered by the extents are
+        considered data.
+        """
+        extents = self._extents
+        start = self._offset
+        end = self._offset + self._size
+
+        # Find the first extent ending after start.
+        lo = 0
+        hi = len(extents)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ext = extents[mid]
+            if ext.start + ext.length <= start:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        cur = None
+        pos = start
+
+        for i in range(lo, len(extents)):
+            if pos == end:
+                break
+            ext = extents[i]
+            if ext.start > pos:
+                # Gap between extents.
+                break
+            length = min(ext.start + ext.length, end) - pos
+            zero = ext.zero and length >= self.MIN_HOLE_SIZE
+            if cur and cur[0] == zero:
+                cur[2] += length
+            else:
+                if cur:
+                    yield tuple(cur)
+                cur = [zero, pos, length]
+            pos += length
+
+        if pos < end:
+            if cur and not cur[0]:
+                cur[2] += end - pos
+            else:
+                if cur:
+                    yield tuple(cur)
+                cur = [False, pos, end - pos]
+
+        if cur:
+            yield tuple(cur)
+
+    def _send_zero(self, length):
+        """
+        Send length zero bytes without reading from the source.
+        """
+        while length:
+            n = min(length, len(ZERO_BUFFER))
+            with memoryview(ZERO_BUFFER)[:n] as view:
+                with self._clock.run("write"):
+                    self._dst.write(view)
+            self._done += n
+            length -= n
+
+    def _send_data(self, buf, offset, length):
+        """
+        Send length bytes from offset in the source, or all data up to the
+        end of the source if length is None.
+        """
+        if length is not None:
+            self._end = self._done + length
+
+        skip = offset % self._src.block_size
+        self._src.seek(offset - skip)
+        if skip:
+            self._send_chunk(buf, skip)
+        if _can_aio(self._src, self._queue_depth):
+            self._send_aio()
+        elif self._can_sendfile():
+            self._sendfile()
+        while self._todo:
+            self._send_chunk(buf)
+
+    def _can_sendfile(self):
+        return (hasattr(self._src, "fileno") and
+                hasattr(self._dst, "can_sendfile") and
+                self._dst.can_sendfile())
+
+    def _sendfile(self):
+        """
+        Send block aligned data from the source file descriptor directly to
+        the destination, without copying the data to userspace.
+
+        Returns when reaching the unaligned end of the range or the end of
+        the file, leaving the rest to _send_chunk(). Direct I/O requires
+        block aligned offset and length.
+        """
+        fd = self._src.fileno()
+        block_size = self._src.block_size
+
+        while True:
+            offset = self._src.tell()
+            if offset % block_size:
+                return
+
+            # Limit the count to update self._done frequently enough to
+            # provide progress.
+            count = util.round_down(min(self._todo, self._step), block_size)
+            if count == 0:
+                return
+
+            start = util.monotonic_time()
+            with self._clock.run("sendfile"):
+                try:
+                    n = self._dst.sendfile(fd, offset, count)
+                except EnvironmentError as e:
+                    # Nothing was sent; the kernel cannot sendfile from this
+                    # file.
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    log.debug("Cannot use sendfile: %s", e)
+                    return
+
+            if n == 0:
+                return
+
+            self._sizer.update(n, util.monotonic_time() - start)
+            self._src.seek(offset + n)
+            self._done += n
+
+    def _send_aio(self):
+        """
+        Read block aligned data from the source file using native AIO,
+        keeping up to queue_depth reads in flight, and write the data to the
+        destination in order.
+
+        Returns when reaching the unaligned end of the range or the end of
+        the file, leaving the rest to _send_chunk().
+        """
+        fd = self._src.fileno()
+        block_size = self._src.block_size
+        offset = self._src.tell()
+        if offset % block_size:
+            return
+
+        # Reads submitted but not written yet, in submit order. Queued
+        # buffers are allocated once, so the step size does not change.
+        inflight = collections.deque()
+        completed = {}
+        step = self._step
+        buffers = [util.aligned_buffer(step)
+                   for i in range(self._queue_depth)]
+        free = list(buffers)
+        ctx = aio.Context(self._queue_depth)
+        try:
+            submitted = offset
+            eof = False
+            while True:
+                while free and not eof:
+                    if self._size is None:
+                        count = step
+                    else:
+                        todo = self._todo - (submitted - offset)
+                        count = util.round_down(
+                            min(todo, step), block_size)
+                    if count == 0:
+                        break
+                    buf = free.pop()
+                    view = memoryview(buf)[:count]
+                    ctx.pread(fd, view, submitted)
+                    inflight.append((buf, view, submitted))
+                    submitted += count
+
+                if not inflight:
+                    break
+
+                buf, view, start = inflight.popleft()
+                # The view must be released before closing the buffers,
+                # even if waiting or writing failed.
+                try:
+                    with self._clock.run("read"):
+                        while id(view) not in completed:
+                            for obj, res in ctx.wait():
+                                completed[id(obj)] = res
+                    n = completed.pop(id(view))
+                    if n < 0:
+                        raise OSError(-n, os.strerror(-n))
+
+                    count = len(view)
+                    with self._clock.run("write"), view[:n] as data:
+                        self._dst.write(data)
+                finally:
+                    view.release()
+
+                self._done += n
+                offset = start + n
+                free.append(buf)
+
+                # Short read: we reached the end of the file. Reads after
+                # this one read nothing.
+                if n < count:
+                    eof = True
+                    break
+        finally:
+            ctx.close()
+            for _, view, _ in inflight:
+                view.release()
+            for buf in buffers:
+                buf.close()
+
+        self._src.seek(offset)
+
     def _send_chunk(self, buf, skip=0):
         if self._src.tell() % self._src.block_size:
             if self._size is None:
                 raise EOF
             raise errors.PartialContent(self.size, self.done)
 
-        with self._clock.run("read"):
-            count = self._src.readinto(buf)
+        start = util.monotonic_time()
+        with memoryview(buf)[:self._step] as view:
+            with self._clock.run("read"):
+                count = self._src.readinto(view)
         if count == 0:
             if self._size is None:
                 raise EOF
@@ -110,20 +411,32 @@ class Send(Operation):
             with self._clock.run("write"):
                 self._dst.write(view)
         self._done += size
+        self._sizer.update(size, util.monotonic_time() - start)
 
 
 class Receive(Operation):
     """
     Receive data from file object to destination backend.
+
+    If queue_depth is larger than 1 and the destination backend is a file,
+    write up to queue_depth buffers in the background using native AIO,
+    while receiving the next buffer.
     """
 
+    name = "write"
+
+    modifies_image = True
+
     def __init__(self, dst, src, size=None, offset=0, flush=True,
-                 buffersize=BUFFERSIZE, clock=util.NullClock()):
+                 buffersize=BUFFERSIZE, clock=util.NullClock(),
+                 queue_depth=0, sizer=None):
         super(Receive, self).__init__(size=size, offset=offset,
-                                      buffersize=buffersize, clock=clock)
+                                      buffersize=buffersize, clock=clock,
+                                      sizer=sizer)
         self._src = src
         self._dst = dst
         self._flush = flush
+        self._queue_depth = queue_depth
 
     def _run(self):
         with closing(util.aligned_buffer(self._buffersize)) as buf:
@@ -139,9 +452,14 @@ class Receive(Operation):
 
                 # Now current file position is aligned to block size and we can
                 # receive full chunks.
+                if _can_aio(self._dst, self._queue_depth):
+                    self._receive_aio()
+
                 while self._todo:
-                    count = min(self._todo, self._buffersize)
+                    count = min(self._todo, self._step)
+                    start = util.monotonic_time()
                     self._receive_chunk(buf, count)
+                    self._sizer.update(count, util.monotonic_time() - start)
             except EOF:
                 pass
             finally:
@@ -149,8 +467,84 @@ class Receive(Operation):
                     with self._clock.run("sync"):
                         self._dst.flush()
 
-    def _receive_chunk(self, buf, count):
-        buf.seek(0)
+    def _receive_aio(self):
+        """
+        Receive block aligned chunks, writing them to the destination file
+        using native AIO, keeping up to queue_depth writes in flight.
+
+        Returns when the rest of the data is smaller than a block, leaving
+        it to _receive_chunk().
+        """
+        fd = self._dst.fileno()
+        block_size = self._dst.block_size
+        offset = self._dst.tell()
+
+        # Queued buffers are allocated once, so the step size does not
+        # change.
+        step = self._step
+        buffers = [util.aligned_buffer(step)
+                   for i in range(self._queue_depth)]
+        free = list(buffers)
+        ctx = aio.Context(self._queue_depth)
+        try:
+            while True:
+                count = util.round_down(
+                    min(self._todo, step), block_size)
+                if count == 0:
+                    break
+
+                if not free:
+                    self._wait_for_writes(ctx, free)
+
+                buf = free.pop()
+                read = self._read_chunk(buf, count)
+                if read < count:
+                    # Write the partial chunk after writes in flight, so
+                    # _receive_chunk() can handle the end of the stream.
+                    free.append(buf)
+                    self._wait_for_writes(ctx, free, ctx.pending)
+                    self._dst.seek(offset)
+                    self._write_chunk(buf, read)
+                    self._done += read
+                    if self._size is None:
+                        raise EOF
+                    raise errors.PartialContent(self.size, self.done)
+
+                ctx.pwrite(fd, memoryview(buf)[:count], offset)
+                offset += count
+                self._done += count
+
+            self._wait_for_writes(ctx, free, ctx.pending)
+        finally:
+            ctx.close()
+            for buf in buffers:
+                buf.close()
+
+        self._dst.seek(offset)
+
+    def _wait_for_writes(self, ctx, free, count=1):
+        """
+        Wait until count writes complete, and return their buffers to free.
+        """
+        while count > 0:
+            with self._clock.run("write"):
+                results = ctx.wait(count)
+            for view, res in results:
+                if res < 0:
+                    raise OSError(-res, os.strerror(-res))
+                if res < len(view):
+                    raise OSError(
+                        errno.EIO,
+                        "Short write: {} < {}".format(res, len(view)))
+                free.append(view.obj)
+                view.release()
+            count -= len(results)
+
+    def _read_chunk(self, buf, count):
+        """
+        Read up to count bytes from source into buf, returning the number of
+        bytes read.
+        """
         with memoryview(buf)[:count] as view:
             read = 0
             while read < count:
@@ -159,13 +553,22 @@ class Receive(Operation):
                 if not n:
                     break
                 read += n
+        return read
 
+    def _write_chunk(self, buf, count):
+        """
+        Write count bytes from buf to destination.
+        """
+        with memoryview(buf)[:count] as view:
             pos = 0
-            while pos < read:
+            while pos < count:
                 with self._clock.run("write"):
-                    n = self._dst.write(view[pos:read])
+                    n = self._dst.write(view[pos:count])
                 pos += n
 
+    def _receive_chunk(self, buf, count):
+        read = self._read_chunk(buf, count)
+        self._write_chunk(buf, read)
         self._done += read
         if read < count:
             if self._size is None:
@@ -173,11 +576,24 @@ class Receive(Operation):
             raise errors.PartialContent(self.size, self.done)
 
 
+def _can_aio(backend, queue_depth):
+    """
+    Return True if native AIO can be used with backend.
+    """
+    return (queue_depth > 1 and
+            aio is not None and
+            hasattr(backend, "fileno"))
+
+
 class Zero(Operation):
     """
     Zero byte range.
     """
 
+    name = "zero"
+
+    modifies_image = True
+
     # Limit zero size so we update self._done frequently enough to provide
     # progress even with slow storage.
     MAX_STEP = 1024**3
@@ -210,6 +626,8 @@ class Flush(Operation):
     Flush received data to storage.
     """
 
+    name = "flush"
+
     def __init__(self, dst, clock=util.NullClock()):
         super(Flush, self).__init__(clock=clock)
         self._dst = dst
@@ -217,3 +635,44 @@ class Flush(Operation):
     def _run(self):
         with self._clock.run("flush"):
             self._dst.flush()
+
+
+class Batch(object):
+    """
+    Run a list of operations as a single operation.
+
+    Every operation is run in order, and accounted in the metrics using its
+    own name. The batch reports the ranges transferred by all operations,
+    and modifies the image if any of the operations modifies it.
+    """
+
+    def __init__(self, operations):
+        self._operations = operations
+        self.modifies_image = any(op.modifies_image for op in operations)
+
+    @property
+    def size(self):
+        return sum(op.size or 0 for op in self._operations)
+
+    @property
+    def offset(self):
+        return min(op.offset for op in self._operations)
+
+    @property
+    def done(self):
+        return sum(op.done for op in self._operations)
+
+    def done_ranges(self):
+        ranges = []
+        for op in self._operations:
+            ranges.extend(op.done_ranges())
+        return ranges
+
+    def run(self):
+        for op in self._operations:
+            op.run()
+
+    def __repr__(self):
+        return ("<Batch operations={ops} done={self.done} "
+                "at 0x{id}>").format(
+                    ops=len(self._operations), self=self, id=id(self))
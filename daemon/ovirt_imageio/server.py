@@ -21,6 +21,7 @@ from . import auth
 from . import config
 from . import services
 from . import version
+from . import workers
 
 log = logging.getLogger("server")
 
@@ -69,16 +70,23 @@ class Server:
 
     def __init__(self, config):
         self.config = config
-        self.auth = auth.Authorizer()
+        self.auth = auth.Authorizer(
+            cache_size=config.daemon.cache_size,
+            write_buffer_size=config.daemon.write_buffer_size)
         self.remote_service = None
         self.local_service = None
         self.control_service = None
+        self.workers = None
         self.running = False
 
     def start(self):
         assert not self.running
         self.running = True
 
+        if self.config.daemon.workers > 1:
+            self._start_workers()
+            return
+
         log.debug("Starting remote service on port %d",
                   self.config.remote.port)
         self.remote_service = services.RemoteService(self.config, self.auth)
@@ -92,11 +100,31 @@ class Server:
 
         log.debug("Starting control service on socket %r",
                   self.config.control.socket)
-        self.control_service = services.ControlService(self.config, self.auth)
+        self.control_service = services.ControlService(
+            self.config, self.auth, remote_service=self.remote_service)
+        self.control_service.start()
+
+    def _start_workers(self):
+        # Workers must be started before starting any thread.
+        self.workers = workers.Workers(self.config)
+        self.workers.start()
+        self.auth = workers.Authorizer(self.workers)
+
+        log.debug("Starting control service on socket %r",
+                  self.config.control.socket)
+        self.control_service = services.ControlService(
+            self.config, self.auth, workers=self.workers)
         self.control_service.start()
 
     def stop(self):
         log.debug("Stopping services")
+        if self.workers is not None:
+            self.control_service.stop()
+            self.workers.stop()
+            self.control_service = None
+            self.workers = None
+            return
+
         self.remote_service.stop()
         if self.local_service is not None:
             self.local_service.stop()
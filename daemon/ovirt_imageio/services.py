@@ -8,20 +8,30 @@
 
 from __future__ import absolute_import
 
+import json
 import logging
 
 from . import errors
 from . import extents
 from . import http
 from . import images
+from . import metrics
 from . import profile
 from . import ssl
 from . import tickets
 from . import uhttp
 from . import util
+from . import validate
 
 log = logging.getLogger("services")
 
+# Clock classes for timing connections.
+CLOCKS = {
+    "none": util.NullClock,
+    "log": util.Clock,
+    "metrics": metrics.Clock,
+}
+
 
 class Service(object):
 
@@ -59,13 +69,16 @@ class RemoteService(Service):
 
     name = "remote.service"
 
-    def __init__(self, config, auth):
+    def __init__(self, config, auth, context=None, reuse_port=False):
         self._config = config
-        self._server = http.Server(
+        self._context = context
+        self._server = _create_server(
+            config,
+            http,
             (config.remote.host, config.remote.port),
-            http.Connection)
-        # TODO: Make clock configurable, disabled by default.
-        self._server.clock_class = util.Clock
+            http.Connection,
+            reuse_port=reuse_port)
+        self._server.clock_class = _clock_class(config.remote.clock)
         if config.remote.port == 0:
             config.remote.port = self.port
         if config.tls.enable:
@@ -76,25 +89,18 @@ class RemoteService(Service):
         ])
         log.debug("%s listening on port %d", self.name, self.port)
 
+    def tls_stats(self):
+        """
+        Return TLS session statistics, or None if TLS is disabled.
+        """
+        if self._context is None:
+            return None
+        return ssl.session_stats(self._context)
+
     def _secure_server(self):
-        required_config = (
-            self._config.tls.ca_file,
-            self._config.tls.cert_file,
-            self._config.tls.key_file,
-        )
-        if "" in required_config:
-            raise errors.TlsConfigurationError(*required_config)
-
-        log.debug("Securing server (cafile=%s, certfile=%s, keyfile=%s)",
-                  self._config.tls.ca_file,
-                  self._config.tls.cert_file,
-                  self._config.tls.key_file)
-        context = ssl.server_context(
-            self._config.tls.cert_file,
-            self._config.tls.key_file,
-            cafile=self._config.tls.ca_file,
-            enable_tls1_1=self._config.tls.enable_tls1_1)
-        self._server.socket = context.wrap_socket(
+        if self._context is None:
+            self._context = tls_context(self._config)
+        self._server.socket = self._context.wrap_socket(
             self._server.socket, server_side=True)
 
 
@@ -108,11 +114,11 @@ class LocalService(Service):
 
     name = "local.service"
 
-    def __init__(self, config, auth):
+    def __init__(self, config, auth, sock=None):
         self._config = config
-        self._server = uhttp.Server(config.local.socket, uhttp.Connection)
-        # TODO: Make clock configurable, disabled by default.
-        self._server.clock_class = util.Clock
+        self._server = _create_server(
+            config, uhttp, config.local.socket, uhttp.Connection, sock=sock)
+        self._server.clock_class = _clock_class(config.local.clock)
         if config.local.socket == "":
             config.local.socket = self.address
         self._server.app = http.Router([
@@ -132,15 +138,139 @@ class ControlService(Service):
 
     name = "control.service"
 
-    def __init__(self, config, auth):
+    def __init__(self, config, auth, remote_service=None, workers=None):
         self._config = config
-        self._server = uhttp.Server(config.control.socket, uhttp.Connection)
-        # TODO: Make clock configurable, disabled by default.
-        self._server.clock_class = util.Clock
+        self._server = _create_server(
+            config, uhttp, config.control.socket, uhttp.Connection)
+        self._server.clock_class = _clock_class(config.control.clock)
         if config.control.socket == "":
             config.control.socket = self.address
         self._server.app = http.Router([
             (r"/tickets/(.*)", tickets.Handler(config, auth)),
             (r"/profile/", profile.Handler(config, auth)),
+            (r"/tls/", TLSHandler(remote_service)),
+            (r"/metrics", MetricsHandler(workers)),
         ])
         log.debug("%s listening on %r", self.name, self.address)
+
+
+def _clock_class(name):
+    try:
+        return CLOCKS[name]
+    except KeyError:
+        raise ValueError(
+            "Invalid clock {!r}, expecting one of {}"
+            .format(name, sorted(CLOCKS)))
+
+
+def tls_context(config):
+    """
+    Create a server TLS context using config.
+    """
+    required_config = (
+        config.tls.ca_file,
+        config.tls.cert_file,
+        config.tls.key_file,
+    )
+    if "" in required_config:
+        raise errors.TlsConfigurationError(*required_config)
+
+    log.debug("Creating TLS context (cafile=%s, certfile=%s, keyfile=%s)",
+              config.tls.ca_file,
+              config.tls.cert_file,
+              config.tls.key_file)
+    return ssl.server_context(
+        config.tls.cert_file,
+        config.tls.key_file,
+        cafile=config.tls.ca_file,
+        enable_tls1_1=config.tls.enable_tls1_1,
+        session_tickets=config.tls.session_tickets,
+        enable_ktls=config.tls.enable_ktls)
+
+
+def _create_server(config, module, address, connection_class,
+                   reuse_port=False, sock=None):
+    """
+    Create a server from module http or uhttp, using an event loop or a
+    thread per connection.
+
+    If sock is specified, serve on this listening socket, inherited from the
+    parent process, instead of binding to address.
+    """
+    if config.daemon.async_server:
+        server = module.AsyncServer(
+            address, connection_class, bind_and_activate=False)
+        server.max_workers = config.daemon.async_workers
+    else:
+        server = module.Server(
+            address, connection_class, bind_and_activate=False)
+
+    try:
+        if sock is None:
+            server.reuse_port = reuse_port
+            server.server_bind()
+            server.server_activate()
+        else:
+            server.socket.close()
+            server.socket = sock
+            server.server_address = util.ensure_text(sock.getsockname())
+    except:  # noqa: E722
+        server.server_close()
+        raise
+
+    return server
+
+
+class TLSHandler(object):
+    """
+    Request handler for the /tls/ resource.
+    """
+
+    def __init__(self, remote_service):
+        self.remote_service = remote_service
+
+    def get(self, req, resp):
+        """
+        Return remote service TLS session statistics.
+        """
+        if self.remote_service is None:
+            raise http.Error(http.NOT_FOUND, "Remote service not available")
+
+        stats = self.remote_service.tls_stats()
+        if stats is None:
+            raise http.Error(http.NOT_FOUND, "TLS is disabled")
+
+        resp.send_json(stats)
+
+
+class MetricsHandler(object):
+    """
+    Request handler for the /metrics resource.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+
+    def get(self, req, resp):
+        """
+        Return daemon metrics in Prometheus text format, or in json format
+        if format=json.
+        """
+        fmt = validate.enum(
+            req.query, "format", ("text", "json"), default="text")
+
+        samples = metrics.REGISTRY.collect()
+
+        # When using worker processes, the workers serve the requests.
+        if self.workers is not None:
+            for data in self.workers.request("GET", "/metrics?format=json"):
+                metrics.REGISTRY.merge(samples, json.loads(data))
+
+        if fmt == "json":
+            resp.send_json(samples)
+            return
+
+        body = metrics.REGISTRY.format(samples).encode("utf-8")
+        resp.headers["content-type"] = metrics.CONTENT_TYPE
+        resp.headers["content-length"] = len(body)
+        resp.write(body)
@@ -0,0 +1,184 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+"""
+sizing - choose buffer sizes for data operations.
+"""
+
+from __future__ import absolute_import
+
+import logging
+
+from . import util
+
+# Limits for adaptive buffer size.
+MIN_BUFFER_SIZE = 256 * 1024
+MAX_BUFFER_SIZE = 32 * 1024**2
+
+log = logging.getLogger("sizing")
+
+
+def create(backends, size, adaptive=False, minimum=MIN_BUFFER_SIZE,
+           maximum=MAX_BUFFER_SIZE):
+    """
+    Create a sizer for transferring data using backends.
+
+    The initial size is limited by the backends hints; the size is always a
+    multiple of the largest backend block_size, and is not larger than the
+    smallest backend max_request_size. Both hints are optional.
+
+    If adaptive is True, return a sizer adapting the size to the measured
+    throughput, between minimum and maximum. Otherwise return a sizer using
+    a fixed size.
+    """
+    alignment = 1
+    for backend in backends:
+        alignment = max(alignment, getattr(backend, "block_size", 1))
+        maximum = min(maximum, getattr(backend, "max_request_size", maximum))
+
+    maximum = max(util.round_down(maximum, alignment), alignment)
+    size = max(util.round_down(min(size, maximum), alignment), alignment)
+
+    if not adaptive:
+        return Fixed(size)
+
+    minimum = min(max(util.round_up(minimum, alignment), alignment), size)
+    return Adaptive(size, minimum, maximum, alignment)
+
+
+class Fixed(object):
+    """
+    Sizer using a fixed size.
+    """
+
+    settled = True
+
+    def __init__(self, size):
+        self.size = size
+
+    @property
+    def maximum(self):
+        return self.size
+
+    def update(self, count, seconds):
+        pass
+
+    def __repr__(self):
+        return "<Fixed size={self.size} at 0x{id}>".format(
+            self=self, id=id(self))
+
+
+class Adaptive(object):
+    """
+    Sizer adapting the size to the measured throughput.
+
+    Users report every step using update(). After WINDOW steps, the sizer
+    computes the throughput, and tries the next size. The sizer doubles the
+    size while the throughput improves by more than THRESHOLD. If doubling
+    the initial size does not help, it halves the size in the same way. When
+    the throughput does not improve, it returns to the best size and stops
+    measuring.
+
+    A sizer is not thread safe; every connection should use its own sizer.
+    """
+
+    # Number of steps measured before changing the size.
+    WINDOW = 8
+
+    # Minimal relative throughput improvement for changing the size.
+    THRESHOLD = 0.05
+
+    def __init__(self, size, minimum, maximum, alignment=1):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.alignment = alignment
+        self.settled = minimum == maximum
+        self._initial = size
+        self._growing = True
+        self._best_size = size
+        self._best_rate = 0.0
+        self._steps = 0
+        self._bytes = 0
+        self._seconds = 0.0
+
+    def update(self, count, seconds):
+        """
+        Report a step transferring count bytes in seconds.
+        """
+        if self.settled:
+            return
+
+        self._steps += 1
+        self._bytes += count
+        self._seconds += seconds
+
+        if self._steps < self.WINDOW:
+            return
+
+        if self._seconds > 0:
+            rate = self._bytes / self._seconds
+        else:
+            rate = float("inf")
+
+        self._steps = 0
+        self._bytes = 0
+        self._seconds = 0.0
+
+        self._next(rate)
+
+    def _next(self, rate):
+        if rate > self._best_rate * (1 + self.THRESHOLD):
+            self._best_size = self.size
+            self._best_rate = rate
+        elif self._growing and self._best_size == self._initial:
+            # Growing did not help, try shrinking.
+            self._growing = False
+        else:
+            self._settle()
+            return
+
+        size = self._candidate()
+        if size is None and self._growing and \
+                self._best_size == self._initial:
+            self._growing = False
+            size = self._candidate()
+
+        if size is None:
+            self._settle()
+            return
+
+        log.debug("Trying size %d (best size %d, %.2f MiB/s)",
+                  size, self._best_size, self._best_rate / 1024**2)
+        self.size = size
+
+    def _candidate(self):
+        """
+        Return the next size to try, or None if the size cannot change.
+        """
+        if self._growing:
+            size = self._best_size * 2
+        else:
+            size = self._best_size // 2
+
+        size = util.round_down(size, self.alignment)
+        if size == self._best_size or not (
+                self.minimum <= size <= self.maximum):
+            return None
+
+        return size
+
+    def _settle(self):
+        log.debug("Using size %d (%.2f MiB/s)",
+                  self._best_size, self._best_rate / 1024**2)
+        self.size = self._best_size
+        self.settled = True
+
+    def __repr__(self):
+        return ("<Adaptive size={self.size} minimum={self.minimum} "
+                "maximum={self.maximum} settled={self.settled} "
+                "at 0x{id}>").format(self=self, id=id(self))
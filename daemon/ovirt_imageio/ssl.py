@@ -8,17 +8,53 @@
 
 from __future__ import absolute_import
 
+import errno
+import logging
+import socket
 import ssl
 import subprocess
 
+log = logging.getLogger("ssl")
 
-def server_context(certfile, keyfile, cafile=None, enable_tls1_1=False):
+# Linux kernel TLS constants, missing in the socket module.
+# See linux/tcp.h and linux/tls.h.
+TCP_ULP = 31
+SOL_TLS = 282
+TLS_TX = 1
+
+_ktls_supported = None
+
+WantReadError = ssl.SSLWantReadError
+
+
+def server_context(certfile, keyfile, cafile=None, enable_tls1_1=False,
+                   session_tickets=True, enable_ktls=False):
     # TODO: Verify client certs
     ctx = ssl.create_default_context(
         purpose=ssl.Purpose.CLIENT_AUTH, cafile=cafile)
     ctx.options |= ssl.OP_NO_TLSv1
     if not enable_tls1_1:
         ctx.options |= ssl.OP_NO_TLSv1_1
+
+    # Session tickets allow clients to resume a session using an abbreviated
+    # handshake when opening another connection.
+    if session_tickets:
+        ctx.options &= ~ssl.OP_NO_TICKET
+    else:
+        ctx.options |= ssl.OP_NO_TICKET
+        # Python 3.8+: TLSv1.3 tickets are controlled by num_tickets.
+        if hasattr(ctx, "num_tickets"):
+            ctx.num_tickets = 0
+
+    # Kernel TLS offloads the symmetric encryption to the kernel after the
+    # handshake, allowing sendfile() on TLS connections.
+    if enable_ktls:
+        if ktls_supported():
+            log.debug("Enabling kernel TLS")
+            ctx.options |= ssl.OP_ENABLE_KTLS
+        else:
+            log.warning("Kernel TLS is not available, using userspace TLS")
+
     ctx.load_cert_chain(certfile, keyfile=keyfile)
     return ctx
 
@@ -32,6 +68,76 @@ def client_context(cafile=None, enable_tls1_1=False):
     return ctx
 
 
+def session_stats(ctx):
+    """
+    Return dict with context session statistics, including the session
+    resumption hit rate.
+    """
+    stats = ctx.session_stats()
+    handshakes = stats["accept_good"] + stats["connect_good"]
+    stats["hit_rate"] = stats["hits"] / handshakes if handshakes else 0.0
+    return stats
+
+
+def ktls_supported():
+    """
+    Return True if both Python and the kernel support kernel TLS.
+
+    Python 3.12 and later can ask OpenSSL to enable kernel TLS. The kernel
+    supports it if the "tls" upper layer protocol can be set on a TCP
+    socket.
+    """
+    global _ktls_supported
+    if _ktls_supported is None:
+        _ktls_supported = (
+            hasattr(ssl, "OP_ENABLE_KTLS") and _kernel_supports_ktls())
+    return _ktls_supported
+
+
+def _kernel_supports_ktls():
+    # The upper layer protocol can be set only on a connected socket.
+    with socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        with socket.create_connection(server.getsockname()) as client:
+            try:
+                client.setsockopt(socket.SOL_TCP, TCP_ULP, b"tls")
+            except EnvironmentError as e:
+                log.debug("Kernel does not support TLS: %s", e)
+                return False
+    return True
+
+
+def can_sendfile(sock):
+    """
+    Return True if data can be sent to sock using os.sendfile(). This is
+    possible for plain sockets, and for TLS sockets using kernel TLS for
+    sending.
+    """
+    if not is_tls(sock):
+        return True
+
+    # If kernel TLS is enabled for sending, the kernel returns the crypto
+    # info. Otherwise the call fails with EOPNOTSUPP or ENOPROTOOPT if the
+    # socket does not use kernel TLS, or EBUSY if it is not configured for
+    # sending.
+    try:
+        sock.getsockopt(SOL_TLS, TLS_TX, 64)
+    except EnvironmentError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOPROTOOPT, errno.EBUSY):
+            raise
+        return False
+
+    return True
+
+
+def is_tls(sock):
+    """
+    Return True if sock is a TLS socket.
+    """
+    return isinstance(sock, ssl.SSLSocket)
+
+
 def check_protocol(server_host, server_port, protocol):
     """
     Use openssl command line tool for checking ssl protocol.
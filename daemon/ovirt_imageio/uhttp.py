@@ -89,6 +89,12 @@ class Server(http.Server):
         return sock, self.server_address
 
 
+class AsyncServer(http.AsyncMixIn, Server):
+    """
+    HTTP server over unix domain socket using an asyncio event loop.
+    """
+
+
 class Connection(http.Connection):
     """
     HTTP connection over unix domain socket.
@@ -11,6 +11,7 @@ from __future__ import absolute_import
 import collections
 import errno
 import io
+import math
 import mmap
 import os
 import threading
@@ -78,6 +79,8 @@ class Clock(object):
         clock.stop("total")
         log.info("times=%s", clock)
 
+    The time of every run is recorded in a histogram, so timers run more
+    than once report also the median, 99th percentile, and maximum time.
     """
 
     def __init__(self):
@@ -105,6 +108,7 @@ class Clock(object):
 
         elapsed = time.time() - t.started
         t.total += elapsed
+        t.histogram.record(elapsed)
         t.started = None
 
         return elapsed
@@ -125,7 +129,12 @@ class Clock(object):
                 total = now - t.started
             else:
                 total = t.total
-            timers.append("%s=%.6f/%d" % (t.name, total, t.count))
+            timer = "%s=%.6f/%d" % (t.name, total, t.count)
+            h = t.histogram
+            if h.count > 1:
+                timer += " (p50=%.6f p99=%.6f max=%.6f)" % (
+                    h.percentile(50), h.percentile(99), h.max)
+            timers.append(timer)
         return "[%s]" % ", ".join(timers)
 
 
@@ -162,6 +171,124 @@ class Timer(object):
         self.total = 0.0
         self.count = 0
         self.started = None
+        self.histogram = Histogram()
+
+
+class Histogram(object):
+    """
+    Log-linear histogram of durations, in the style of HdrHistogram:
+    http://hdrhistogram.org/
+
+    Values are recorded in microseconds. Every power of 2 range is split to
+    2**(SUB_BITS - 1) buckets, so values smaller than 2**SUB_BITS are
+    recorded exactly, and larger values are recorded with relative error
+    smaller than 2**(1 - SUB_BITS). Values larger than MAX_VALUE are
+    recorded as MAX_VALUE.
+
+    Memory usage is bounded by the number of buckets, and histograms
+    recorded by different clocks can be merged.
+    """
+
+    SUB_BITS = 5
+    SUB_COUNT = 2**SUB_BITS
+
+    # About 19 hours.
+    MAX_VALUE = 2**36 - 1
+
+    def __init__(self):
+        # Sparse bucket counts; we typically use only few buckets.
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def record(self, seconds):
+        # Called for every timed stage; keep it fast.
+        value = int(seconds * 1000000)
+        if value < 0:
+            value = 0
+        elif value > self.MAX_VALUE:
+            value = self.MAX_VALUE
+        i = self._index(value)
+
+        counts = self.counts
+        counts[i] = counts.get(i, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+
+    def percentile(self, p):
+        """
+        Return the value in seconds at percentile p (0-100), or 0 if the
+        histogram is empty.
+        """
+        if self.count == 0:
+            return 0.0
+
+        rank = max(1, int(math.ceil(p / 100.0 * self.count)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                break
+
+        low, high = self._range(i)
+        value = (low + high) / 2.0 / 1000000
+        return min(max(value, self.min), self.max)
+
+    def merge(self, other):
+        for i, n in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max > self.max:
+            self.max = other.max
+
+    def state(self):
+        """
+        Return histogram state that can be serialized to json.
+        """
+        return {
+            "counts": sorted(self.counts.items()),
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        h = cls()
+        h.counts = {int(i): n for i, n in state["counts"]}
+        h.count = state["count"]
+        h.sum = state["sum"]
+        h.min = state["min"]
+        h.max = state["max"]
+        return h
+
+    def _index(self, value):
+        """
+        Return the index of the bucket for value in microseconds.
+        """
+        shift = max(value.bit_length() - self.SUB_BITS, 0)
+        return (shift << (self.SUB_BITS - 1)) + (value >> shift)
+
+    def _range(self, index):
+        """
+        Return the smallest and largest values in bucket index.
+        """
+        if index < self.SUB_COUNT:
+            return index, index
+        shift = (index >> (self.SUB_BITS - 1)) - 1
+        sub = index - (shift << (self.SUB_BITS - 1))
+        return sub << shift, ((sub + 1) << shift) - 1
 
 
 def round_up(n, size):
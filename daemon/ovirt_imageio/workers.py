@@ -0,0 +1,319 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+"""
+workers - serve images using multiple processes
+
+In this mode the daemon process runs only the control service, and forks
+worker processes serving the remote and local services.
+
+Every worker listens on the remote port using SO_REUSEPORT, so the kernel
+distributes incoming connections between the workers. The local service
+socket is a unix socket, not supported by SO_REUSEPORT, so the daemon binds
+it before forking, and all workers accept connections on the inherited
+socket.
+
+The TLS context is created before forking, so all workers use the same
+session ticket keys, and clients can resume a TLS session with any worker.
+
+Every worker runs a private control service, listening on a random abstract
+unix socket. Tickets installed using the daemon control service are
+replicated to all workers, and ticket info returned by the daemon includes
+the progress in all workers.
+
+Workers do not share state, so an image modified by one worker is not
+visible to caches in other workers. Workers do not cache image extents, and
+the read cache and write buffer are not supported.
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+from . import auth
+from . import services
+from . import uhttp
+from . import util
+
+log = logging.getLogger("workers")
+
+# Time to wait until a worker is ready or terminates.
+WORKER_TIMEOUT = 30
+
+
+class Workers(object):
+    """
+    Manage worker processes.
+
+    Must be started before starting any thread in the daemon process.
+    """
+
+    def __init__(self, config):
+        if config.daemon.cache_size or config.daemon.write_buffer_size:
+            raise ValueError(
+                "cache_size and write_buffer_size are not supported with "
+                "workers={}".format(config.daemon.workers))
+        self._config = config
+        self._port_sock = None
+        self._local_sock = None
+        self._procs = []
+        self.sockets = []
+
+    def start(self):
+        count = self._config.daemon.workers
+        log.debug("Starting %d workers", count)
+
+        context = None
+        if self._config.tls.enable:
+            context = services.tls_context(self._config)
+
+        # Reserve the remote port without listening on it; the kernel
+        # distributes connections only to listening sockets.
+        self._port_sock = _reserve_port(
+            self._config.remote.host, self._config.remote.port)
+        if self._config.remote.port == 0:
+            self._config.remote.port = self._port_sock.getsockname()[1]
+
+        if self._config.local.enable:
+            self._local_sock = _bind_unix(self._config.local.socket)
+            if self._config.local.socket == "":
+                self._config.local.socket = util.ensure_text(
+                    self._local_sock.getsockname())
+
+        mp = multiprocessing.get_context("fork")
+        try:
+            for i in range(count):
+                reader, writer = mp.Pipe(duplex=False)
+                proc = mp.Process(
+                    target=_run_worker,
+                    args=(self._config, context, self._local_sock, writer),
+                    name="worker/{}".format(i))
+                proc.daemon = True
+                proc.start()
+                self._procs.append(proc)
+                writer.close()
+
+                with reader:
+                    if not reader.poll(WORKER_TIMEOUT):
+                        raise RuntimeError(
+                            "Timeout waiting for {}".format(proc.name))
+                    try:
+                        address = reader.recv()
+                    except EOFError:
+                        raise RuntimeError(
+                            "{} failed to start".format(proc.name))
+
+                log.debug("Started %s pid=%s control=%r",
+                          proc.name, proc.pid, address)
+                self.sockets.append(address)
+        except:  # noqa: E722
+            self.stop()
+            raise
+
+    def stop(self):
+        log.debug("Stopping workers")
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            proc.join(WORKER_TIMEOUT)
+            if proc.is_alive():
+                log.warning("Killing unresponsive %s pid=%s",
+                            proc.name, proc.pid)
+                proc.kill()
+                proc.join()
+        self._procs = []
+        self.sockets = []
+
+        if self._local_sock is not None:
+            self._local_sock.close()
+            self._local_sock = None
+        if self._port_sock is not None:
+            self._port_sock.close()
+            self._port_sock = None
+
+    def request(self, method, path, body=None):
+        """
+        Send request to all workers control services, and return list of
+        response bodies.
+
+        Raises RuntimeError if any worker failed the request.
+        """
+        results = []
+        for address in self.sockets:
+            con = uhttp.UnixHTTPConnection(address, timeout=WORKER_TIMEOUT)
+            try:
+                con.request(method, path, body=body)
+                res = con.getresponse()
+                data = res.read()
+            finally:
+                con.close()
+
+            if res.status >= 300:
+                raise RuntimeError(
+                    "Worker {!r} failed {} {}: {} {}".format(
+                        address, method, path, res.status, data))
+
+            results.append(data)
+
+        return results
+
+
+class Authorizer(auth.Authorizer):
+    """
+    Authorizer replicating tickets to all workers.
+    """
+
+    def __init__(self, workers):
+        auth.Authorizer.__init__(self)
+        self._workers = workers
+
+    def add(self, ticket_dict):
+        auth.Authorizer.add(self, ticket_dict)
+        self._workers.request(
+            "PUT", "/tickets/" + ticket_dict["uuid"],
+            body=json.dumps(ticket_dict).encode("utf-8"))
+
+    def remove(self, ticket_id):
+        try:
+            auth.Authorizer.remove(self, ticket_id)
+        finally:
+            self._workers.request("DELETE", "/tickets/" + ticket_id)
+
+    def clear(self):
+        auth.Authorizer.clear(self)
+        self._workers.request("DELETE", "/tickets/")
+
+    def get(self, ticket_id):
+        ticket = auth.Authorizer.get(self, ticket_id)
+        return Ticket(ticket, self._workers)
+
+
+class Ticket(object):
+    """
+    Ticket proxy, reporting the state of the ticket in all workers.
+    """
+
+    def __init__(self, ticket, workers):
+        self._ticket = ticket
+        self._workers = workers
+
+    def info(self):
+        info = self._ticket.info()
+        path = "/tickets/" + self._ticket.uuid
+        infos = [json.loads(data)
+                 for data in self._workers.request("GET", path)]
+        return merge_info(info, infos)
+
+    def extend(self, timeout):
+        self._ticket.extend(timeout)
+        self._workers.request(
+            "PATCH", "/tickets/" + self._ticket.uuid,
+            body=json.dumps({"timeout": timeout}).encode("utf-8"))
+
+    def __getattr__(self, name):
+        return getattr(self._ticket, name)
+
+
+def merge_info(info, infos):
+    """
+    Merge ticket info from all workers into ticket info from the daemon.
+
+    A ticket is active if it is active in any worker, and expires when it
+    expires in the last worker. The idle time is the time since the last
+    operation in any worker, and transferred is the sum of bytes
+    transferred by all workers. Clients transfer every range once, so ranges
+    transferred by different workers do not overlap.
+    """
+    if not infos:
+        return info
+
+    info = dict(info)
+    info["active"] = any(i["active"] for i in infos)
+    info["expires"] = max(i["expires"] for i in infos)
+    info["idle_time"] = min(i["idle_time"] for i in infos)
+
+    transferred = [i["transferred"] for i in infos if "transferred" in i]
+    if len(transferred) == len(infos):
+        info["transferred"] = sum(transferred)
+    else:
+        info.pop("transferred", None)
+
+    return info
+
+
+def _reserve_port(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+    except:  # noqa: E722
+        sock.close()
+        raise
+    return sock
+
+
+def _bind_unix(address):
+    server = uhttp.Server(address, uhttp.Connection)
+    # Several workers are waiting on the same socket; the workers that lost
+    # the race must not block in accept().
+    server.socket.setblocking(False)
+    return server.socket
+
+
+def _run_worker(config, context, local_sock, conn):
+    # The daemon handles SIGINT and terminates the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    running = [True]
+
+    def terminate(signo, frame):
+        running[0] = False
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    log.info("Worker starting (pid=%s)", os.getpid())
+
+    # Another worker may modify the image, invalidating cached extents.
+    authorizer = auth.Authorizer(cache_extents=False)
+
+    # The daemon owns the control socket. Replicated tickets are installed
+    # using a private control socket.
+    config.control.socket = ""
+
+    remote_service = services.RemoteService(
+        config, authorizer, context=context, reuse_port=True)
+    remote_service.start()
+
+    local_service = None
+    if local_sock is not None:
+        local_service = services.LocalService(
+            config, authorizer, sock=local_sock)
+        local_service.start()
+
+    control_service = services.ControlService(
+        config, authorizer, remote_service=remote_service)
+    control_service.start()
+
+    with conn:
+        conn.send(control_service.address)
+
+    try:
+        while running[0]:
+            signal.pause()
+    finally:
+        remote_service.stop()
+        if local_service is not None:
+            local_service.stop()
+        control_service.stop()
+
+    log.info("Worker stopped")
@@ -30,5 +30,8 @@ setup(
         Extension(
             "ovirt_imageio/ioutil",
             sources=["ovirt_imageio/ioutil.c"]),
+        Extension(
+            "ovirt_imageio/aio",
+            sources=["ovirt_imageio/aio.c"]),
     ]
 )
@@ -0,0 +1,161 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from __future__ import absolute_import
+
+import errno
+
+from contextlib import closing
+
+import pytest
+
+from ovirt_imageio import util
+
+from . marks import requires_python3
+
+pytestmark = requires_python3
+
+aio = pytest.importorskip("ovirt_imageio.aio")
+
+BLOCKSIZE = 4096
+
+
+@pytest.fixture
+def fd(tmpdir):
+    path = str(tmpdir.join("file"))
+    with util.open(path, "w") as f:
+        buf = util.aligned_buffer(BLOCKSIZE * 4)
+        with closing(buf):
+            for i in range(4):
+                buf[i * BLOCKSIZE:(i + 1) * BLOCKSIZE] = b"%d" % i * BLOCKSIZE
+            f.write(buf)
+
+    with util.open(path, "r+") as f:
+        yield f.fileno()
+
+
+def test_read_parallel(fd):
+    ctx = aio.Context(4)
+    buffers = [util.aligned_buffer(BLOCKSIZE) for i in range(4)]
+    try:
+        for i, buf in enumerate(buffers):
+            ctx.pread(fd, buf, i * BLOCKSIZE)
+        assert ctx.pending == 4
+
+        results = []
+        while ctx.pending:
+            results.extend(ctx.wait())
+
+        assert sorted((buffers.index(buf), n) for buf, n in results) == [
+            (i, BLOCKSIZE) for i in range(4)]
+
+        for i, buf in enumerate(buffers):
+            assert buf[:] == b"%d" % i * BLOCKSIZE
+    finally:
+        ctx.close()
+        for buf in buffers:
+            buf.close()
+
+
+def test_write(fd):
+    ctx = aio.Context(1)
+    with closing(util.aligned_buffer(BLOCKSIZE)) as buf:
+        buf[:] = b"x" * BLOCKSIZE
+        ctx.pwrite(fd, buf, BLOCKSIZE)
+        assert ctx.wait() == [(buf, BLOCKSIZE)]
+
+        ctx.pread(fd, buf, 0)
+        ctx.wait()
+        assert buf[:] == b"0" * BLOCKSIZE
+
+        ctx.pread(fd, buf, BLOCKSIZE)
+        ctx.wait()
+        assert buf[:] == b"x" * BLOCKSIZE
+
+        ctx.close()
+
+
+def test_read_memoryview(fd):
+    ctx = aio.Context(1)
+    with closing(util.aligned_buffer(BLOCKSIZE * 2)) as buf:
+        with memoryview(buf)[:BLOCKSIZE] as view:
+            ctx.pread(fd, view, 3 * BLOCKSIZE)
+            assert ctx.wait() == [(view, BLOCKSIZE)]
+        assert buf[:BLOCKSIZE] == b"3" * BLOCKSIZE
+        ctx.close()
+
+
+def test_read_eof(fd):
+    ctx = aio.Context(1)
+    with closing(util.aligned_buffer(BLOCKSIZE * 2)) as buf:
+        ctx.pread(fd, buf, 3 * BLOCKSIZE)
+        assert ctx.wait() == [(buf, BLOCKSIZE)]
+
+        ctx.pread(fd, buf, 4 * BLOCKSIZE)
+        assert ctx.wait() == [(buf, 0)]
+
+        ctx.close()
+
+
+def test_read_unaligned(fd):
+    ctx = aio.Context(1)
+    with closing(util.aligned_buffer(BLOCKSIZE)) as buf:
+        ctx.pread(fd, buf, 1)
+        # Direct I/O requires aligned offset.
+        assert ctx.wait() == [(buf, -errno.EINVAL)]
+        ctx.close()
+
+
+def test_read_readonly_buffer(fd):
+    ctx = aio.Context(1)
+    with pytest.raises(BufferError):
+        ctx.pread(fd, b"x" * BLOCKSIZE, 0)
+    ctx.close()
+
+
+def test_too_many_requests(fd):
+    ctx = aio.Context(1)
+    with closing(util.aligned_buffer(BLOCKSIZE)) as buf:
+        ctx.pread(fd, buf, 0)
+        with pytest.raises(RuntimeError):
+            ctx.pread(fd, buf, 0)
+        ctx.close()
+
+
+def test_invalid_fd():
+    ctx = aio.Context(1)
+    with closing(util.aligned_buffer(BLOCKSIZE)) as buf:
+        with pytest.raises(OSError) as e:
+            ctx.pread(-1, buf, 0)
+        assert e.value.errno == errno.EBADF
+    ctx.close()
+
+
+def test_close_waits_for_pending(fd):
+    ctx = aio.Context(2)
+    with closing(util.aligned_buffer(BLOCKSIZE)) as buf:
+        ctx.pread(fd, buf, 0)
+        ctx.close()
+        assert ctx.pending == 0
+        assert buf[:] == b"0" * BLOCKSIZE
+
+
+def test_closed():
+    ctx = aio.Context(1)
+    ctx.close()
+    # Closing twice does nothing.
+    ctx.close()
+    with pytest.raises(ValueError):
+        ctx.wait()
+    with pytest.raises(ValueError):
+        ctx.pread(0, bytearray(1), 0)
+
+
+def test_invalid_nr_events():
+    with pytest.raises(ValueError):
+        aio.Context(0)
@@ -8,15 +8,18 @@
 
 from __future__ import absolute_import
 
+import functools
 import time
 
 import pytest
 
 from six.moves import xrange
 
+from ovirt_imageio import cache
 from ovirt_imageio import errors
 from ovirt_imageio import util
-from ovirt_imageio.auth import Ticket
+from ovirt_imageio.auth import Authorizer, Ticket
+from ovirt_imageio.backends import image
 
 from test import testutil
 
@@ -28,10 +31,14 @@ class Operation(object):
     Used to fake a ops.Operation object.
     """
 
-    def __init__(self, offset=0, size=0):
+    def __init__(self, offset=0, size=0, modifies_image=False):
         self.offset = offset
         self.size = size
         self.done = 0
+        self.modifies_image = modifies_image
+
+    def done_ranges(self):
+        return [(self.offset, self.offset + self.done)]
 
     def run(self):
         self.done = self.size
@@ -332,3 +339,215 @@ def test_ticket_run():
 
     assert ticket.transferred() == op.done
     assert op.done == 100
+
+
+class FakeBackend(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def extents(self, context="zero"):
+        self.calls += 1
+        return [image.ZeroExtent(0, 100, context == "zero")]
+
+
+def test_extents_cached():
+    ticket = Ticket(testutil.create_ticket(ops=["read"]))
+    backend = FakeBackend()
+
+    load = functools.partial(backend.extents, "zero")
+    extents = ticket.extents("zero", load)
+    assert extents == [image.ZeroExtent(0, 100, True)]
+    assert backend.calls == 1
+
+    # Extents are cached, and cached per context.
+    assert ticket.extents("zero", load) == extents
+    assert backend.calls == 1
+
+    ticket.extents("dirty", functools.partial(backend.extents, "dirty"))
+    assert backend.calls == 2
+
+
+def test_cached_extents():
+    ticket = Ticket(testutil.create_ticket(ops=["read"]))
+    assert ticket.cached_extents("zero") is None
+
+    backend = FakeBackend()
+    load = functools.partial(backend.extents, "zero")
+    extents = ticket.extents("zero", load)
+    assert ticket.cached_extents("zero") == extents
+    assert ticket.cached_extents("dirty") is None
+
+
+def test_extents_not_cached():
+    ticket = Ticket(testutil.create_ticket(ops=["read"]), cache_extents=False)
+    backend = FakeBackend()
+
+    load = functools.partial(backend.extents, "zero")
+    for i in range(2):
+        assert ticket.extents("zero", load) == [image.ZeroExtent(0, 100, True)]
+    assert backend.calls == 2
+
+
+def test_extents_invalidated_by_modifying_operation():
+    ticket = Ticket(testutil.create_ticket(ops=["write"]))
+    backend = FakeBackend()
+    load = functools.partial(backend.extents, "zero")
+    ticket.extents("zero", load)
+
+    # Reading does not modify the image.
+    ticket.run(Operation(0, 100))
+    ticket.extents("zero", load)
+    assert backend.calls == 1
+
+    ticket.run(Operation(0, 100, modifies_image=True))
+    ticket.extents("zero", load)
+    assert backend.calls == 2
+
+
+def test_extents_not_cached_if_modified_while_loading():
+    ticket = Ticket(testutil.create_ticket(ops=["write"]))
+    backend = FakeBackend()
+
+    def load():
+        # Simulate a write completing while loading extents.
+        ticket.run(Operation(0, 100, modifies_image=True))
+        return backend.extents("zero")
+
+    ticket.extents("zero", load)
+    ticket.extents("zero", functools.partial(backend.extents, "zero"))
+    assert backend.calls == 2
+
+
+def test_extents_load_error():
+    ticket = Ticket(testutil.create_ticket(ops=["read"]))
+
+    def load():
+        raise errors.UnsupportedOperation("no extents")
+
+    with pytest.raises(errors.UnsupportedOperation):
+        ticket.extents("dirty", load)
+
+    backend = FakeBackend()
+    ticket.extents("dirty", functools.partial(backend.extents, "dirty"))
+    assert backend.calls == 1
+
+
+class FakeStorage(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def read(self):
+        self.calls += 1
+        return b"x" * 100
+
+
+def test_cached_block():
+    ticket = Ticket(testutil.create_ticket(ops=["read"]),
+                    cache=cache.Cache(1024))
+    storage = FakeStorage()
+
+    assert ticket.cached_block(0, storage.read) == b"x" * 100
+    assert storage.calls == 1
+
+    # Blocks are cached, and cached per offset.
+    assert ticket.cached_block(0, storage.read) == b"x" * 100
+    assert storage.calls == 1
+
+    ticket.cached_block(100, storage.read)
+    assert storage.calls == 2
+
+
+def test_cached_block_invalidated_by_modifying_operation():
+    ticket = Ticket(testutil.create_ticket(ops=["write"]),
+                    cache=cache.Cache(1024))
+    storage = FakeStorage()
+    ticket.cached_block(0, storage.read)
+
+    # Reading does not modify the image.
+    ticket.run(Operation(0, 100))
+    ticket.cached_block(0, storage.read)
+    assert storage.calls == 1
+
+    ticket.run(Operation(0, 100, modifies_image=True))
+    assert ticket.cache.size == 0
+    ticket.cached_block(0, storage.read)
+    assert storage.calls == 2
+
+
+def test_cached_block_not_cached_if_modified_while_loading():
+    ticket = Ticket(testutil.create_ticket(ops=["write"]),
+                    cache=cache.Cache(1024))
+    storage = FakeStorage()
+
+    def load():
+        # Simulate a write completing while loading the block.
+        ticket.run(Operation(0, 100, modifies_image=True))
+        return storage.read()
+
+    ticket.cached_block(0, load)
+    ticket.cached_block(0, storage.read)
+    assert storage.calls == 2
+
+
+def test_authorizer_cache_disabled():
+    auth = Authorizer()
+    ticket_dict = testutil.create_ticket()
+    auth.add(ticket_dict)
+    assert auth.get(ticket_dict["uuid"]).cache is None
+
+
+def test_authorizer_remove_discards_cached_blocks():
+    auth = Authorizer(cache_size=1024)
+    ticket_dict = testutil.create_ticket()
+    auth.add(ticket_dict)
+    ticket = auth.get(ticket_dict["uuid"])
+    ticket.cached_block(0, FakeStorage().read)
+    assert ticket.cache.size == 100
+
+    auth.remove(ticket_dict["uuid"])
+    assert ticket.cache.size == 0
+
+
+def test_authorizer_add_discards_replaced_ticket_blocks():
+    auth = Authorizer(cache_size=1024)
+    ticket_dict = testutil.create_ticket()
+    auth.add(ticket_dict)
+    old = auth.get(ticket_dict["uuid"])
+    old.cached_block(0, FakeStorage().read)
+
+    # Adding a ticket with the same id must not use the old ticket blocks.
+    auth.add(ticket_dict)
+    new = auth.get(ticket_dict["uuid"])
+    assert new.cache is old.cache
+    assert new.cache.size == 0
+    storage = FakeStorage()
+    new.cached_block(0, storage.read)
+    assert storage.calls == 1
+
+
+def test_write_buffer_unset():
+    ticket = Ticket(testutil.create_ticket())
+    assert ticket.write_buffer is None
+
+
+def test_write_buffer():
+    ticket = Ticket(testutil.create_ticket(), write_buffer_size=1024**2)
+    assert ticket.write_buffer.max_size == 1024**2
+
+
+@pytest.mark.parametrize("kw", [
+    {"ops": ["read"]},
+    {"url": "nbd:unix:/run/vdsm/nbd/sock"},
+])
+def test_write_buffer_not_used(kw):
+    ticket = Ticket(testutil.create_ticket(**kw), write_buffer_size=1024**2)
+    assert ticket.write_buffer is None
+
+
+def test_authorizer_write_buffer():
+    auth = Authorizer(write_buffer_size=1024**2)
+    ticket_dict = testutil.create_ticket()
+    auth.add(ticket_dict)
+    assert auth.get(ticket_dict["uuid"]).write_buffer.max_size == 1024**2
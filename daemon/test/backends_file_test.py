@@ -84,6 +84,27 @@ def test_open_read_write(user_file):
         assert f.read() == b"b" * user_file.sector_size
 
 
+def test_clone(user_file):
+    size = user_file.sector_size
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"a" * size * 2)
+    with file.open(user_file.url, "r+") as f, \
+            closing(util.aligned_buffer(size)) as buf:
+        f.seek(size)
+        with f.clone() as c:
+            # Clone uses the same file, with its own position.
+            assert c.writable()
+            assert c.tell() == 0
+            buf[:] = b"b" * size
+            c.write(buf)
+            c.flush()
+
+        assert f.tell() == size
+        f.seek(0)
+        f.readinto(buf)
+        assert buf[:] == b"b" * size
+
+
 @pytest.mark.parametrize("mode", ["r", "r+"])
 def test_open_no_create(mode):
     with pytest.raises(OSError) as e:
@@ -385,6 +406,156 @@ def test_flush(user_file, monkeypatch):
     assert count[0] == 1
 
 
+def test_write_buffer_coalesce(user_file):
+    size = user_file.sector_size * 2
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * size)
+
+    buf = file.WriteBuffer(1024**2)
+
+    # Write small chunks into the second block.
+    with file.open(user_file.url, "r+", write_buffer=buf) as f:
+        f.seek(user_file.sector_size + 10)
+        for i in range(10):
+            assert f.write(b"y" * 10) == 10
+        assert buf.pending == 1
+
+        # The file was not modified yet.
+        with io.open(user_file.path, "rb") as r:
+            assert r.read() == b"x" * size
+
+    # Closing the backend writes pending blocks.
+    assert buf.pending == 0
+
+    with io.open(user_file.path, "rb") as f:
+        assert f.read(user_file.sector_size + 10) == (
+            b"x" * (user_file.sector_size + 10))
+        assert f.read(100) == b"y" * 100
+        assert f.read() == b"x" * (user_file.sector_size - 110)
+
+
+def test_write_buffer_complete_block(user_file):
+    size = user_file.sector_size
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * size)
+
+    buf = file.WriteBuffer(1024**2)
+
+    with file.open(user_file.url, "r+", write_buffer=buf) as f:
+        for i in range(0, size, 100):
+            f.write(b"y" * min(100, size - i))
+        assert buf.pending == 1
+
+    with io.open(user_file.path, "rb") as f:
+        assert f.read() == b"y" * size
+
+
+def test_write_buffer_after_end(user_file):
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * user_file.sector_size)
+
+    buf = file.WriteBuffer(1024**2)
+
+    with file.open(user_file.url, "r+", write_buffer=buf) as f:
+        f.seek(user_file.sector_size + 10)
+        f.write(b"y" * 10)
+
+        # size() writes pending blocks, extending the file.
+        assert f.size() == user_file.sector_size * 2
+        assert buf.pending == 0
+
+    with io.open(user_file.path, "rb") as f:
+        assert f.read(user_file.sector_size) == b"x" * user_file.sector_size
+        assert f.read(10) == b"\0" * 10
+        assert f.read(10) == b"y" * 10
+        assert f.read() == b"\0" * (user_file.sector_size - 20)
+
+
+def test_write_buffer_read_from_clone(user_file):
+    size = user_file.sector_size
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * size)
+
+    buf = file.WriteBuffer(1024**2)
+
+    with file.open(user_file.url, "r+", write_buffer=buf) as f, \
+            closing(f.clone()) as c, \
+            closing(util.aligned_buffer(size)) as data:
+        f.write(b"y" * 10)
+        assert buf.pending == 1
+
+        # Reading from another backend sharing the buffer must see the
+        # pending data.
+        c.readinto(data)
+        assert data[:] == b"y" * 10 + b"x" * (size - 10)
+        assert buf.pending == 0
+
+
+def test_write_buffer_full(user_file):
+    size = user_file.sector_size * 3
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * size)
+
+    buf = file.WriteBuffer(user_file.sector_size * 2)
+
+    with file.open(user_file.url, "r+", write_buffer=buf) as f:
+        for i in range(3):
+            f.seek(i * user_file.sector_size)
+            f.write(b"y" * 10)
+        # Adding the third block wrote the first two.
+        assert buf.pending == 1
+
+
+def test_write_buffer_write_after(user_file, fake_time):
+    size = user_file.sector_size * 2
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * size)
+
+    buf = file.WriteBuffer(1024**2, write_after=1.0)
+
+    with file.open(user_file.url, "r+", write_buffer=buf) as f:
+        f.write(b"y" * 10)
+        assert buf.pending == 1
+
+        # Without writes, pending blocks are kept.
+        fake_time.now += 2.0
+        assert buf.pending == 1
+
+        # Writing after write_after seconds writes the old pending blocks.
+        f.seek(user_file.sector_size)
+        f.write(b"y" * 10)
+        assert buf.pending == 1
+
+        with io.open(user_file.path, "rb") as r:
+            assert r.read(10) == b"y" * 10
+
+
+def test_write_buffer_flush(user_file, monkeypatch):
+    calls = []
+
+    def fsync(fd):
+        calls.append(buf.pending)
+
+    monkeypatch.setattr(os, "fsync", fsync)
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * user_file.sector_size)
+
+    buf = file.WriteBuffer(1024**2)
+
+    with file.open(user_file.url, "r+", write_buffer=buf) as f:
+        f.write(b"y" * 10)
+        f.flush()
+
+    # Pending blocks were written before syncing.
+    assert calls == [0]
+
+
 ZERO_SPARSE = [
     pytest.param(True, id="sparse"),
     pytest.param(False, id="preallocted"),
@@ -617,9 +788,90 @@ def test_extents(user_file):
         f.truncate(size)
 
     with file.open(user_file.url, "r+", sparse=True) as f:
-        # We support detecting extents now; empty file reports one data
-        # extents.
-        assert list(f.extents()) == [image.ZeroExtent(0, size, False)]
+        # Empty file reports one zero extent.
+        assert list(f.extents()) == [image.ZeroExtent(0, size, True)]
+
+
+def test_extents_data(user_file):
+    size = 1024**2
+
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(3 * size)
+        f.seek(size)
+        f.write(b"x" * size)
+
+    with file.open(user_file.url, "r") as f:
+        f.seek(100)
+        assert list(f.extents()) == [
+            image.ZeroExtent(0, size, True),
+            image.ZeroExtent(size, size, False),
+            image.ZeroExtent(2 * size, size, True),
+        ]
+        # Detecting extents does not change the position.
+        assert f.tell() == 100
+
+
+def test_extents_range(user_file):
+    size = 1024**2
+
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(3 * size)
+        f.seek(size)
+        f.write(b"x" * size)
+
+    with file.open(user_file.url, "r") as f:
+        # Extents are clipped to the requested range.
+        assert list(f.extents(start=size // 2, length=size)) == [
+            image.ZeroExtent(size // 2, size // 2, True),
+            image.ZeroExtent(size, size // 2, False),
+        ]
+        # And to the end of the file.
+        assert list(f.extents(start=2 * size, length=2 * size)) == [
+            image.ZeroExtent(2 * size, size, True),
+        ]
+
+
+def test_extents_limit(user_file, monkeypatch):
+    size = 1024**2
+    monkeypatch.setattr(file, "MAX_EXTENTS", 3)
+
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(5 * size)
+        for i in (1, 3):
+            f.seek(i * size)
+            f.write(b"x" * size)
+
+    with file.open(user_file.url, "r") as f:
+        # The rest of the file is reported as data.
+        assert list(f.extents()) == [
+            image.ZeroExtent(0, size, True),
+            image.ZeroExtent(size, 4 * size, False),
+        ]
+
+
+def test_extents_batch(user_file, monkeypatch):
+    size = 1024**2
+    monkeypatch.setattr(file, "EXTENTS_BATCH", 2)
+
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(5 * size)
+        for i in (1, 3):
+            f.seek(i * size)
+            f.write(b"x" * size)
+
+    with file.open(user_file.url, "r") as f:
+        f.seek(100)
+        extents = f.extents()
+        # Detecting the first batch does not change the position.
+        assert next(extents) == image.ZeroExtent(0, size, True)
+        assert f.tell() == 100
+
+        assert list(extents) == [
+            image.ZeroExtent(size, size, False),
+            image.ZeroExtent(2 * size, size, True),
+            image.ZeroExtent(3 * size, size, False),
+            image.ZeroExtent(4 * size, size, True),
+        ]
 
 
 def test_extents_dirty(user_file):
@@ -15,6 +15,7 @@ import logging
 from six.moves.urllib_parse import urlparse
 import pytest
 
+from ovirt_imageio import compression
 from ovirt_imageio import http
 from ovirt_imageio import ssl
 from ovirt_imageio import uhttp
@@ -22,7 +23,8 @@ from ovirt_imageio import util
 from ovirt_imageio import errors
 
 from ovirt_imageio.backends import image
-from ovirt_imageio.backends.http import Backend
+from ovirt_imageio.backends import http as http_backend
+from ovirt_imageio.backends.http import Backend, ConnectionPool
 
 from . marks import requires_python3
 
@@ -31,9 +33,12 @@ pytestmark = requires_python3
 log = logging.getLogger("test")
 
 
-@pytest.fixture(scope="module")
-def http_server(tmp_pki):
-    server = http.Server(("localhost", 0), http.Connection)
+@pytest.fixture(
+    scope="module",
+    params=[http.Server, http.AsyncServer],
+    ids=["threading", "async"])
+def http_server(request, tmp_pki):
+    server = request.param(("localhost", 0), http.Connection)
     log.info("Server listening on port %d", server.server_port)
 
     ctx = ssl.server_context(
@@ -83,6 +88,7 @@ class Handler(object):
         self.unix_socket = None
         self.dirty = False
         self.requests = 0
+        self.compressed = 0
 
         router = http.Router([("/(.*)", self)])
         http_server.app = router
@@ -112,8 +118,12 @@ class Handler(object):
             size = len(self.image)
             resp.status_code = http.OK
 
-        resp.headers["content-length"] = size
-        self._read(resp, offset, size)
+        encoding = req.headers.get("accept-encoding")
+        if encoding in self.features:
+            self._read_compressed(resp, offset, size, encoding)
+        else:
+            resp.headers["content-length"] = size
+            self._read(resp, offset, size)
 
     def put(self, req, resp, path=None):
         """
@@ -129,9 +139,31 @@ class Handler(object):
         with memoryview(self.image)[offset:offset + size] as view:
             resp.write(view)
 
+    def _read_compressed(self, resp, offset, size, encoding):
+        log.debug("READ offset=%s size=%s encoding=%s",
+                  offset, size, encoding)
+        self.compressed += 1
+        del resp.headers["content-length"]
+        resp.headers["content-encoding"] = encoding
+        resp.headers["transfer-encoding"] = "chunked"
+        body = http.ChunkedWriter(resp)
+        writer = compression.Writer(encoding, body)
+        with memoryview(self.image)[offset:offset + size] as view:
+            for i in range(0, size, 4096):
+                writer.write(view[i:i + 4096])
+        writer.close()
+        body.close()
+
     def _write(self, req, offset, size, flush):
-        log.debug("WRITE offset=%s size=%s flush=%s", offset, size, flush)
-        self.image[offset:offset + size] = req.read()
+        data = req.read()
+        encoding = req.headers.get("content-encoding")
+        if encoding:
+            self.compressed += 1
+            size = req.content_range.last - offset + 1
+            data = compression.decompress(encoding, data, size)
+        log.debug("WRITE offset=%s size=%s flush=%s encoding=%s",
+                  offset, size, flush, encoding)
+        self.image[offset:offset + size] = data
         self.dirty = not flush
 
 
@@ -157,7 +189,9 @@ class Daemon(Handler):
     and recently /extents resource.
     """
 
-    def __init__(self, http_server, uhttp_server=None, extents=True):
+    def __init__(self, http_server, uhttp_server=None, extents=True,
+                 extents_range=False, extents_binary=False, encodings=(),
+                 batch=False):
         super().__init__(http_server, uhttp_server)
 
         # zero and flush support was introduce with OPTIONS, so we always
@@ -165,6 +199,20 @@ class Daemon(Handler):
         self.features = ["zero", "flush"]
         if extents:
             self.features.append("extents")
+        if extents_range:
+            self.features.append("extents_range")
+        if extents_binary:
+            self.features.append("extents_binary")
+        if batch:
+            self.features.append("batch")
+        self.features.extend(encodings)
+
+        # Number of batched PATCH requests.
+        self.batches = 0
+
+        # Maximum number of extents returned when the client specifies a
+        # range.
+        self.max_extents = 1
 
         # Extents support was added later. It works only with NBD backend, and
         # emulated otherwise by reporting single non-zero extent.
@@ -192,7 +240,10 @@ class Daemon(Handler):
         if path == "/extents":
             self.requests += 1
             context = req.query.get("context", "zero")
-            self._extents(resp, context)
+            start = req.query.get("start")
+            binary = (req.headers.get("accept") ==
+                      "application/octet-stream")
+            self._extents(resp, context, start, binary)
         else:
             super().get(req, resp, path)
 
@@ -208,10 +259,20 @@ class Daemon(Handler):
 
     def patch(self, req, resp, path=None):
         """
-        Implement PATCH/zero and PATCH/flush.
+        Implement PATCH/zero, PATCH/flush, and batched PATCH.
         """
         self.requests += 1
         msg = json.loads(req.read())
+        if isinstance(msg, list):
+            if "batch" not in self.features:
+                raise http.Error(http.BAD_REQUEST, "No batch for you!")
+            self.batches += 1
+            for item in msg:
+                self._run(item)
+        else:
+            self._run(msg)
+
+    def _run(self, msg):
         if msg["op"] == "zero":
             self._zero(msg)
         elif msg["op"] == "flush":
@@ -219,15 +280,33 @@ class Daemon(Handler):
         else:
             raise http.Error(http.BAD_REQUEST, "Invalid PATCH request")
 
-    def _extents(self, resp, context):
+    def _extents(self, resp, context, start=None, binary=False):
         # Older daemon considered "/extents" as part of the ticket id, and will
         # fail to authorize the request.
         if "extents" not in self.features:
             raise http.Error(http.FORBIDDEN, "No extents for you!")
         if context not in self.extents:
             raise http.Error(http.NOT_FOUND, "No dirty extents for you!")
-        log.debug("EXTENTS context=%s", context)
-        resp.send_json(self.extents[context])
+        log.debug("EXTENTS context=%s start=%s", context, start)
+        extents = self.extents[context]
+        if start is not None and "extents_range" in self.features:
+            start = int(start)
+            extents = [e for e in extents if e["start"] >= start]
+            if len(extents) > self.max_extents:
+                extents = extents[:self.max_extents]
+                last = extents[-1]
+                resp.headers["x-next-start"] = last["start"] + last["length"]
+        if binary and "extents_binary" in self.features:
+            cls = image.ZeroExtent if context == "zero" else image.DirtyExtent
+            body = image.ExtentList(
+                context,
+                (cls(e["start"], e["length"], e[context]) for e in extents)
+            ).to_bytes()
+            resp.headers["content-length"] = len(body)
+            resp.headers["content-type"] = "application/octet-stream"
+            resp.write(body)
+        else:
+            resp.send_json(extents)
 
     def _zero(self, msg):
         offset = msg["offset"]
@@ -475,6 +554,54 @@ def test_daemon_extents_dirty(http_server, uhttp_server):
         ]
 
 
+def test_daemon_extents_range(http_server):
+    handler = Daemon(http_server, extents_range=True)
+
+    chunk_size = len(handler.image) // 4
+    handler.extents["zero"] = [
+        {"start": i * chunk_size, "length": chunk_size, "zero": bool(i % 2)}
+        for i in range(4)
+    ]
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        handler.requests = 0
+
+        # Extents are fetched one chunk at a time, until the end of the
+        # image.
+        assert list(b.extents()) == [
+            image.ZeroExtent(i * chunk_size, chunk_size, bool(i % 2))
+            for i in range(4)
+        ]
+        assert handler.requests == 4
+
+        # And not cached by the client.
+        list(b.extents())
+        assert handler.requests == 8
+
+        assert b.size() == len(handler.image)
+
+
+@pytest.mark.parametrize("extents_range", [True, False])
+@pytest.mark.parametrize("context", ["zero", "dirty"])
+def test_daemon_extents_binary(http_server, extents_range, context):
+    handler = Daemon(
+        http_server, extents_range=extents_range, extents_binary=True)
+
+    chunk_size = len(handler.image) // 4
+    handler.extents[context] = [
+        {"start": i * chunk_size, "length": chunk_size, context: bool(i % 2)}
+        for i in range(4)
+    ]
+
+    cls = image.ZeroExtent if context == "zero" else image.DirtyExtent
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        assert list(b.extents(context)) == [
+            cls(i * chunk_size, chunk_size, bool(i % 2))
+            for i in range(4)
+        ]
+
+
 def test_daemon_readinto(http_server, uhttp_server):
     handler = Daemon(http_server, uhttp_server)
     with Backend(http_server.url, http_server.cafile) as b:
@@ -514,8 +641,256 @@ def test_daemon_write_to(http_server, uhttp_server):
         check_write_to(handler, b)
 
 
+# Daemon with compression tests
+
+def test_daemon_compression_open(http_server):
+    Daemon(http_server, encodings=["gzip"])
+    with Backend(http_server.url, http_server.cafile, encoding="gzip") as b:
+        assert b.encoding == "gzip"
+        with b.clone() as c:
+            assert c.encoding == "gzip"
+
+
+def test_daemon_compression_not_supported(http_server):
+    Daemon(http_server)
+    with Backend(http_server.url, http_server.cafile, encoding="gzip") as b:
+        assert b.encoding is None
+
+
+def test_daemon_compression_unix_socket(http_server, uhttp_server):
+    Daemon(http_server, uhttp_server, encodings=["gzip"])
+    with Backend(http_server.url, http_server.cafile, encoding="gzip") as b:
+        assert b.server_address == uhttp_server.server_address
+        assert b.encoding is None
+
+
+def test_daemon_compression_invalid_encoding(http_server):
+    Daemon(http_server, encodings=["gzip"])
+    with pytest.raises(ValueError):
+        Backend(http_server.url, http_server.cafile, encoding="invalid")
+
+
+def test_daemon_compression_readinto(http_server):
+    handler = Daemon(http_server, encodings=["gzip"])
+    with Backend(http_server.url, http_server.cafile, encoding="gzip") as b:
+        check_readinto(handler, b)
+    assert handler.compressed == 1
+
+
+def test_daemon_compression_write(http_server):
+    handler = Daemon(http_server, encodings=["gzip"])
+    with Backend(http_server.url, http_server.cafile, encoding="gzip") as b:
+        check_write(handler, b)
+    assert handler.compressed == 1
+
+
+def test_daemon_compression_read_from(http_server):
+    handler = Daemon(http_server, encodings=["gzip"])
+    with Backend(http_server.url, http_server.cafile, encoding="gzip") as b:
+        check_compressed_read_from(handler, b)
+
+
+def test_daemon_compression_write_to(http_server):
+    handler = Daemon(http_server, encodings=["gzip"])
+    with Backend(http_server.url, http_server.cafile, encoding="gzip") as b:
+        check_compressed_write_to(handler, b)
+
+
+# Daemon with batch tests
+
+def test_daemon_batch_flush(http_server):
+    handler = Daemon(http_server, batch=True)
+    handler.image[:] = b"x" * len(handler.image)
+    with Backend(http_server.url, http_server.cafile) as b:
+        requests = handler.requests
+        for offset in range(0, 256 * 1024, 128 * 1024):
+            b.seek(offset)
+            b.zero(4096)
+        assert b.tell() == offset + 4096
+
+        # Zero requests are queued.
+        assert handler.requests == requests
+        assert handler.image[offset:offset + 4096] == b"x" * 4096
+
+        # And sent with the flush in a single request.
+        b.flush()
+        assert handler.requests == requests + 1
+        assert handler.batches == 1
+        assert not handler.dirty
+        for offset in range(0, 256 * 1024, 128 * 1024):
+            assert handler.image[offset:offset + 4096] == b"\0" * 4096
+
+
+def test_daemon_batch_max(http_server):
+    handler = Daemon(http_server, batch=True)
+    handler.image[:] = b"x" * len(handler.image)
+    with Backend(http_server.url, http_server.cafile) as b:
+        for i in range(http_backend.MAX_BATCH):
+            b.zero(512)
+        assert handler.batches == 1
+        assert handler.image[:512 * http_backend.MAX_BATCH] == (
+            b"\0" * 512 * http_backend.MAX_BATCH)
+
+
+@pytest.mark.parametrize("send_request", [
+    pytest.param(lambda b: b.readinto(bytearray(4096)), id="readinto"),
+    pytest.param(lambda b: b.write(b"x" * 4096), id="write"),
+    pytest.param(lambda b: b.close(), id="close"),
+])
+def test_daemon_batch_send_before_request(http_server, send_request):
+    handler = Daemon(http_server, batch=True)
+    handler.image[:] = b"x" * len(handler.image)
+    with Backend(http_server.url, http_server.cafile) as b:
+        b.seek(64 * 1024)
+        b.zero(4096)
+        b.seek(0)
+        send_request(b)
+        assert handler.image[64 * 1024:68 * 1024] == b"\0" * 4096
+
+
+def test_daemon_batch_single_zero(http_server):
+    handler = Daemon(http_server, batch=True)
+    with Backend(http_server.url, http_server.cafile) as b:
+        b.zero(4096)
+        b.flush()
+        # The flush is sent with the zero request.
+        assert handler.batches == 1
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        b.zero(4096)
+
+    # A single zero request is sent without batching.
+    assert handler.batches == 1
+
+
 # Common flows - must works for all variants.
 
+def test_daemon_pool_reuse(http_server):
+    handler = Daemon(http_server)
+    pool = ConnectionPool(http_server.url, http_server.cafile)
+
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        con = b._con
+        check_readinto(handler, b)
+
+    handler.requests = 0
+
+    # Connection and options are reused.
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert b._con is con
+        check_write(handler, b)
+
+    assert handler.requests == 1
+    pool.close()
+
+
+def test_daemon_pool_parallel(http_server):
+    handler = Daemon(http_server)
+    pool = ConnectionPool(http_server.url, http_server.cafile)
+
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b1, \
+            Backend(http_server.url, http_server.cafile, pool=pool) as b2:
+        # Every backend has its own connection.
+        assert b1._con is not b2._con
+        check_readinto(handler, b1)
+        check_readinto(handler, b2)
+
+    pool.close()
+
+
+def test_daemon_pool_shared(http_server):
+    handler = Daemon(http_server)
+    pool = ConnectionPool(http_server.url, http_server.cafile)
+    url1 = http_server.url._replace(path="/images/1")
+    url2 = http_server.url._replace(path="/images/2")
+
+    with Backend(url1, http_server.cafile, pool=pool) as b:
+        con = b._con
+        check_readinto(handler, b)
+
+    handler.requests = 0
+
+    # Backend for another image on the same server reuses the connection,
+    # sending OPTIONS for the new path.
+    with Backend(url2, http_server.cafile, pool=pool) as b:
+        assert b._con is con
+        assert handler.requests == 1
+        check_write(handler, b)
+
+    assert pool.options(url1.path) == pool.options(url2.path)
+    pool.close()
+
+
+def test_daemon_pool_netloc_mismatch(http_server):
+    Daemon(http_server)
+    pool = ConnectionPool(http_server.url, http_server.cafile)
+    url = http_server.url._replace(netloc="localhost:1")
+    with pytest.raises(ValueError):
+        Backend(url, http_server.cafile, pool=pool)
+    pool.close()
+
+
+def test_daemon_pool_clone(http_server):
+    handler = Daemon(http_server)
+
+    with Backend(http_server.url, http_server.cafile) as b:
+        handler.requests = 0
+        with b.clone() as c:
+            # Clone does not send OPTIONS.
+            assert handler.requests == 0
+            check_write(handler, c)
+        con = b._pool._idle[-1]
+
+        # The clone connection was returned to the pool.
+        with b.clone() as c:
+            assert c._con is con
+
+    # Closing the backend closed the private pool.
+    assert b._pool._idle == []
+
+
+def test_daemon_pool_drop_busy_connection(http_server):
+    Daemon(http_server)
+    pool = ConnectionPool(http_server.url, http_server.cafile)
+
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        con = b._con
+        # Simulate a request aborted before reading the response.
+        con.request("GET", http_server.url.path)
+        assert not con.reusable()
+
+    # The connection was not returned to the pool.
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b:
+        assert b._con is not con
+
+    pool.close()
+
+
+def test_daemon_pool_session_resumption(http_server):
+    handler = Daemon(http_server)
+    pool = ConnectionPool(http_server.url, http_server.cafile)
+
+    with Backend(http_server.url, http_server.cafile, pool=pool) as b1:
+        check_readinto(handler, b1)
+        # New connection resumes the session of the first connection.
+        with Backend(http_server.url, http_server.cafile, pool=pool) as b2:
+            assert b2._con.sock.session_reused
+            check_readinto(handler, b2)
+
+    assert pool.session_cache.hits == 1
+    assert pool.session_cache.misses == 1
+    assert pool.session_cache.hit_rate == 0.5
+    pool.close()
+
+
+def test_daemon_pool_closed(http_server):
+    Daemon(http_server)
+    pool = ConnectionPool(http_server.url, http_server.cafile)
+    pool.close()
+    with pytest.raises(RuntimeError):
+        pool.get()
+
+
 def check_readinto(handler, backend):
     """
     Check single readinto opertion.
@@ -598,3 +973,41 @@ def check_write_to(handler, backend):
     assert handler.requests == 1
     assert backend.tell() == offset + length
     assert writer.getvalue() == handler.image[offset:offset + length]
+
+
+def check_compressed_read_from(handler, backend):
+    """
+    Check that we can stream data using compressed request per buffer.
+    """
+    offset = 8192
+    length = 600000
+    reader = io.BytesIO(b"x" * length)
+    buf = bytearray(128 * 1024)
+    handler.requests = 0
+
+    backend.seek(offset)
+    backend.read_from(reader, length, buf)
+
+    assert handler.requests == 5
+    assert handler.compressed == 5
+    assert backend.tell() == offset + length
+    assert handler.image[offset:offset + length] == reader.getvalue()
+
+
+def check_compressed_write_to(handler, backend):
+    """
+    Check that we can stream data using compressed response per buffer.
+    """
+    offset = 8192
+    length = 600000
+    writer = io.BytesIO()
+    buf = bytearray(128 * 1024)
+    handler.requests = 0
+
+    backend.seek(offset)
+    backend.write_to(writer, length, buf)
+
+    assert handler.requests == 5
+    assert handler.compressed == 5
+    assert backend.tell() == offset + length
+    assert writer.getvalue() == handler.image[offset:offset + length]
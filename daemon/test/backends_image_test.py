@@ -0,0 +1,88 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from __future__ import absolute_import
+
+import pytest
+
+from ovirt_imageio.backends import image
+
+ZERO_EXTENTS = [
+    image.ZeroExtent(0, 4096, False),
+    image.ZeroExtent(4096, 2**40, True),
+    image.ZeroExtent(2**40 + 4096, 2**63, False),
+]
+
+DIRTY_EXTENTS = [
+    image.DirtyExtent(0, 4096, True),
+    image.DirtyExtent(4096, 8192, False),
+]
+
+
+@pytest.mark.parametrize("context,extents", [
+    ("zero", ZERO_EXTENTS),
+    ("dirty", DIRTY_EXTENTS),
+])
+def test_extent_list(context, extents):
+    el = image.ExtentList(context, extents)
+    assert el.context == context
+    assert len(el) == len(extents)
+    assert list(el) == extents
+    assert el[0] == extents[0]
+    assert el[-1] == extents[-1]
+    assert list(el[1:]) == extents[1:]
+
+
+def test_extent_list_append():
+    el = image.ExtentList("zero")
+    assert len(el) == 0
+    assert list(el) == []
+
+    for ext in ZERO_EXTENTS:
+        el.append(ext)
+
+    assert list(el) == ZERO_EXTENTS
+
+
+def test_extent_list_invalid_context():
+    with pytest.raises(ValueError):
+        image.ExtentList("invalid")
+
+
+@pytest.mark.parametrize("context,extents", [
+    ("zero", ZERO_EXTENTS),
+    ("dirty", DIRTY_EXTENTS),
+    ("zero", []),
+])
+def test_extent_list_bytes(context, extents):
+    data = image.ExtentList(context, extents).to_bytes()
+    assert len(data) == 8 + 17 * len(extents)
+
+    el = image.ExtentList.from_bytes(context, data)
+    assert list(el) == extents
+
+
+def test_extent_list_bytes_format():
+    el = image.ExtentList("zero", [image.ZeroExtent(1, 2, True)])
+    assert el.to_bytes() == (
+        b"\0\0\0\0\0\0\0\x01"
+        b"\0\0\0\0\0\0\0\x01"
+        b"\0\0\0\0\0\0\0\x02"
+        b"\x01"
+    )
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\0\0\0\0",
+    b"\0\0\0\0\0\0\0\x01",
+    b"\0\0\0\0\0\0\0\x00\x00",
+])
+def test_extent_list_bytes_invalid(data):
+    with pytest.raises(ValueError):
+        image.ExtentList.from_bytes("zero", data)
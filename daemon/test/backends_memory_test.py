@@ -136,6 +136,24 @@ def test_propagate_user_error():
             raise UserError("user error")
 
 
+def test_clone():
+    m = memory.Backend("r+", b"data")
+    m.seek(2)
+
+    with m.clone() as c:
+        # Clone shares the data, but has its own position.
+        assert c.tell() == 0
+        assert c.data() == b"data"
+        c.seek(4)
+        c.write(b"more")
+
+    # Closing the clone does not close the original backend.
+    assert m.tell() == 2
+    assert m.data() == b"datamore"
+    m.write(b"xx")
+    assert m.data() == b"daxxmore"
+
+
 def test_create_with_bytes():
     m = memory.Backend("r", b"data")
     assert m.readable()
@@ -169,6 +187,27 @@ def test_dirty():
     assert not m.dirty
 
 
+def test_dirty_clone():
+    m = memory.Backend("r+", b"data")
+
+    with m.clone() as c:
+        # Writing to a clone dirties the original backend.
+        c.write(b"01234")
+        assert m.dirty
+        assert c.dirty
+
+        # Flushing the original backend cleans the clone.
+        m.flush()
+        assert not m.dirty
+        assert not c.dirty
+
+        # Flushing a clone cleans the original backend.
+        m.zero(5)
+        assert c.dirty
+        c.flush()
+        assert not m.dirty
+
+
 def test_size():
     m = memory.Backend("r+", b"data")
     assert m.size() == 4
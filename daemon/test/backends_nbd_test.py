@@ -171,6 +171,26 @@ def test_context_manager(nbd_server):
         b.write("more")
 
 
+def test_clone(nbd_server):
+    nbd_server.shared = 2
+    nbd_server.start()
+    with nbd.open(nbd_server.url, "r+") as b:
+        b.seek(4096)
+        with b.clone() as c:
+            # Clone is connected to the same export, with its own position.
+            assert c.tell() == 0
+            assert c.size() == b.size()
+            c.write(b"data")
+            c.flush()
+
+        assert b.tell() == 4096
+
+        with closing(util.aligned_buffer(4)) as buf:
+            b.seek(0)
+            b.readinto(buf)
+            assert buf[:] == b"data"
+
+
 def test_dirty(nbd_server):
     nbd_server.start()
     with nbd.open(nbd_server.url, "r+") as b:
@@ -20,12 +20,14 @@ from . marks import requires_python3
 
 class Ticket(object):
 
-    def __init__(self, uuid, url, ops=("read",), sparse=False, dirty=False):
+    def __init__(self, uuid, url, ops=("read",), sparse=False, dirty=False,
+                 write_buffer=None):
         self.uuid = uuid
         self.url = url
         self.ops = ops
         self.sparse = sparse
         self.dirty = dirty
+        self.write_buffer = write_buffer
 
 
 class Request(object):
@@ -0,0 +1,183 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+"""
+Helpers for measuring data path throughput in benchmark tests.
+
+Benchmark results are collected during the test session, and can be saved
+as JSON and compared with results saved in a previous run:
+
+    # Save baseline results.
+    tox -e bench-py37 -- --bench-save=baseline.json
+
+    # Compare with the baseline, failing if a benchmark regressed by more
+    # than 10%.
+    tox -e bench-py37 -- --bench-compare=baseline.json --bench-threshold=10
+"""
+
+from __future__ import absolute_import
+
+import io
+import json
+import platform
+import resource
+import time
+
+GiB = 1024**3
+MiB = 1024**2
+
+
+class Result(object):
+
+    def __init__(self, name, size, elapsed, cpu):
+        self.name = name
+        self.size = size
+        self.elapsed = elapsed
+        self.cpu = cpu
+
+    @property
+    def throughput(self):
+        """
+        Throughput in MiB per second.
+        """
+        return self.size / self.elapsed / MiB
+
+    @property
+    def cpu_per_gib(self):
+        """
+        CPU time (user and system) in seconds per GiB.
+        """
+        return self.cpu / self.size * GiB
+
+    def to_dict(self):
+        return {
+            "size": self.size,
+            "elapsed": self.elapsed,
+            "cpu": self.cpu,
+            "throughput": self.throughput,
+            "cpu_per_gib": self.cpu_per_gib,
+        }
+
+    def __str__(self):
+        return ("{self.name}: {self.size} bytes in {self.elapsed:.3f} "
+                "seconds ({self.throughput:.2f} MiB/s, "
+                "{self.cpu_per_gib:.3f} cpu seconds/GiB)").format(self=self)
+
+
+class Results(object):
+    """
+    Results collected during a test session.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, size, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) transferring size bytes, and record the
+        wall and CPU time.
+        """
+        start_cpu = _cpu_time()
+        start = time.monotonic()
+
+        func(*args, **kwargs)
+
+        elapsed = time.monotonic() - start
+        cpu = _cpu_time() - start_cpu
+
+        result = Result(name, size, elapsed, cpu)
+        self.results.append(result)
+        print(result)
+        return result
+
+    def save(self, path):
+        data = {
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "time": int(time.time()),
+            "results": {r.name: r.to_dict() for r in self.results},
+        }
+        with io.open(path, "w") as f:
+            f.write(json.dumps(data, indent=4, sort_keys=True))
+
+
+def load(path):
+    with io.open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results with baseline results loaded from a file.
+
+    Return list of (name, metric, baseline, current, change) tuples, and list
+    of regressions, where throughput decreased or CPU usage increased by
+    more than threshold percent.
+    """
+    changes = []
+    regressions = []
+
+    for r in results:
+        if r.name not in baseline:
+            continue
+
+        base = baseline[r.name]
+
+        change = _percent(base["throughput"], r.throughput)
+        item = (r.name, "throughput", base["throughput"], r.throughput,
+                change)
+        changes.append(item)
+        if change < -threshold:
+            regressions.append(item)
+
+        change = _percent(base["cpu_per_gib"], r.cpu_per_gib)
+        item = (r.name, "cpu_per_gib", base["cpu_per_gib"], r.cpu_per_gib,
+                change)
+        changes.append(item)
+        if change > threshold:
+            regressions.append(item)
+
+    return changes, regressions
+
+
+def _percent(old, new):
+    if old == 0:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def _cpu_time():
+    # os.times() has only 10 milliseconds resolution.
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+class Reader(object):
+    """
+    File object returning size bytes of junk, simulating a client sending
+    data, without copying data.
+    """
+
+    def __init__(self, size):
+        self._todo = size
+
+    def readinto(self, buf):
+        n = min(len(buf), self._todo)
+        self._todo -= n
+        return n
+
+
+class Writer(object):
+    """
+    File object dropping written data, simulating a client receiving data.
+    """
+
+    def write(self, buf):
+        return len(buf)
+
+    def flush(self):
+        pass
@@ -0,0 +1,207 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from __future__ import absolute_import
+
+import io
+import os
+
+import pytest
+
+from ovirt_imageio import cache
+from ovirt_imageio import metrics
+from ovirt_imageio import ops
+from ovirt_imageio.auth import Ticket
+from ovirt_imageio.backends import memory
+
+from test import testutil
+
+BLOCK = b"x" * 100
+
+
+def test_cache_get_put():
+    c = cache.Cache(1024)
+    hits = metrics.CACHE_HITS.get()
+    misses = metrics.CACHE_MISSES.get()
+
+    assert c.get("a", 0) is None
+    c.put("a", 0, BLOCK)
+    assert c.get("a", 0) == BLOCK
+    assert c.get("a", 100) is None
+    assert c.get("b", 0) is None
+
+    assert len(c) == 1
+    assert c.size == len(BLOCK)
+    assert metrics.CACHE_HITS.get() == hits + 1
+    assert metrics.CACHE_MISSES.get() == misses + 3
+
+
+def test_cache_put_replace():
+    c = cache.Cache(1024)
+    c.put("a", 0, BLOCK)
+    c.put("a", 0, b"y" * 50)
+    assert c.get("a", 0) == b"y" * 50
+    assert len(c) == 1
+    assert c.size == 50
+
+
+def test_cache_evict_least_recently_used():
+    c = cache.Cache(300)
+    evictions = metrics.CACHE_EVICTIONS.get()
+
+    for offset in (0, 100, 200):
+        c.put("a", offset, BLOCK)
+
+    # Using block 0 makes block 100 the least recently used.
+    c.get("a", 0)
+    c.put("a", 300, BLOCK)
+
+    assert c.get("a", 100) is None
+    for offset in (0, 200, 300):
+        assert c.get("a", offset) == BLOCK
+
+    assert c.size == 300
+    assert metrics.CACHE_EVICTIONS.get() == evictions + 1
+
+
+def test_cache_put_too_large():
+    c = cache.Cache(99)
+    c.put("a", 0, BLOCK)
+    assert c.get("a", 0) is None
+    assert c.size == 0
+
+
+def test_cache_discard():
+    c = cache.Cache(1024)
+    c.put("a", 0, BLOCK)
+    c.put("a", 100, BLOCK)
+    c.put("b", 0, BLOCK)
+
+    c.discard("a")
+    assert c.get("a", 0) is None
+    assert c.get("a", 100) is None
+    assert c.get("b", 0) == BLOCK
+    assert c.size == len(BLOCK)
+
+    # Discarding owner without blocks does nothing.
+    c.discard("a")
+    assert c.size == len(BLOCK)
+
+
+def test_cache_discard_after_eviction():
+    c = cache.Cache(100)
+    c.put("a", 0, BLOCK)
+    c.put("b", 0, BLOCK)
+    c.discard("a")
+    c.discard("b")
+    assert len(c) == 0
+    assert c.size == 0
+
+
+def test_cache_clear():
+    c = cache.Cache(1024)
+    c.put("a", 0, BLOCK)
+    c.put("b", 0, BLOCK)
+    c.clear()
+    assert len(c) == 0
+    assert c.size == 0
+
+
+DATA = os.urandom(10 * 1024)
+
+
+@pytest.fixture
+def ticket():
+    return Ticket(testutil.create_ticket(), cache=cache.Cache(1024**2))
+
+
+class CountingBackend(memory.Backend):
+
+    def __init__(self, mode, data=None):
+        super(CountingBackend, self).__init__(mode, data)
+        self.reads = 0
+
+    def readinto(self, buf):
+        n = super(CountingBackend, self).readinto(buf)
+        if n:
+            self.reads += 1
+        return n
+
+
+@pytest.mark.parametrize("offset,size", [
+    (0, len(DATA)),
+    (0, 1000),
+    (1000, 3000),
+    (len(DATA) - 100, 100),
+])
+def test_backend_readinto(ticket, offset, size):
+    src = CountingBackend("r", DATA)
+    b = cache.Backend(src, ticket, block_size=4096)
+
+    for i in range(2):
+        buf = bytearray(size)
+        b.seek(offset)
+        assert b.readinto(buf) == size
+        assert buf == DATA[offset:offset + size]
+        assert b.tell() == offset + size
+
+    # The second read was served from the cache.
+    first = offset // 4096
+    last = (offset + size - 1) // 4096
+    assert src.reads == last - first + 1
+
+
+def test_backend_readinto_end_of_image(ticket):
+    src = CountingBackend("r", DATA)
+    b = cache.Backend(src, ticket, block_size=4096)
+
+    buf = bytearray(4096)
+    b.seek(len(DATA) - 100)
+    assert b.readinto(buf) == 100
+    assert buf[:100] == DATA[-100:]
+    assert b.tell() == len(DATA)
+
+    assert b.readinto(buf) == 0
+    assert b.tell() == len(DATA)
+
+
+def test_backend_send(ticket):
+    src = CountingBackend("r", DATA)
+    b = cache.Backend(src, ticket, block_size=4096)
+
+    for i in range(2):
+        dst = io.BytesIO()
+        op = ops.Send(b, dst, len(DATA) - 1000, offset=1000,
+                      buffersize=4096)
+        ticket.run(op)
+        assert dst.getvalue() == DATA[1000:]
+
+    assert src.reads == 3
+
+
+def test_backend_invalidated_by_write(ticket):
+    src = memory.Backend("r+", DATA)
+    b = cache.Backend(src, ticket, block_size=4096)
+
+    buf = bytearray(4096)
+    b.readinto(buf)
+    assert buf == DATA[:4096]
+
+    ticket.run(ops.Zero(src.clone(), 4096))
+
+    b.seek(0)
+    b.readinto(buf)
+    assert buf == b"\0" * 4096
+
+
+def test_backend_close(ticket):
+    src = memory.Backend("r", DATA)
+    b = cache.Backend(src, ticket)
+    b.readinto(bytearray(100))
+    b.close()
+    b.close()
@@ -12,9 +12,14 @@ import os
 
 import pytest
 
+from six.moves.urllib_parse import urlparse
+
 from ovirt_imageio import config
 from ovirt_imageio import client
+from ovirt_imageio import io
 from ovirt_imageio import server
+from ovirt_imageio.backends import http
+from ovirt_imageio.backends import memory
 
 from . import testutil
 
@@ -180,6 +185,20 @@ def test_upload_unix_socket(tmpdir, srv, use_unix_socket):
     check_content(src, dst)
 
 
+def test_upload_adaptive(tmpdir, srv):
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.write(os.urandom(IMAGE_SIZE))
+
+    dst = str(tmpdir.join("dst"))
+    url = prepare_upload(srv, dst)
+
+    client.upload(
+        src, url, srv.config.tls.ca_file, buffer_size=4096, adaptive=True)
+
+    check_content(src, dst)
+
+
 def test_progress(tmpdir, srv):
     src = str(tmpdir.join("src"))
     with open(src, "wb") as f:
@@ -223,3 +242,58 @@ def test_progress_callback(tmpdir, srv):
         progress=progress.append)
 
     assert progress == [IMAGE_SIZE]
+
+
+def test_upload_shared_pool(tmpdir, srv):
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        f.write(b"b" * IMAGE_SIZE)
+
+    dst1 = str(tmpdir.join("dst1"))
+    url1 = prepare_upload(srv, dst1)
+    dst2 = str(tmpdir.join("dst2"))
+    url2 = prepare_upload(srv, dst2)
+
+    pool = http.ConnectionPool(urlparse(url1), srv.config.tls.ca_file)
+    try:
+        client.upload(src, url1, srv.config.tls.ca_file, pool=pool)
+        con = pool._idle[-1]
+
+        # The second upload reuses the connections of the first upload.
+        client.upload(src, url2, srv.config.tls.ca_file, pool=pool)
+        assert con in pool._idle
+    finally:
+        pool.close()
+
+    check_content(src, dst1)
+    check_content(src, dst2)
+
+
+@pytest.mark.parametrize("max_extents", [1, 10000])
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_copy_from_http(tmpdir, srv, monkeypatch, max_extents, max_workers):
+    # Return the extents in several chunks if max_extents is small.
+    monkeypatch.setattr(srv.config.daemon, "max_extents", max_extents)
+
+    # Alternating data and holes, reported as multiple extents.
+    chunk_size = IMAGE_SIZE // 8
+    src = str(tmpdir.join("src"))
+    with open(src, "wb") as f:
+        for i in range(0, 8, 2):
+            f.seek(i * chunk_size)
+            f.write(os.urandom(chunk_size))
+        f.truncate(IMAGE_SIZE)
+
+    ticket = testutil.create_ticket(
+        url="file://" + src, ops=["read"], size=IMAGE_SIZE)
+    srv.auth.add(ticket)
+    url = urlparse("https://127.0.0.1:{}/images/{}".format(
+        srv.remote_service.port, ticket["uuid"]))
+
+    dst = memory.Backend("r+", b"x" * IMAGE_SIZE)
+
+    with http.open(url, "r", cafile=srv.config.tls.ca_file) as b:
+        io.copy(b, dst, max_workers=max_workers)
+
+    with open(src, "rb") as f:
+        assert dst.data() == f.read()
@@ -0,0 +1,150 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from __future__ import absolute_import
+
+import io
+import os
+
+import pytest
+
+from ovirt_imageio import compression
+from ovirt_imageio import errors
+
+ENCODINGS = [
+    "gzip",
+    pytest.param(
+        "zstd",
+        marks=pytest.mark.skipif(
+            compression.zstandard is None,
+            reason="zstandard not installed")),
+]
+
+DATA = os.urandom(64 * 1024) + b"\0" * 64 * 1024 + b"x" * 1000
+
+
+def test_encodings():
+    encodings = compression.encodings()
+    assert encodings[-1] == "gzip"
+    if compression.zstandard is not None:
+        assert encodings[0] == "zstd"
+
+
+@pytest.mark.parametrize("header,encoding", [
+    (None, None),
+    ("", None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("deflate, gzip", "gzip"),
+    ("GZIP", "gzip"),
+    ("gzip;q=0.5", "gzip"),
+    ("gzip;q=0", None),
+    ("gzip; q=0.0", None),
+    ("gzip;q=invalid", None),
+    ("br, deflate", None),
+])
+def test_negotiate(header, encoding):
+    assert compression.negotiate(header) == encoding
+
+
+@pytest.mark.skipif(
+    compression.zstandard is None, reason="zstandard not installed")
+def test_negotiate_prefer_zstd():
+    assert compression.negotiate("gzip, zstd") == "zstd"
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+@pytest.mark.parametrize(
+    "data", [b"", b"x", DATA], ids=["empty", "one", "mixed"])
+def test_compress_decompress(encoding, data):
+    compressed = compression.compress(encoding, data)
+    assert compression.decompress(encoding, compressed, len(data)) == data
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_decompress_truncated(encoding):
+    compressed = compression.compress(encoding, DATA)
+    with pytest.raises(errors.InvalidData):
+        compression.decompress(encoding, compressed[:-10], len(DATA))
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_decompress_too_much_data(encoding):
+    compressed = compression.compress(encoding, DATA)
+    with pytest.raises(errors.InvalidData):
+        compression.decompress(encoding, compressed, len(DATA) - 1)
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_decompress_invalid_data(encoding):
+    with pytest.raises(errors.InvalidData):
+        compression.decompress(encoding, b"invalid data", 100)
+
+
+def test_decompress_gzip_trailing_data():
+    compressed = compression.compress("gzip", DATA)
+    with pytest.raises(errors.InvalidData):
+        compression.decompress("gzip", compressed + b"x", len(DATA))
+
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError):
+        compression.compress("br", DATA)
+    with pytest.raises(ValueError):
+        compression.decompress("br", DATA, len(DATA))
+    with pytest.raises(ValueError):
+        compression.Reader("br", io.BytesIO())
+    with pytest.raises(ValueError):
+        compression.Writer("br", io.BytesIO())
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_reader(encoding):
+    src = io.BytesIO(compression.compress(encoding, DATA))
+    reader = compression.Reader(encoding, src)
+
+    buf = bytearray(len(DATA))
+    pos = 0
+    with memoryview(buf) as view:
+        while pos < len(buf):
+            n = reader.readinto(view[pos:pos + 4096])
+            assert n > 0
+            pos += n
+
+    assert buf == DATA
+    assert reader.read(1) == b""
+    assert src.tell() == len(src.getvalue())
+
+
+def test_reader_invalid_data():
+    reader = compression.Reader("gzip", io.BytesIO(b"invalid data"))
+    with pytest.raises(errors.InvalidData):
+        reader.readinto(bytearray(100))
+
+
+def test_reader_truncated():
+    compressed = compression.compress("gzip", DATA)
+    reader = compression.Reader("gzip", io.BytesIO(compressed[:-10]))
+    with pytest.raises(errors.InvalidData):
+        reader.read()
+
+
+@pytest.mark.parametrize("encoding", ENCODINGS)
+def test_writer(encoding):
+    dst = io.BytesIO()
+    writer = compression.Writer(encoding, dst)
+    for i in range(0, len(DATA), 4096):
+        with memoryview(DATA)[i:i + 4096] as view:
+            assert writer.write(view) == len(view)
+
+    writer.close()
+    assert not dst.closed
+
+    compressed = dst.getvalue()
+    assert len(compressed) < len(DATA)
+    assert compression.decompress(encoding, compressed, len(DATA)) == DATA
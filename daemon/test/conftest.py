@@ -9,6 +9,7 @@
 from __future__ import absolute_import
 
 import errno
+import functools
 import io
 import logging
 import os
@@ -24,6 +25,8 @@ from ovirt_imageio import nbd
 from ovirt_imageio import qemu_nbd
 from ovirt_imageio import util
 
+from . import benchmark
+
 
 log = logging.getLogger("test")
 
@@ -160,3 +163,83 @@ def fake_time(monkeypatch):
     time = FakeTime()
     monkeypatch.setattr(util, "monotonic_time", time.monotonic_time)
     return time
+
+
+# Benchmarks
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmark")
+    group.addoption(
+        "--bench-save",
+        metavar="PATH",
+        help="Save benchmark results as JSON to PATH.")
+    group.addoption(
+        "--bench-compare",
+        metavar="PATH",
+        help="Compare benchmark results with results saved in PATH.")
+    group.addoption(
+        "--bench-threshold",
+        metavar="PERCENT",
+        type=float,
+        default=10.0,
+        help="Fail if a benchmark regressed by more than PERCENT compared "
+             "with --bench-compare results (default 10).")
+
+
+def pytest_configure(config):
+    config._bench_results = benchmark.Results()
+    config._bench_regressions = []
+
+
+@pytest.fixture
+def bench(request):
+    """
+    Return a function running a benchmark transferring size bytes, and
+    recording the result using the test id:
+
+        bench(size, func, *args, **kwargs)
+    """
+    results = request.config._bench_results
+    return functools.partial(results.run, request.node.nodeid)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    config = session.config
+    results = config._bench_results.results
+    if not results:
+        return
+
+    path = config.getoption("bench_save")
+    if path:
+        config._bench_results.save(path)
+
+    path = config.getoption("bench_compare")
+    if path:
+        baseline = benchmark.load(path)
+        threshold = config.getoption("bench_threshold")
+        changes, regressions = benchmark.compare(
+            results, baseline, threshold)
+        config._bench_changes = changes
+        config._bench_regressions = regressions
+        if regressions:
+            session.exitstatus = pytest.ExitCode.TESTS_FAILED
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    changes = getattr(config, "_bench_changes", None)
+    if not changes:
+        return
+
+    tr = terminalreporter
+    tr.section("benchmark comparison")
+    for name, metric, old, new, change in changes:
+        tr.write_line("{:<60} {:<12} {:>10.2f} {:>10.2f} {:>+8.1f}%".format(
+            name, metric, old, new, change))
+
+    regressions = config._bench_regressions
+    if regressions:
+        tr.section("benchmark regressions", red=True)
+        for name, metric, old, new, change in regressions:
+            tr.write_line("{} {}: {:.2f} -> {:.2f} ({:+.1f}%)".format(
+                name, metric, old, new, change), red=True)
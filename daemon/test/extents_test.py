@@ -17,6 +17,7 @@ import pytest
 
 from ovirt_imageio import config
 from ovirt_imageio import server
+from ovirt_imageio.backends import image
 
 from . import testutil
 from . import http
@@ -111,7 +112,162 @@ def test_file_zero(srv, client, user_file, fmt, path):
     assert res.status == 200
 
     extents = json.loads(data.decode("utf-8"))
-    assert extents == [{"start": 0, "length": size, "zero": False}]
+    if fmt == "raw":
+        assert extents == [{"start": 0, "length": size, "zero": True}]
+    else:
+        # qcow2 header is allocated, the rest may be a hole.
+        assert not extents[0]["zero"]
+        assert sum(ext["length"] for ext in extents) == size
+
+
+@pytest.mark.parametrize("query,extents", [
+    ("start=0", [{"start": 0, "length": 65536, "zero": True}]),
+    ("start=4096", [{"start": 4096, "length": 61440, "zero": True}]),
+    ("start=4096&length=8192",
+     [{"start": 4096, "length": 8192, "zero": True}]),
+    ("length=4096", [{"start": 0, "length": 4096, "zero": True}]),
+    ("start=65536", []),
+])
+def test_file_zero_range(srv, client, tmpfile, query, extents):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?" % ticket + query)
+    data = res.read()
+    assert res.status == 200
+    assert json.loads(data.decode("utf-8")) == extents
+    # All extents were returned.
+    assert res.getheader("x-next-start") is None
+
+
+def test_file_zero_paging(srv, client, tmpfile, monkeypatch):
+    monkeypatch.setattr(srv.config.daemon, "max_extents", 2)
+
+    # Alternating holes and data: 5 extents.
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(5 * 65536)
+        for i in (1, 3):
+            f.seek(i * 65536)
+            f.write(b"x" * 65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=5 * 65536)
+    srv.auth.add(ticket)
+
+    pages = []
+    start = 0
+    while True:
+        res = client.request(
+            "GET", "/images/%(uuid)s/extents?start=" % ticket + str(start))
+        data = res.read()
+        assert res.status == 200
+        pages.append(json.loads(data.decode("utf-8")))
+        next_start = res.getheader("x-next-start")
+        if next_start is None:
+            break
+        start = int(next_start)
+
+    assert pages == [
+        [{"start": 0, "length": 65536, "zero": True},
+         {"start": 65536, "length": 65536, "zero": False}],
+        [{"start": 2 * 65536, "length": 65536, "zero": True},
+         {"start": 3 * 65536, "length": 65536, "zero": False}],
+        [{"start": 4 * 65536, "length": 65536, "zero": True}],
+    ]
+
+    # Paged requests get only the requested extents from the backend, and
+    # do not cache the extents for the entire image.
+    ticket = srv.auth.get(ticket["uuid"])
+    assert ticket.cached_extents("zero") is None
+
+
+def test_file_zero_paging_end_of_range(srv, client, tmpfile, monkeypatch):
+    monkeypatch.setattr(srv.config.daemon, "max_extents", 2)
+
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(4 * 65536)
+        f.seek(65536)
+        f.write(b"x" * 65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=4 * 65536)
+    srv.auth.add(ticket)
+
+    # The response includes the end of the range, so there is no next start.
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?start=0&length=131072" % ticket)
+    data = res.read()
+    assert res.status == 200
+    assert json.loads(data.decode("utf-8")) == [
+        {"start": 0, "length": 65536, "zero": True},
+        {"start": 65536, "length": 65536, "zero": False},
+    ]
+    assert res.getheader("x-next-start") is None
+
+
+@pytest.mark.parametrize("query", ["", "?start=0"])
+def test_file_zero_binary(srv, client, tmpfile, query):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents" % ticket + query,
+        headers={"accept": "application/octet-stream"})
+    data = res.read()
+    assert res.status == 200
+    assert res.getheader("content-type") == "application/octet-stream"
+
+    extents = image.ExtentList.from_bytes("zero", data)
+    assert list(extents) == [image.ZeroExtent(0, 65536, True)]
+
+
+def test_file_zero_data(srv, client, tmpfile):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(3 * 65536)
+        f.seek(65536)
+        f.write(b"x" * 65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=3 * 65536)
+    srv.auth.add(ticket)
+
+    res = client.request("GET", "/images/%(uuid)s/extents" % ticket)
+    data = res.read()
+    assert res.status == 200
+    assert json.loads(data.decode("utf-8")) == [
+        {"start": 0, "length": 65536, "zero": True},
+        {"start": 65536, "length": 65536, "zero": False},
+        {"start": 2 * 65536, "length": 65536, "zero": True},
+    ]
+
+
+@pytest.mark.parametrize("query", [
+    "start=invalid",
+    "start=-1",
+    "length=invalid",
+    "length=-1",
+])
+def test_file_zero_invalid_range(srv, client, tmpfile, query):
+    with open(str(tmpfile), "wb") as f:
+        f.truncate(65536)
+
+    ticket = testutil.create_ticket(
+        url="file://{}".format(tmpfile), size=65536)
+    srv.auth.add(ticket)
+
+    res = client.request(
+        "GET", "/images/%(uuid)s/extents?" % ticket + query)
+    res.read()
+    assert res.status == 400
 
 
 def test_file_ticket_not_dirty(srv, client, tmpfile):
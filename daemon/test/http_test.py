@@ -303,9 +303,24 @@ class PartialResponse(object):
         raise http.Error(http.INTERNAL_SERVER_ERROR, "No more data for you!")
 
 
-@pytest.fixture(scope="module")
-def server():
-    server = http.Server(("127.0.0.1", 0), http.Connection)
+class Sendfile(object):
+
+    def get(self, req, resp):
+        with io.open(req.query["path"], "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            resp.headers["content-length"] = size
+            assert resp.can_sendfile()
+            offset = 0
+            while offset < size:
+                offset += resp.sendfile(f.fileno(), offset, size - offset)
+
+
+@pytest.fixture(
+    scope="module",
+    params=[http.Server, http.AsyncServer],
+    ids=["threading", "async"])
+def server(request):
+    server = request.param(("127.0.0.1", 0), http.Connection)
     log.info("Server listening on port %d", server.server_port)
 
     server.app = http.Router([
@@ -322,6 +337,7 @@ def server():
         (r"/client-error/(.*)", ClientError()),
         (r"/keep-connection/", KeepConnection()),
         (r"/partial-response/", PartialResponse()),
+        (r"/sendfile/", Sendfile()),
     ])
 
     t = util.start_thread(
@@ -504,6 +520,69 @@ def test_range_demo(server):
         assert r.getheader("content-range") == "bytes */16"
 
 
+def test_sendfile(server, tmpdir):
+    data = b"x" * 1024**2 + b"y" * 42
+    path = tmpdir.join("file")
+    path.write(data)
+
+    con = http_client.HTTPConnection("localhost", server.server_port)
+    with closing(con):
+        con.request("GET", "/sendfile/?path={}".format(path))
+        r = con.getresponse()
+        assert r.status == http.OK
+        assert r.read() == data
+
+
+def test_async_server_idle_connections():
+    # Many idle connections do not need more workers.
+    server = http.AsyncServer(("127.0.0.1", 0), http.Connection)
+    server.max_workers = 2
+    server.app = http.Router([(r"/demo/(.*)", Demo())])
+    t = util.start_thread(server.serve_forever)
+    try:
+        connections = [
+            http_client.HTTPConnection("localhost", server.server_port)
+            for i in range(20)]
+        try:
+            for i in range(3):
+                for con in connections:
+                    con.request("GET", "/demo/{}".format(i))
+                    r = con.getresponse()
+                    assert r.status == http.OK
+                    assert r.read() == b"%d\n" % i
+        finally:
+            for con in connections:
+                con.close()
+    finally:
+        server.shutdown()
+        t.join()
+
+
+def test_async_server_pipelined_requests():
+    server = http.AsyncServer(("127.0.0.1", 0), http.Connection)
+    server.app = http.Router([(r"/demo/(.*)", Demo())])
+    t = util.start_thread(server.serve_forever)
+    try:
+        sock = socket.create_connection(("localhost", server.server_port))
+        with closing(sock):
+            # Both requests are sent before reading the first response.
+            sock.sendall(
+                b"GET /demo/a HTTP/1.1\r\nHost: localhost\r\n\r\n"
+                b"GET /demo/b HTTP/1.1\r\nHost: localhost\r\n"
+                b"Connection: close\r\n\r\n")
+            data = b""
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        assert data.count(b"HTTP/1.1 200 OK") == 2
+        assert data.endswith(b"b\n")
+    finally:
+        server.shutdown()
+        t.join()
+
+
 def test_request_info_get(server):
     con = http_client.HTTPConnection("localhost", server.server_port)
     with closing(con):
@@ -1005,6 +1084,38 @@ def test_range_parse_not_satisfiable(header):
     assert e.value.code == http.REQUESTED_RANGE_NOT_SATISFIABLE
 
 
+@pytest.mark.parametrize("header,ranges", [
+    # Single range.
+    ("bytes=0-99", [(0, 99)]),
+    # Multiple ranges.
+    ("bytes=0-499,500-599", [(0, 499), (500, 599)]),
+    # Optional whitespace.
+    ("bytes=0-0, 42-42 ,99-", [(0, 0), (42, 42), (99, None)]),
+    # Order is kept.
+    ("bytes=500-599,0-99", [(500, 599), (0, 99)]),
+])
+def test_range_parse_multiple(header, ranges):
+    res = http.Range.parse_multiple(header)
+    assert [(r.first, r.last) for r in res] == ranges
+
+
+@pytest.mark.parametrize("header", [
+    # Missing bytes
+    "cats=0-99,100-199",
+    # Empty range
+    "bytes=0-99,",
+    "bytes=0-99,,100-199",
+    # first > last
+    "bytes=0-99,199-100",
+    # Junk
+    "bytes=0-99;100-199",
+])
+def test_range_parse_multiple_not_satisfiable(header):
+    with pytest.raises(http.Error) as e:
+        http.Range.parse_multiple(header)
+    assert e.value.code == http.REQUESTED_RANGE_NOT_SATISFIABLE
+
+
 @pytest.mark.parametrize("header,first,last,complete", [
     # First 100 bytes of 200 bytes.
     ("bytes 0-99/200", 0, 99, 200),
@@ -9,17 +9,24 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import email
 import io
 import json
 import logging
+import os
 import time
 
 from six.moves import http_client
 
 import pytest
 
+from ovirt_imageio import cache
+from ovirt_imageio import compression
 from ovirt_imageio import config
+from ovirt_imageio import images
+from ovirt_imageio import metrics
 from ovirt_imageio import server
+from ovirt_imageio.backends import file
 
 from . import testutil
 from . import http
@@ -286,6 +293,324 @@ def test_download(tmpdir, srv, rng, start, end):
         assert res.getheader("Content-Range") == content_range
 
 
+@pytest.mark.parametrize("rng,parts", [
+    # Sorted ranges.
+    ("bytes=0-99,1024-1099", [(0, 99), (1024, 1099)]),
+    # Unsorted ranges are sent sorted.
+    ("bytes=1024-1099,0-99", [(0, 99), (1024, 1099)]),
+    # Adjacent ranges are coalesced.
+    ("bytes=0-99,100-199,512-", [(0, 199), (512, 1535)]),
+    # Overlapping ranges are coalesced.
+    ("bytes=0-511,100-199,500-1023", [(0, 1023)]),
+])
+def test_download_multiple_ranges(tmpdir, srv, rng, parts):
+    data = b"a" * 512 + b"b" * 512 + b"c" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"], headers={"Range": rng})
+        assert res.status == 206
+        body = res.read()
+        assert int(res.getheader("content-length")) == len(body)
+        received = parse_multipart(res.getheader("content-type"), body)
+
+    expected = [
+        ("bytes %d-%d/%d" % (first, last, len(data)), data[first:last + 1])
+        for first, last in parts
+    ]
+    assert received == expected
+
+
+def test_download_multiple_ranges_keep_alive(tmpdir, srv):
+    data = b"a" * 512 + b"b" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+    with http.Client(srv.config) as c:
+        for i in range(2):
+            res = c.get("/images/" + ticket["uuid"],
+                        headers={"Range": "bytes=0-9,600-609"})
+            assert res.status == 206
+            received = parse_multipart(
+                res.getheader("content-type"), res.read())
+            assert [part for _, part in received] == [
+                data[0:10], data[600:610]]
+
+
+@pytest.mark.parametrize("rng", [
+    # After end of image.
+    "bytes=0-99,1024-2047",
+    "bytes=0-99,1024-",
+    # Suffix range is not supported yet.
+    "bytes=0-99,-100",
+    # Invalid range.
+    "bytes=0-99,100",
+])
+def test_download_multiple_ranges_not_satisfiable(tmpdir, srv, rng):
+    image = testutil.create_tempfile(tmpdir, "image", size=1024)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=1024)
+    srv.auth.add(ticket)
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"], headers={"Range": rng})
+        assert res.status == 416
+
+
+def test_download_too_many_ranges(tmpdir, srv):
+    image = testutil.create_tempfile(tmpdir, "image", size=1024)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=1024)
+    srv.auth.add(ticket)
+    rng = "bytes=" + ",".join("%d-%d" % (i, i) for i in range(200))
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"], headers={"Range": rng})
+        assert res.status == 416
+
+
+def parse_multipart(content_type, body):
+    """
+    Parse multipart/byteranges body, returning list of (content_range, data)
+    tuples.
+    """
+    assert content_type.startswith("multipart/byteranges; boundary=")
+    msg = email.message_from_bytes(
+        b"Content-Type: " + content_type.encode("ascii") + b"\r\n\r\n" +
+        body)
+    return [(part["Content-Range"], part.get_payload(decode=True))
+            for part in msg.get_payload()]
+
+
+@pytest.fixture
+def caching_srv(srv, monkeypatch):
+    # The cache is created when starting the server, so we replace the
+    # authorizer cache. Tickets added after that use the new cache.
+    monkeypatch.setattr(srv.auth, "_cache", cache.Cache(1024**2))
+    yield srv
+
+
+def test_download_cached(tmpdir, caching_srv):
+    srv = caching_srv
+    data = os.urandom(256 * 1024)
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+
+    hits = metrics.CACHE_HITS.get()
+    misses = metrics.CACHE_MISSES.get()
+
+    with http.Client(srv.config) as c:
+        for i in range(2):
+            res = c.get("/images/" + ticket["uuid"],
+                        headers={"Range": "bytes=1000-69999"})
+            assert res.status == 206
+            assert res.read() == data[1000:70000]
+
+    # The first request read 2 blocks from storage, and the second was
+    # served from the cache.
+    assert metrics.CACHE_MISSES.get() == misses + 2
+    assert metrics.CACHE_HITS.get() == hits + 2
+
+
+def test_download_large_range_not_cached(tmpdir, caching_srv):
+    srv = caching_srv
+    size = cache.MAX_READ_SIZE + 4096
+    data = os.urandom(size)
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+
+    hits = metrics.CACHE_HITS.get()
+    misses = metrics.CACHE_MISSES.get()
+
+    with http.Client(srv.config) as c:
+        for i in range(2):
+            res = c.get("/images/" + ticket["uuid"])
+            assert res.status == 200
+            assert res.read() == data
+
+    # Large reads bypass the cache.
+    assert metrics.CACHE_MISSES.get() == misses
+    assert metrics.CACHE_HITS.get() == hits
+    assert srv.auth._cache.size == 0
+
+
+def test_download_cached_multiple_ranges(tmpdir, caching_srv):
+    srv = caching_srv
+    data = os.urandom(256 * 1024)
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+
+    hits = metrics.CACHE_HITS.get()
+
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"],
+                    headers={"Range": "bytes=0-99,200-299"})
+        assert res.status == 206
+        parts = parse_multipart(res.getheader("content-type"), res.read())
+        assert parts[0][1] == data[0:100]
+        assert parts[1][1] == data[200:300]
+
+    # Both parts are in the first block.
+    assert metrics.CACHE_HITS.get() == hits + 1
+
+
+def test_download_cached_after_upload(tmpdir, caching_srv):
+    srv = caching_srv
+    data = b"x" * 128 * 1024
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"],
+                    headers={"Range": "bytes=0-4095"})
+        assert res.read() == data[:4096]
+
+        # Modifying the image drops cached blocks.
+        res = c.put("/images/" + ticket["uuid"], b"y" * 4096)
+        res.read()
+        assert res.status == 200
+
+        res = c.get("/images/" + ticket["uuid"],
+                    headers={"Range": "bytes=0-4095"})
+        assert res.read() == b"y" * 4096
+
+        body = json.dumps({"op": "zero", "size": 4096}).encode("ascii")
+        res = c.patch("/images/" + ticket["uuid"], body)
+        res.read()
+        assert res.status == 200
+
+        res = c.get("/images/" + ticket["uuid"],
+                    headers={"Range": "bytes=0-4095"})
+        assert res.read() == b"\0" * 4096
+
+
+@pytest.fixture
+def compressing_srv(srv, monkeypatch):
+    monkeypatch.setattr(srv.config.daemon, "compression", True)
+    yield srv
+
+
+def test_upload_compressed(tmpdir, compressing_srv):
+    srv = compressing_srv
+    data = b"-------|after"
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(url="file://" + str(image))
+    srv.auth.add(ticket)
+    body = compression.compress("gzip", b"content")
+    headers = {
+        "content-encoding": "gzip",
+        "content-range": "bytes 0-6/*",
+    }
+    with http.Client(srv.config) as c:
+        res = c.put("/images/" + ticket["uuid"], body, headers=headers)
+        assert res.status == 200
+        with io.open(str(image), "rb") as f:
+            assert f.read(len(data)) == b"content|after"
+
+
+def test_upload_compressed_no_range(tmpdir, compressing_srv):
+    srv = compressing_srv
+    ticket = testutil.create_ticket(url="file:///no/such/image")
+    srv.auth.add(ticket)
+    body = compression.compress("gzip", b"content")
+    with http.Client(srv.config) as c:
+        res = c.put("/images/" + ticket["uuid"], body,
+                    headers={"content-encoding": "gzip"})
+        assert res.status == 400
+
+
+def test_upload_compressed_invalid_data(tmpdir, compressing_srv):
+    srv = compressing_srv
+    image = testutil.create_tempfile(tmpdir, "image", b"x" * 7)
+    ticket = testutil.create_ticket(url="file://" + str(image))
+    srv.auth.add(ticket)
+    headers = {
+        "content-encoding": "gzip",
+        "content-range": "bytes 0-6/*",
+    }
+    with http.Client(srv.config) as c:
+        res = c.put("/images/" + ticket["uuid"], b"not gzip data",
+                    headers=headers)
+        assert res.status == 400
+
+
+def test_upload_compression_disabled(tmpdir, srv):
+    ticket = testutil.create_ticket(url="file:///no/such/image")
+    srv.auth.add(ticket)
+    body = compression.compress("gzip", b"content")
+    headers = {
+        "content-encoding": "gzip",
+        "content-range": "bytes 0-6/*",
+    }
+    with http.Client(srv.config) as c:
+        res = c.put("/images/" + ticket["uuid"], body, headers=headers)
+        assert res.status == 415
+
+
+def test_download_compressed(tmpdir, compressing_srv):
+    srv = compressing_srv
+    data = b"a" * 512 + b"b" * 512 + b"c" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+    headers = {"range": "bytes=512-1535", "accept-encoding": "gzip"}
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"], headers=headers)
+        assert res.status == 206
+        assert res.getheader("content-encoding") == "gzip"
+        assert res.getheader("content-range") == "bytes 512-1535/1536"
+        assert res.getheader("content-length") is None
+        assert res.getheader("transfer-encoding") == "chunked"
+        body = res.read()
+        assert compression.decompress("gzip", body, 1024) == data[512:]
+
+
+def test_download_compressed_stream(tmpdir, compressing_srv, monkeypatch):
+    srv = compressing_srv
+    # Send the data in many chunks.
+    monkeypatch.setattr(srv.config.daemon, "buffer_size", 128 * 1024)
+    data = os.urandom(1024**2) + b"\0" * 4 * 1024**2
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+    headers = {"accept-encoding": "gzip"}
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"], headers=headers)
+        assert res.status == 200
+        assert res.getheader("content-encoding") == "gzip"
+        body = res.read()
+        assert len(body) < len(data)
+        assert compression.decompress("gzip", body, len(data)) == data
+
+        # The connection can be used for the next request.
+        res = c.get("/images/" + ticket["uuid"])
+        assert res.status == 200
+        assert res.read() == data
+
+
+def test_download_compression_disabled(tmpdir, srv):
+    data = b"a" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=len(data))
+    srv.auth.add(ticket)
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"],
+                    headers={"accept-encoding": "gzip"})
+        assert res.status == 200
+        assert res.getheader("content-encoding") is None
+        assert res.read() == data
+
+
 def test_download_image_size_gt_ticket_size(tmpdir, srv):
     image = testutil.create_tempfile(tmpdir, "image", size=8192)
     ticket = testutil.create_ticket(url="file://" + str(image), size=4096)
@@ -448,6 +773,75 @@ def test_download_holes(tmpdir, srv):
         assert received == b"\0" * size
 
 
+@pytest.fixture
+def extents_calls(monkeypatch):
+    calls = []
+    orig = file.Backend.extents
+
+    def extents(self, context="zero", start=0, length=None):
+        calls.append((context, start, length))
+        return orig(self, context, start=start, length=length)
+
+    monkeypatch.setattr(file.Backend, "extents", extents)
+    return calls
+
+
+def test_download_small_range_no_extents(tmpdir, srv, extents_calls):
+    size = 4 * 1024**2
+    image = testutil.create_tempfile(tmpdir, "image", size=size)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=size)
+    srv.auth.add(ticket)
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"],
+                    headers={"Range": "bytes=4096-8191"})
+        assert res.status == 206
+        assert res.read() == b"\0" * 4096
+
+    # Too small range to skip holes.
+    assert extents_calls == []
+
+
+def test_download_range_extents(tmpdir, srv, extents_calls):
+    chunk_size = 1024**2
+    data = b"x" * chunk_size
+    image = str(tmpdir.join("image"))
+    with open(image, "wb") as f:
+        f.truncate(4 * chunk_size)
+        f.seek(2 * chunk_size)
+        f.write(data)
+
+    ticket = testutil.create_ticket(url="file://" + image, size=4 * chunk_size)
+    srv.auth.add(ticket)
+    with http.Client(srv.config) as c:
+        res = c.get("/images/" + ticket["uuid"],
+                    headers={"Range": "bytes={}-{}".format(
+                        chunk_size, 3 * chunk_size - 1)})
+        assert res.status == 206
+        assert res.read() == b"\0" * chunk_size + data
+
+    # Only extents in the requested range are needed.
+    assert extents_calls == [("zero", chunk_size, 2 * chunk_size)]
+
+
+def test_download_cached_extents(tmpdir, srv, extents_calls):
+    size = 4 * 1024**2
+    image = testutil.create_tempfile(tmpdir, "image", size=size)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=size)
+    srv.auth.add(ticket)
+    with http.Client(srv.config) as c:
+        # Getting the extents caches them in the ticket.
+        res = c.get("/images/" + ticket["uuid"] + "/extents")
+        res.read()
+        assert res.status == 200
+        del extents_calls[:]
+
+        res = c.get("/images/" + ticket["uuid"])
+        assert res.status == 200
+        assert res.read() == b"\0" * size
+
+    assert extents_calls == []
+
+
 def test_download_filename_in_ticket(tmpdir, srv):
     size = 1024
     filename = "\u05d0.raw"  # hebrew aleph
@@ -485,9 +879,10 @@ def test_download_progress(tmpdir, srv, monkeypatch):
     # the client read all the data.
     size = srv.config.daemon.buffer_size * 50
 
+    # The image must contain data, since holes are sent without reading.
     filename = tmpdir.join("image")
     with open(str(filename), 'wb') as image:
-        image.truncate(size)
+        image.write(b"x" * size)
     ticket = testutil.create_ticket(
         url="file://" + str(filename), ops=["read"], size=size)
     srv.auth.add(ticket)
@@ -681,13 +1076,129 @@ def test_flush_ticket_readonly(tmpdir, srv):
         assert res.status == 403
 
 
+# Batch
+
+def test_batch(tmpdir, srv):
+    data = b"x" * 4096
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(url="file://" + str(image))
+    srv.auth.add(ticket)
+    msgs = [
+        {"op": "zero", "offset": 0, "size": 512},
+        {"op": "zero", "offset": 1024, "size": 1024},
+        {"op": "zero", "offset": 3584, "size": 512, "flush": False},
+        {"op": "flush"},
+    ]
+    body = json.dumps(msgs).encode("ascii")
+    with http.Client(srv.config) as c:
+        res = c.patch("/images/" + ticket["uuid"], body)
+
+        assert res.status == 200
+        assert res.getheader("content-length") == "0"
+
+    with io.open(str(image), "rb") as f:
+        assert f.read() == (
+            b"\0" * 512 + b"x" * 512 +
+            b"\0" * 1024 + b"x" * 1536 +
+            b"\0" * 512)
+
+
+def test_batch_extends_ticket(tmpdir, srv, fake_time):
+    data = b"x" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), ops=["write"])
+    srv.auth.add(ticket)
+    server_ticket = srv.auth.get(ticket["uuid"]).info()
+    assert server_ticket["expires"] == 300
+
+    fake_time.now += 200
+    msgs = [{"op": "zero", "size": 512}, {"op": "flush"}]
+    body = json.dumps(msgs).encode("ascii")
+    with http.Client(srv.config) as c:
+        res = c.patch("/images/" + ticket["uuid"], body)
+        assert res.status == 200
+
+        res.read()
+
+        # Yield to server thread - will close the opreration and extend the
+        # ticket.
+        time.sleep(0.1)
+
+        server_ticket = srv.auth.get(ticket["uuid"]).info()
+        assert server_ticket["expires"] == 500
+        assert server_ticket["transferred"] == 512
+
+
+@pytest.mark.parametrize("msgs", [
+    [],
+    ["not an operation"],
+    [{"op": "invalid"}],
+    [{"op": "zero"}],
+    [{"op": "zero", "size": 1, "offset": -1}],
+    [{"op": "zero", "size": 1}, {"op": "zero", "size": "invalid"}],
+    [{"op": "zero", "size": 1}] * (images.MAX_BATCH + 1),
+])
+def test_batch_validation(tmpdir, srv, msgs):
+    data = b"x" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(url="file://" + str(image))
+    srv.auth.add(ticket)
+    body = json.dumps(msgs).encode("ascii")
+    with http.Client(srv.config) as c:
+        res = c.patch("/images/" + ticket["uuid"], body)
+        res.read()
+        assert res.status == 400
+
+    # Nothing was modified.
+    with io.open(str(image), "rb") as f:
+        assert f.read() == data
+
+
+def test_batch_out_of_range(tmpdir, srv):
+    data = b"x" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(url="file://" + str(image), size=512)
+    srv.auth.add(ticket)
+    msgs = [
+        {"op": "zero", "offset": 0, "size": 256},
+        {"op": "zero", "offset": 256, "size": 512},
+    ]
+    body = json.dumps(msgs).encode("ascii")
+    with http.Client(srv.config) as c:
+        res = c.patch("/images/" + ticket["uuid"], body)
+        res.read()
+        assert res.status == 416
+
+    with io.open(str(image), "rb") as f:
+        assert f.read() == data
+
+
+def test_batch_ticket_readonly(tmpdir, srv):
+    data = b"x" * 512
+    image = testutil.create_tempfile(tmpdir, "image", data)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), ops=["read"])
+    srv.auth.add(ticket)
+    msgs = [{"op": "zero", "size": 512}, {"op": "flush"}]
+    body = json.dumps(msgs).encode("ascii")
+    with http.Client(srv.config) as c:
+        res = c.patch("/images/" + ticket["uuid"], body)
+        res.read()
+        assert res.status == 403
+
+    with io.open(str(image), "rb") as f:
+        assert f.read() == data
+
+
 # Options
 
 def test_options_all(srv):
     with http.Client(srv.config) as c:
         res = c.options("/images/*")
         allows = {"OPTIONS", "GET", "PUT", "PATCH"}
-        features = {"extents", "zero", "flush"}
+        features = {"extents", "extents_range", "extents_binary", "zero",
+                    "flush", "batch"}
         assert res.status == 200
         assert set(res.getheader("allow").split(',')) == allows
         options = json.loads(res.read())
@@ -695,13 +1206,23 @@ def test_options_all(srv):
         assert options["unix_socket"] == srv.config.local.socket
 
 
+def test_options_compression(compressing_srv):
+    srv = compressing_srv
+    with http.Client(srv.config) as c:
+        res = c.options("/images/*")
+        assert res.status == 200
+        options = json.loads(res.read())
+        assert set(compression.encodings()) <= set(options["features"])
+
+
 def test_options_read_write(srv):
     ticket = testutil.create_ticket(ops=["read", "write"])
     srv.auth.add(ticket)
     with http.Client(srv.config) as c:
         res = c.options("/images/" + ticket["uuid"])
         allows = {"OPTIONS", "GET", "PUT", "PATCH"}
-        features = {"extents", "zero", "flush"}
+        features = {"extents", "extents_range", "extents_binary", "zero",
+                    "flush", "batch"}
         assert res.status == 200
         assert set(res.getheader("allow").split(',')) == allows
         assert set(json.loads(res.read())["features"]) == features
@@ -713,7 +1234,7 @@ def test_options_read(srv):
     with http.Client(srv.config) as c:
         res = c.options("/images/" + ticket["uuid"])
         allows = {"OPTIONS", "GET"}
-        features = {"extents"}
+        features = {"extents", "extents_range", "extents_binary"}
         assert res.status == 200
         assert set(res.getheader("allow").split(',')) == allows
         assert set(json.loads(res.read())["features"]) == features
@@ -726,7 +1247,8 @@ def test_options_write(srv):
         res = c.options("/images/" + ticket["uuid"])
         # Having "write" imply also "read".
         allows = {"OPTIONS", "GET", "PUT", "PATCH"}
-        features = {"extents", "zero", "flush"}
+        features = {"extents", "extents_range", "extents_binary", "zero",
+                    "flush", "batch"}
         assert res.status == 200
         assert set(res.getheader("allow").split(',')) == allows
         assert set(json.loads(res.read())["features"]) == features
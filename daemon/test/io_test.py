@@ -8,6 +8,8 @@
 
 from __future__ import absolute_import
 
+import os
+
 import pytest
 
 from six.moves.urllib_parse import urlparse
@@ -15,6 +17,7 @@ from six.moves.urllib_parse import urlparse
 from ovirt_imageio import qemu_img
 from ovirt_imageio import qemu_nbd
 from ovirt_imageio import io
+from ovirt_imageio import sizing
 from ovirt_imageio.backends import nbd, memory, image
 from ovirt_imageio.nbd import UnixAddress
 
@@ -27,6 +30,14 @@ ZERO_PARAMS = [
     pytest.param(False, id="nozero"),
 ]
 
+BENCH_SIZE = 256 * 1024**2
+
+BENCH_BUFFER_SIZE = [
+    pytest.param(128 * 1024, id="128k"),
+    pytest.param(1024**2, id="1m"),
+    pytest.param(4 * 1024**2, id="4m"),
+]
+
 
 @pytest.mark.parametrize("src_fmt,dst_fmt", [
     ("raw", "raw"),
@@ -184,6 +195,396 @@ def test_copy_dirty():
     )
 
 
+@pytest.mark.parametrize("max_workers", [1, 4])
+@pytest.mark.parametrize("queue_depth", [0, 4])
+def test_copy_adaptive(monkeypatch, max_workers, queue_depth):
+    # Change the buffer size after every request.
+    monkeypatch.setattr(sizing.Adaptive, "WINDOW", 1)
+    monkeypatch.setattr(io, "MAX_COPY_SIZE", 1024)
+
+    size = 64 * 1024
+    data = b"".join(b"%08d" % i for i in range(size // 8))
+    src = memory.Backend("r", data)
+    dst = memory.Backend("r+", b"\0" * size)
+
+    io.copy(src, dst, buffer_size=256, max_workers=max_workers,
+            queue_depth=queue_depth, adaptive=True)
+
+    assert dst.data() == data
+
+
+class RecordingBackend(memory.Backend):
+    """
+    Memory backend recording the size of every write.
+    """
+
+    def __init__(self, mode, data=None):
+        super(RecordingBackend, self).__init__(mode, data)
+        self.writes = []
+
+    def write(self, buf):
+        self.writes.append(len(buf))
+        return super(RecordingBackend, self).write(buf)
+
+
+@pytest.mark.parametrize("queue_depth", [0, 4])
+def test_copy_adaptive_step_changes(monkeypatch, queue_depth):
+    monkeypatch.setattr(sizing.Adaptive, "WINDOW", 1)
+    monkeypatch.setattr(io, "MAX_COPY_SIZE", 64 * 1024)
+
+    size = 1024**2
+    data = b"".join(b"%08d" % i for i in range(size // 8))
+    src = memory.Backend("r", data)
+    dst = RecordingBackend("r+", b"\0" * size)
+
+    io.copy(src, dst, buffer_size=8192, max_workers=1,
+            queue_depth=queue_depth, adaptive=True)
+
+    assert dst.data() == data
+    # The step changed while copying.
+    assert len(set(dst.writes)) > 1
+
+
+class RecordingSizer(sizing.Fixed):
+    """
+    Fixed sizer recording updates.
+    """
+
+    def __init__(self, size):
+        super(RecordingSizer, self).__init__(size)
+        self.updates = []
+
+    def update(self, count, seconds):
+        self.updates.append((count, seconds))
+
+
+class SlowBackend(memory.Backend):
+    """
+    Memory backend taking 1 second to write.
+    """
+
+    def __init__(self, mode, data, time):
+        super(SlowBackend, self).__init__(mode, data)
+        self.time = time
+
+    def write(self, buf):
+        self.time.now += 1
+        return super(SlowBackend, self).write(buf)
+
+
+@pytest.mark.parametrize("queue_depth", [0, 4])
+def test_copy_adaptive_measures_writes(monkeypatch, fake_time, queue_depth):
+    sizers = []
+
+    def create(backends, size, **options):
+        sizers.append(RecordingSizer(size))
+        return sizers[-1]
+
+    monkeypatch.setattr(sizing, "create", create)
+    monkeypatch.setattr(io, "MAX_COPY_SIZE", 4096)
+
+    size = 16 * 1024
+    src = memory.Backend("r", b"x" * size)
+    dst = SlowBackend("r+", b"\0" * size, fake_time)
+
+    io.copy(src, dst, buffer_size=1024, max_workers=1,
+            queue_depth=queue_depth, adaptive=True)
+
+    # Every copy request is measured after writing 4 buffers, also when
+    # writing in the writer thread.
+    assert sizers[0].updates == [(4096, 4)] * 4
+
+
+class CountingBackend(memory.Backend):
+    """
+    Memory backend counting write and zero calls.
+    """
+
+    def __init__(self, mode, data=None):
+        super(CountingBackend, self).__init__(mode, data)
+        self.calls = {"write": 0, "zero": 0}
+
+    def write(self, buf):
+        self.calls["write"] += 1
+        return super(CountingBackend, self).write(buf)
+
+    def zero(self, count):
+        self.calls["zero"] += 1
+        return super(CountingBackend, self).zero(count)
+
+
+class NoCloneBackend(object):
+    """
+    Backend wrapping a memory backend, without clone().
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def seek(self, pos, how=os.SEEK_SET):
+        return self.backend.seek(pos, how)
+
+    def write(self, buf):
+        return self.backend.write(buf)
+
+    def zero(self, count):
+        return self.backend.zero(count)
+
+    def flush(self):
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
+
+    @property
+    def block_size(self):
+        return self.backend.block_size
+
+    def data(self):
+        return self.backend.data()
+
+
+def detect_zeroes_data():
+    # Data, big zero run, data with small zero run, big zero run.
+    run = io.MIN_ZERO_RUN
+    return (
+        b"a" * run +
+        b"\0" * 4 * run +
+        b"b" * run + b"\0" * (run // 2) + b"c" * (run // 2) +
+        b"\0" * 2 * run
+    )
+
+
+@pytest.mark.parametrize("queue_depth", [0, 4])
+@pytest.mark.parametrize("buffer_size", [
+    pytest.param(io.MIN_ZERO_RUN, id="small"),
+    pytest.param(16 * io.MIN_ZERO_RUN, id="large"),
+])
+def test_copy_detect_zeroes(queue_depth, buffer_size):
+    data = detect_zeroes_data()
+    src = memory.Backend("r", data)
+    dst = CountingBackend("r+", b"y" * len(data))
+
+    io.copy(src, dst, buffer_size=buffer_size, max_workers=1,
+            queue_depth=queue_depth, detect_zeroes=True)
+
+    assert dst.data() == data
+    # Consecutive zero runs are merged.
+    assert dst.calls["zero"] == 2
+    # Small zero run is written as data.
+    if buffer_size > io.MIN_ZERO_RUN:
+        assert dst.calls["write"] == 2
+
+
+@pytest.mark.parametrize("queue_depth", [0, 4])
+def test_copy_detect_zeroes_skip(queue_depth):
+    data = detect_zeroes_data()
+    src = memory.Backend("r", data)
+    # The destination is not zeroed, so we can detect skipped zero runs.
+    dst = CountingBackend("r+", b"y" * len(data))
+
+    io.copy(src, dst, max_workers=1, queue_depth=queue_depth, zero=False,
+            detect_zeroes=True)
+
+    run = io.MIN_ZERO_RUN
+    assert dst.data() == (
+        b"a" * run +
+        b"y" * 4 * run +
+        b"b" * run + b"\0" * (run // 2) + b"c" * (run // 2) +
+        b"y" * 2 * run
+    )
+    assert dst.calls["zero"] == 0
+
+
+@pytest.mark.parametrize("max_workers", [1, 2, 4])
+@pytest.mark.parametrize("queue_depth", [0, 4])
+def test_copy_detect_zeroes_parallel(monkeypatch, max_workers, queue_depth):
+    monkeypatch.setattr(io, "MAX_COPY_SIZE", io.MIN_ZERO_RUN)
+    data = detect_zeroes_data() * 4
+    src = memory.Backend("r", data)
+    dst = memory.Backend("r+", b"y" * len(data))
+
+    io.copy(src, dst, max_workers=max_workers, queue_depth=queue_depth,
+            detect_zeroes=True)
+
+    assert dst.data() == data
+
+
+@pytest.mark.parametrize("max_workers", [1, 2, 4])
+@pytest.mark.parametrize("zero", ZERO_PARAMS)
+def test_copy_parallel(max_workers, zero):
+    size = 1024
+    chunk_size = size // 8
+
+    def fake_extents(context="zero"):
+        return [
+            image.ZeroExtent(i * chunk_size, chunk_size, bool(i % 2))
+            for i in range(8)
+        ]
+
+    src = memory.Backend(
+        "r", (b"x" * chunk_size + b"\0" * chunk_size) * 4)
+    src.extents = fake_extents
+
+    dst = memory.Backend("r+", (b"y" if zero else b"\0") * size)
+
+    io.copy(src, dst, buffer_size=64, zero=zero, max_workers=max_workers)
+
+    assert dst.data() == src.data()
+
+
+def test_copy_parallel_error():
+    size = 1024
+    chunk_size = size // 8
+
+    def fake_extents(context="zero"):
+        return [
+            image.ZeroExtent(i * chunk_size, chunk_size, False)
+            for i in range(8)
+        ]
+
+    class Failing(memory.Backend):
+
+        def write(self, buf):
+            if self.tell() >= 4 * chunk_size:
+                raise IOError("backend error")
+            return super(Failing, self).write(buf)
+
+    src = memory.Backend("r", b"x" * size)
+    src.extents = fake_extents
+    dst = Failing("r+", b"\0" * size)
+
+    with pytest.raises(IOError):
+        io.copy(src, dst, max_workers=4)
+
+
+def test_copy_no_clone():
+    size = 1024
+    chunk_size = size // 2
+
+    def fake_extents(context="zero"):
+        return [
+            image.ZeroExtent(0 * chunk_size, chunk_size, False),
+            image.ZeroExtent(1 * chunk_size, chunk_size, True),
+        ]
+
+    src = memory.Backend("r", b"x" * chunk_size + b"\0" * chunk_size)
+    src.extents = fake_extents
+
+    dst = NoCloneBackend(memory.Backend("r+", b"y" * size))
+
+    io.copy(src, dst, max_workers=4)
+
+    assert dst.data() == src.data()
+
+
+@pytest.mark.parametrize("queue_depth", [0, 1, 4])
+@pytest.mark.parametrize("src_type,dst_type", [
+    (memory.Backend, memory.Backend),
+    (memory.Backend, memory.ReaderFrom),
+    (memory.WriterTo, memory.Backend),
+    (memory.WriterTo, memory.ReaderFrom),
+])
+@pytest.mark.parametrize("zero", ZERO_PARAMS)
+def test_copy_pipeline(queue_depth, src_type, dst_type, zero):
+    size = 1024
+    chunk_size = size // 4
+
+    def fake_extents(context="zero"):
+        return [
+            image.ZeroExtent(i * chunk_size, chunk_size, bool(i % 2))
+            for i in range(4)
+        ]
+
+    src = src_type("r", (b"x" * chunk_size + b"\0" * chunk_size) * 2)
+    src.extents = fake_extents
+
+    dst = dst_type("r+", (b"y" if zero else b"\0") * size)
+
+    p = FakeProgress()
+    io.copy(
+        src,
+        dst,
+        buffer_size=64,
+        zero=zero,
+        progress=p,
+        max_workers=1,
+        queue_depth=queue_depth)
+
+    assert dst.data() == src.data()
+    assert sum(p.updates) == size
+
+
+@pytest.mark.parametrize("src_type,dst_type", [
+    (memory.Backend, memory.ReaderFrom),
+    (memory.WriterTo, memory.Backend),
+    (memory.WriterTo, memory.ReaderFrom),
+])
+def test_copy_pipeline_random_data(src_type, dst_type):
+    # Enough data to fill the pipeline many times, so the reader and writer
+    # threads run concurrently.
+    size = 64 * 1024**2
+
+    def fake_extents(context="zero"):
+        return [image.ZeroExtent(0, size, False)]
+
+    src = src_type("r", os.urandom(size))
+    src.extents = fake_extents
+    dst = dst_type("r+", b"\0" * size)
+
+    io.copy(
+        src,
+        dst,
+        buffer_size=1024**2,
+        max_workers=1,
+        queue_depth=4)
+
+    assert dst.data() == src.data()
+
+
+@pytest.mark.parametrize("dst_type", [memory.Backend, memory.ReaderFrom])
+def test_copy_pipeline_write_error(dst_type):
+    size = 1024
+
+    def fake_extents(context="zero"):
+        return [image.ZeroExtent(0, size, False)]
+
+    class Failing(dst_type):
+
+        def write(self, buf):
+            if self.tell() >= size // 2:
+                raise IOError("backend error")
+            return super(Failing, self).write(buf)
+
+    src = memory.Backend("r", b"x" * size)
+    src.extents = fake_extents
+    dst = Failing("r+", b"\0" * size)
+
+    with pytest.raises(IOError):
+        io.copy(src, dst, buffer_size=64, max_workers=1, queue_depth=2)
+
+
+def test_copy_pipeline_read_error():
+    size = 1024
+
+    def fake_extents(context="zero"):
+        return [image.ZeroExtent(0, size, False)]
+
+    class Failing(memory.Backend):
+
+        def readinto(self, buf):
+            if self.tell() >= size // 2:
+                raise IOError("backend error")
+            return super(Failing, self).readinto(buf)
+
+    src = Failing("r", b"x" * size)
+    src.extents = fake_extents
+    dst = memory.ReaderFrom("r+", b"\0" * size)
+
+    with pytest.raises(IOError):
+        io.copy(src, dst, buffer_size=64, max_workers=1, queue_depth=2)
+
+
 class FakeProgress:
 
     def __init__(self):
@@ -256,3 +657,38 @@ def test_copy_dirty_progress():
 
     # Report entire image size.
     assert sum(p.updates) == size
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+@pytest.mark.parametrize("max_workers", [1, 4])
+@pytest.mark.parametrize("queue_depth", [0, 4])
+def test_copy_memory_benchmark(bench, buffer_size, max_workers, queue_depth):
+    src = memory.Backend("r", bytearray(b"x" * BENCH_SIZE))
+    dst = memory.Backend("r+", bytearray(BENCH_SIZE))
+    bench(BENCH_SIZE, io.copy, src, dst, buffer_size=buffer_size,
+          max_workers=max_workers, queue_depth=queue_depth)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+@pytest.mark.parametrize("max_workers", [1, 4])
+@pytest.mark.parametrize("queue_depth", [0, 4])
+def test_copy_nbd_benchmark(
+        bench, tmpdir, buffer_size, max_workers, queue_depth):
+    src = str(tmpdir.join("src.raw"))
+    with open(src, "wb") as f:
+        f.write(b"x" * BENCH_SIZE)
+    src_sock = UnixAddress(tmpdir.join("src.sock"))
+
+    dst = str(tmpdir.join("dst.raw"))
+    qemu_img.create(dst, "raw", size=BENCH_SIZE)
+    dst_sock = UnixAddress(tmpdir.join("dst.sock"))
+
+    with qemu_nbd.run(src, "raw", src_sock, read_only=True), \
+            qemu_nbd.run(dst, "raw", dst_sock), \
+            nbd.open(urlparse(src_sock.url()), "r") as src_backend, \
+            nbd.open(urlparse(dst_sock.url()), "r+") as dst_backend:
+        bench(BENCH_SIZE, io.copy, src_backend, dst_backend,
+              buffer_size=buffer_size, max_workers=max_workers,
+              queue_depth=queue_depth)
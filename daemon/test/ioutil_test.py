@@ -203,6 +203,49 @@ def test_is_not_zero_mmap(aligned_buffer):
     assert not ioutil.is_zero(aligned_buffer)
 
 
+# Zero runs
+
+def test_zero_runs_empty():
+    assert ioutil.zero_runs(b"", 512) == []
+
+
+@pytest.mark.parametrize("buf", [
+    pytest.param(b"\0" * 4096, id="bytes"),
+    pytest.param(bytearray(4096), id="bytearray"),
+    pytest.param(memoryview(bytearray(4096)), id="memoryview"),
+])
+def test_zero_runs_zero(buf):
+    assert ioutil.zero_runs(buf, 512) == [(0, 4096, True)]
+
+
+def test_zero_runs_data():
+    buf = b"x" * 1024
+    assert ioutil.zero_runs(buf, 512) == [(0, 1024, False)]
+
+
+def test_zero_runs_mixed():
+    buf = bytearray(8 * 512)
+    buf[512 * 2 + 100] = 1
+    buf[512 * 3] = 1
+    buf[512 * 7 + 511] = 1
+    assert ioutil.zero_runs(buf, 512) == [
+        (0, 1024, True),
+        (1024, 1024, False),
+        (2048, 1536, True),
+        (3584, 512, False),
+    ]
+
+
+def test_zero_runs_partial_block():
+    buf = b"x" * 512 + b"\0" * 100
+    assert ioutil.zero_runs(buf, 512) == [(0, 512, False), (512, 100, True)]
+
+
+def test_zero_runs_invalid_block_size():
+    with pytest.raises(ValueError):
+        ioutil.zero_runs(b"\0" * 512, 0)
+
+
 # fallocate
 
 fallocate_mode = pytest.mark.parametrize("mode", [
@@ -135,7 +135,8 @@ def test_options(srv):
     with http.UnixClient(srv.local_service.address) as c:
         res = c.request("OPTIONS", "/images/*")
         allows = {"OPTIONS", "GET", "PUT", "PATCH"}
-        features = {"zero", "flush", "extents"}
+        features = {"zero", "flush", "extents", "extents_range",
+                    "extents_binary", "batch"}
         assert res.status == http_client.OK
         assert set(res.getheader("allow").split(',')) == allows
         options = json.loads(res.read())
@@ -0,0 +1,193 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from __future__ import absolute_import
+
+import io
+import json
+import time
+
+import pytest
+
+from ovirt_imageio import metrics
+from ovirt_imageio import ops
+from ovirt_imageio.backends import memory
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.value = 0
+
+    def __call__(self):
+        return self.value
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    t = FakeTime()
+    monkeypatch.setattr(time, "time", t)
+    yield t
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+def test_counter(registry):
+    c = registry.counter("requests_total", "Number of requests.")
+    c.inc()
+    c.inc(2)
+    assert c.get() == 3
+
+
+def test_counter_labels(registry):
+    c = registry.counter("bytes_total", "Number of bytes.", ("op",))
+    c.inc(10, op="read")
+    c.inc(20, op="write")
+    c.inc(5, op="read")
+    assert c.get(op="read") == 15
+    assert c.get(op="write") == 20
+    assert c.get(op="zero") == 0
+
+
+def test_counter_invalid_labels(registry):
+    c = registry.counter("bytes_total", "Number of bytes.", ("op",))
+    with pytest.raises(ValueError):
+        c.inc(1)
+    with pytest.raises(ValueError):
+        c.inc(1, op="read", backend="file")
+
+
+def test_gauge(registry):
+    g = registry.gauge("connections", "Number of connections.")
+    g.inc()
+    g.inc()
+    g.dec()
+    assert g.get() == 1
+
+
+def test_format(registry):
+    c = registry.counter(
+        "bytes_total", "Number of bytes.", ("op", "backend"))
+    g = registry.gauge("connections", "Number of connections.")
+    c.inc(4096, op="read", backend="file")
+    c.inc(512, op="write", backend="nbd")
+    g.inc()
+
+    assert registry.format(registry.collect()) == (
+        '# HELP bytes_total Number of bytes.\n'
+        '# TYPE bytes_total counter\n'
+        'bytes_total{op="read",backend="file"} 4096\n'
+        'bytes_total{op="write",backend="nbd"} 512\n'
+        '# HELP connections Number of connections.\n'
+        '# TYPE connections gauge\n'
+        'connections 1\n'
+    )
+
+
+def test_format_escape_labels(registry):
+    c = registry.counter("errors_total", "Number of errors.", ("reason",))
+    c.inc(reason='a "quoted"\\path\n')
+    text = registry.format(registry.collect())
+    assert 'errors_total{reason="a \\"quoted\\"\\\\path\\n"} 1' in text
+
+
+def test_summary(registry):
+    s = registry.summary("seconds", "Time.", ("stage",))
+    for i in range(1, 101):
+        s.observe(i / 1000.0, stage="read")
+
+    h = s.get(stage="read")
+    assert h.count == 100
+    assert h.sum == pytest.approx(5.05)
+    assert s.get(stage="write").count == 0
+
+
+def test_summary_has_no_inc(registry):
+    s = registry.summary("seconds", "Time.")
+    assert not hasattr(s, "inc")
+
+
+def test_format_summary(registry):
+    s = registry.summary("seconds", "Time.", ("stage",))
+    s.observe(0.5, stage="read")
+
+    assert registry.format(registry.collect()) == (
+        '# HELP seconds Time.\n'
+        '# TYPE seconds summary\n'
+        'seconds{stage="read",quantile="0.5"} 0.5\n'
+        'seconds{stage="read",quantile="0.9"} 0.5\n'
+        'seconds{stage="read",quantile="0.99"} 0.5\n'
+        'seconds_sum{stage="read"} 0.5\n'
+        'seconds_count{stage="read"} 1\n'
+    )
+
+
+def test_merge(registry):
+    c = registry.counter("bytes_total", "Number of bytes.", ("op",))
+    c.inc(100, op="read")
+    samples = registry.collect()
+
+    # Samples from another process, as returned by the json format.
+    other = json.loads(json.dumps(
+        {"bytes_total": [[["read"], 10], [["write"], 20]]}))
+    registry.merge(samples, other)
+
+    assert samples == {"bytes_total": [(("read",), 110), (("write",), 20)]}
+
+
+def test_merge_summary(registry):
+    s = registry.summary("seconds", "Time.", ("stage",))
+    s.observe(0.1, stage="read")
+    samples = registry.collect()
+
+    other_registry = metrics.Registry()
+    other = other_registry.summary("seconds", "Time.", ("stage",))
+    other.observe(0.3, stage="read")
+    other.observe(0.2, stage="write")
+    registry.merge(samples, json.loads(json.dumps(other_registry.collect())))
+
+    text = registry.format(samples)
+    assert 'seconds_count{stage="read"} 2' in text
+    assert 'seconds_count{stage="write"} 1' in text
+    assert 'seconds{stage="read",quantile="0.99"} 0.3' in text
+
+
+def test_clear(registry):
+    c = registry.counter("bytes_total", "Number of bytes.", ("op",))
+    c.inc(100, op="read")
+    registry.clear()
+    assert registry.collect() == {"bytes_total": []}
+
+
+def test_clock(fake_time):
+    metrics.REGISTRY.clear()
+    c = metrics.Clock()
+    c.start("read")
+    fake_time.value += 1
+    c.stop("read")
+    c.start("read")
+    fake_time.value += 2
+    c.stop("read")
+
+    h = metrics.STAGE_SECONDS.get(stage="read")
+    assert h.sum == 3
+    assert h.count == 2
+    assert h.max == 2
+
+
+def test_operation():
+    metrics.REGISTRY.clear()
+    src = memory.Backend("r", b"x" * 100)
+    op = ops.Send(src, io.BytesIO(), 100)
+    op.run()
+
+    assert metrics.BYTES.get(op="read", backend="memory") == 100
+    assert metrics.OPERATIONS.get(op="read") == 0
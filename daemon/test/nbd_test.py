@@ -505,6 +505,132 @@ def test_extents_reply_error(nbd_server, user_file):
         assert c.read(4096, 1) == b"\0"
 
 
+@pytest.mark.parametrize("fmt", ["raw", "qcow2"])
+def test_aio_write_read(tmpdir, fmt):
+    image = str(tmpdir.join("image"))
+    sock = nbd.UnixAddress(tmpdir.join("sock"))
+    create_image(image, fmt, 1024**3)
+    chunk = 64 * 1024
+    count = 8
+
+    with qemu_nbd.run(image, fmt, sock):
+        with nbd.Client(sock) as c:
+            # Send all writes before waiting for replies.
+            handles = []
+            for i in range(count):
+                data = b"%d" % i * chunk
+                handles.append(c.aio_write(i * chunk, data[:chunk]))
+            assert c.in_flight == count
+
+            c.wait_all()
+            assert c.in_flight == 0
+
+            c.flush()
+
+            # Send all reads and wait for them in reverse order.
+            bufs = [bytearray(chunk) for i in range(count)]
+            handles = [c.aio_readinto(i * chunk, buf)
+                       for i, buf in enumerate(bufs)]
+
+            for handle in reversed(handles):
+                c.wait(handle)
+
+            for i, buf in enumerate(bufs):
+                assert buf == (b"%d" % i * chunk)[:chunk]
+
+
+def test_aio_zero(tmpdir):
+    size = 2 * 1024**2
+    image = str(tmpdir.join("image"))
+    sock = nbd.UnixAddress(tmpdir.join("sock"))
+    create_image(image, "raw", size)
+
+    with qemu_nbd.run(image, "raw", sock):
+        with nbd.Client(sock) as c:
+            c.write(0, b"x" * size)
+            handles = [c.aio_zero(offset, 4096)
+                       for offset in range(0, size, 1024**2)]
+            for handle in handles:
+                c.wait(handle)
+            c.flush()
+
+            for offset in range(0, size, 1024**2):
+                assert c.read(offset, 4096) == b"\0" * 4096
+                assert c.read(offset + 4096, 4096) == b"x" * 4096
+
+
+def test_aio_queue_depth(tmpdir):
+    image = str(tmpdir.join("image"))
+    sock = nbd.UnixAddress(tmpdir.join("sock"))
+    create_image(image, "raw", 1024**2)
+
+    with qemu_nbd.run(image, "raw", sock):
+        with nbd.Client(sock, queue_depth=4) as c:
+            for i in range(16):
+                c.aio_write(i * 4096, b"x" * 4096)
+                assert c.in_flight <= 4
+            c.wait_all()
+            assert c.in_flight == 0
+
+
+def test_aio_error(tmpdir):
+    size = 1024**2
+    image = str(tmpdir.join("image"))
+    sock = nbd.UnixAddress(tmpdir.join("sock"))
+    create_image(image, "raw", size)
+
+    with qemu_nbd.run(image, "raw", sock):
+        with nbd.Client(sock) as c:
+            good1 = c.aio_readinto(0, bytearray(4096))
+            bad = c.aio_readinto(size, bytearray(4096))
+            good2 = c.aio_readinto(4096, bytearray(4096))
+
+            # Waiting for the good commands succeeds even if the server
+            # failed the previous command.
+            c.wait(good2)
+            c.wait(good1)
+
+            with pytest.raises(nbd.RequestError):
+                c.wait(bad)
+
+            # The failure does not break the connection.
+            assert c.in_flight == 0
+            assert c.read(0, 1) == b"\0"
+
+
+def test_aio_wait_all_error(tmpdir):
+    size = 1024**2
+    image = str(tmpdir.join("image"))
+    sock = nbd.UnixAddress(tmpdir.join("sock"))
+    create_image(image, "raw", size)
+
+    with qemu_nbd.run(image, "raw", sock):
+        with nbd.Client(sock) as c:
+            c.aio_readinto(size, bytearray(4096))
+            c.aio_write(0, b"x" * 4096)
+
+            # Wait for all commands before raising the error.
+            with pytest.raises(nbd.RequestError):
+                c.wait_all()
+            assert c.in_flight == 0
+
+            c.flush()
+            assert c.read(0, 4096) == b"x" * 4096
+
+
+def test_aio_wait_unknown_handle(tmpdir):
+    image = str(tmpdir.join("image"))
+    sock = nbd.UnixAddress(tmpdir.join("sock"))
+    create_image(image, "raw", 1024**2)
+
+    with qemu_nbd.run(image, "raw", sock):
+        with nbd.Client(sock) as c:
+            handle = c.aio_flush()
+            c.wait(handle)
+            with pytest.raises(nbd.Error):
+                c.wait(handle)
+
+
 # Communicate with qemu builtin NBD server
 
 
@@ -8,18 +8,27 @@
 
 from __future__ import absolute_import
 
+import errno
 import io
 import os
 
 import pytest
 import userstorage
 
+from six.moves import urllib_parse
+
 from ovirt_imageio import errors
+from ovirt_imageio import nbd
 from ovirt_imageio import ops
+from ovirt_imageio import qemu_nbd
+from ovirt_imageio import sizing
 from ovirt_imageio import util
 from ovirt_imageio.backends import file
+from ovirt_imageio.backends import image
 from ovirt_imageio.backends import memory
+from ovirt_imageio.backends import nbd as nbd_backend
 
+from . import benchmark
 from . import storage
 from . marks import requires_python3
 
@@ -52,13 +61,22 @@ OFFSET_SIZE = [
     pytest.param(42, 1024**2 * 2, id="large-unaligned-offset-and-size"),
 ]
 
+# Test both synchronous I/O and native AIO.
+QUEUE_DEPTH = [
+    pytest.param(0, id="sync"),
+    pytest.param(4, id="aio",
+                 marks=pytest.mark.skipif(
+                     ops.aio is None, reason="aio extension is not built")),
+]
+
 
 @pytest.mark.parametrize("trailer", [
     pytest.param(0, id="no-trailer"),
     pytest.param(8192, id="trailer"),
 ])
 @pytest.mark.parametrize("offset,size", OFFSET_SIZE)
-def test_send_full(user_file, offset, size, trailer):
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_send_full(user_file, offset, size, trailer, queue_depth):
     data = b"b" * size
 
     with io.open(user_file.path, "wb") as f:
@@ -68,20 +86,21 @@ def test_send_full(user_file, offset, size, trailer):
 
     dst = io.BytesIO()
     with file.open(user_file.url, "r") as src:
-        op = ops.Send(src, dst, size, offset=offset)
+        op = ops.Send(src, dst, size, offset=offset, queue_depth=queue_depth)
         op.run()
 
     assert dst.getvalue() == data
 
 
 @pytest.mark.parametrize("offset,size", OFFSET_SIZE)
-def test_send_partial_content(user_file, offset, size):
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_send_partial_content(user_file, offset, size, queue_depth):
     with io.open(user_file.path, "wb") as f:
         f.truncate(offset + size - 1)
 
     dst = io.BytesIO()
     with file.open(user_file.url, "r") as src:
-        op = ops.Send(src, dst, size, offset=offset)
+        op = ops.Send(src, dst, size, offset=offset, queue_depth=queue_depth)
         with pytest.raises(errors.PartialContent) as e:
             op.run()
 
@@ -89,6 +108,26 @@ def test_send_partial_content(user_file, offset, size):
     assert e.value.available == size - 1
 
 
+class FailingWriter(object):
+
+    def write(self, buf):
+        raise ConnectionResetError("Client disconnected")
+
+
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_send_write_error(user_file, queue_depth):
+    size = 1024**2 * 2
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"x" * size)
+
+    with file.open(user_file.url, "r") as src:
+        op = ops.Send(src, FailingWriter(), size, queue_depth=queue_depth)
+        # The original error must not be hidden by errors closing buffers.
+        with pytest.raises(ConnectionResetError):
+            op.run()
+
+
 def test_send_seek():
     src = memory.Backend("r", b"0123456789")
     src.seek(8)
@@ -99,7 +138,8 @@ def test_send_seek():
 
 
 @pytest.mark.parametrize("offset,size", OFFSET_SIZE)
-def test_send_no_size(user_file, offset, size):
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_send_no_size(user_file, offset, size, queue_depth):
     data = b"b" * size
 
     with io.open(user_file.path, "wb") as f:
@@ -108,12 +148,258 @@ def test_send_no_size(user_file, offset, size):
 
     dst = io.BytesIO()
     with file.open(user_file.url, "r") as src:
-        op = ops.Send(src, dst, offset=offset)
+        op = ops.Send(src, dst, offset=offset, queue_depth=queue_depth)
         op.run()
 
     assert dst.getvalue() == data
 
 
+class SendfileWriter(object):
+    """
+    Destination supporting sendfile(), writing to a file.
+    """
+
+    def __init__(self, path, error=None):
+        self._file = io.open(path, "wb", buffering=0)
+        self._error = error
+        self.sendfile_calls = 0
+
+    def write(self, buf):
+        return self._file.write(buf)
+
+    def can_sendfile(self):
+        return True
+
+    def sendfile(self, fd, offset, count):
+        self.sendfile_calls += 1
+        if self._error:
+            raise OSError(self._error, os.strerror(self._error))
+        return os.sendfile(self._file.fileno(), fd, offset, count)
+
+    def close(self):
+        self._file.close()
+
+
+@pytest.mark.parametrize("offset,size", OFFSET_SIZE)
+def test_send_sendfile(user_file, tmpdir, offset, size):
+    data = b"b" * size
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(b"a" * offset)
+        f.write(data)
+        f.write(b"c" * 8192)
+
+    dst_path = str(tmpdir.join("dst"))
+    dst = SendfileWriter(dst_path)
+    with file.open(user_file.url, "r") as src:
+        op = ops.Send(src, dst, size, offset=offset)
+        op.run()
+    dst.close()
+
+    with io.open(dst_path, "rb") as f:
+        assert f.read() == data
+
+    # Unaligned offset is sent by copying the first buffer, so only large
+    # requests are sure to use sendfile.
+    if size > ops.BUFFERSIZE:
+        assert dst.sendfile_calls > 0
+
+
+@pytest.mark.parametrize("offset,size", OFFSET_SIZE)
+def test_send_sendfile_partial_content(user_file, tmpdir, offset, size):
+    with io.open(user_file.path, "wb") as f:
+        f.truncate(offset + size - 1)
+
+    dst = SendfileWriter(str(tmpdir.join("dst")))
+    with file.open(user_file.url, "r") as src:
+        op = ops.Send(src, dst, size, offset=offset)
+        with pytest.raises(errors.PartialContent) as e:
+            op.run()
+    dst.close()
+
+    assert e.value.requested == size
+    assert e.value.available == size - 1
+
+
+def test_send_sendfile_unsupported(user_file, tmpdir):
+    data = b"b" * 8192
+
+    with io.open(user_file.path, "wb") as f:
+        f.write(data)
+
+    dst_path = str(tmpdir.join("dst"))
+    dst = SendfileWriter(dst_path, error=errno.EINVAL)
+    with file.open(user_file.url, "r") as src:
+        op = ops.Send(src, dst, len(data))
+        op.run()
+    dst.close()
+
+    # Fall back to copying the data.
+    with io.open(dst_path, "rb") as f:
+        assert f.read() == data
+
+
+class FakeSizer(object):
+    """
+    Sizer cycling over sizes on every update.
+    """
+
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.maximum = max(sizes)
+        self.updates = []
+
+    @property
+    def size(self):
+        return self.sizes[len(self.updates) % len(self.sizes)]
+
+    def update(self, count, seconds):
+        self.updates.append(count)
+
+
+def test_send_sizer():
+    data = b"".join(b"%08d" % i for i in range(4096))
+    src = memory.Backend("r", data)
+    dst = io.BytesIO()
+    sizer = FakeSizer([512, 4096, 1024, 8192])
+    op = ops.Send(src, dst, len(data) - 100, offset=100, sizer=sizer)
+    op.run()
+
+    assert dst.getvalue() == data[100:]
+    assert sizer.updates[:4] == [512, 4096, 1024, 8192]
+    assert sum(sizer.updates) == len(data) - 100
+
+
+def test_receive_sizer():
+    data = b"".join(b"%08d" % i for i in range(4096))
+    dst = memory.Backend("r+", bytearray(len(data)))
+    src = io.BytesIO(data)
+    sizer = FakeSizer([512, 4096, 1024, 8192])
+    op = ops.Receive(dst, src, len(data), sizer=sizer)
+    op.run()
+
+    assert dst.data() == data
+    assert sizer.updates[:4] == [512, 4096, 1024, 8192]
+    assert sum(sizer.updates) == len(data)
+
+
+class RecordingWriter(object):
+    """
+    Writer recording the size of every write.
+    """
+
+    def __init__(self):
+        self.buf = io.BytesIO()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(len(data))
+        return self.buf.write(data)
+
+    def flush(self):
+        pass
+
+
+def test_send_adaptive(monkeypatch):
+    # Try the next size after every step.
+    monkeypatch.setattr(sizing.Adaptive, "WINDOW", 1)
+    data = b"".join(b"%08d" % i for i in range(64 * 1024))
+    src = memory.Backend("r", data)
+    dst = RecordingWriter()
+    sizer = sizing.create([src], 64 * 1024, adaptive=True, minimum=4096)
+    op = ops.Send(src, dst, len(data), sizer=sizer)
+    op.run()
+
+    assert dst.buf.getvalue() == data
+    # The step changed while sending.
+    assert len(set(dst.writes)) > 1
+
+
+def test_receive_adaptive(monkeypatch):
+    monkeypatch.setattr(sizing.Adaptive, "WINDOW", 1)
+    data = b"".join(b"%08d" % i for i in range(64 * 1024))
+    dst = memory.Backend("r+", bytearray(len(data)))
+    src = io.BytesIO(data)
+    sizer = sizing.create([dst], 64 * 1024, adaptive=True, minimum=4096)
+    sizes = []
+    readinto = src.readinto
+
+    def recording_readinto(buf):
+        sizes.append(len(buf))
+        return readinto(buf)
+
+    src.readinto = recording_readinto
+    op = ops.Receive(dst, src, len(data), sizer=sizer)
+    op.run()
+
+    assert dst.data() == data
+    assert len(set(sizes)) > 1
+
+
+HOLE = ops.Send.MIN_HOLE_SIZE
+
+
+@pytest.mark.parametrize("offset,size", [
+    pytest.param(0, 4 * HOLE, id="full"),
+    pytest.param(HOLE // 2, 3 * HOLE, id="middle"),
+    pytest.param(HOLE + 42, 2 * HOLE - 42, id="unaligned"),
+    pytest.param(2 * HOLE, HOLE, id="hole"),
+])
+def test_send_skip_holes(offset, size):
+    # The zero extent contains junk; if we read it, we send the junk.
+    src = memory.Backend(
+        "r", b"a" * 2 * HOLE + b"x" * HOLE + b"b" * HOLE)
+    extents = [
+        image.ZeroExtent(0, 2 * HOLE, False),
+        image.ZeroExtent(2 * HOLE, HOLE, True),
+        image.ZeroExtent(3 * HOLE, HOLE, False),
+    ]
+    expected = b"a" * 2 * HOLE + b"\0" * HOLE + b"b" * HOLE
+
+    dst = io.BytesIO()
+    op = ops.Send(src, dst, size, offset=offset, extents=extents)
+    op.run()
+
+    assert dst.getvalue() == expected[offset:offset + size]
+    assert op.done == size
+
+
+def test_send_skip_holes_small_hole():
+    # Zero extents smaller than MIN_HOLE_SIZE are read from the source.
+    src = memory.Backend("r", b"a" * HOLE + b"x" * (HOLE - 1))
+    extents = [
+        image.ZeroExtent(0, HOLE, False),
+        image.ZeroExtent(HOLE, HOLE - 1, True),
+    ]
+    dst = io.BytesIO()
+    op = ops.Send(src, dst, 2 * HOLE - 1, extents=extents)
+    op.run()
+
+    assert dst.getvalue() == b"a" * HOLE + b"x" * (HOLE - 1)
+
+
+def test_send_skip_holes_not_covered():
+    # Ranges not covered by the extents are read from the source.
+    src = memory.Backend("r", b"x" * HOLE + b"b" * HOLE)
+    extents = [image.ZeroExtent(0, HOLE, True)]
+    dst = io.BytesIO()
+    op = ops.Send(src, dst, 2 * HOLE, extents=extents)
+    op.run()
+
+    assert dst.getvalue() == b"\0" * HOLE + b"b" * HOLE
+
+
+def test_send_skip_holes_partial_content():
+    src = memory.Backend("r", b"x" * HOLE + b"b" * 100)
+    extents = [image.ZeroExtent(0, HOLE, True)]
+    op = ops.Send(src, io.BytesIO(), HOLE + 200, extents=extents)
+    with pytest.raises(errors.PartialContent) as e:
+        op.run()
+
+    assert e.value.requested == HOLE + 200
+    assert e.value.available == HOLE + 100
+
+
 def test_send_repr():
     op = ops.Send(None, None, 200, offset=24)
     rep = repr(op)
@@ -126,14 +412,16 @@ def test_send_repr():
     pytest.param(False, id="empty"),
 ])
 @pytest.mark.parametrize("offset,size", OFFSET_SIZE)
-def test_receive_new(user_file, offset, size, preallocated):
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_receive_new(user_file, offset, size, preallocated, queue_depth):
     with io.open(user_file.path, "wb") as f:
         if preallocated:
             f.truncate(offset + size)
 
     src = io.BytesIO(b"x" * size)
     with file.open(user_file.url, "r+") as dst:
-        op = ops.Receive(dst, src, size, offset=offset)
+        op = ops.Receive(
+            dst, src, size, offset=offset, queue_depth=queue_depth)
         op.run()
 
     with io.open(user_file.path, "rb") as f:
@@ -174,13 +462,15 @@ def test_receive_inside(user_file, offset, size):
 
 
 @pytest.mark.parametrize("offset,size", OFFSET_SIZE)
-def test_receive_partial_content(user_file, offset, size):
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_receive_partial_content(user_file, offset, size, queue_depth):
     with io.open(user_file.path, "wb") as f:
         f.truncate(size + offset)
 
     src = io.BytesIO(b"x" * (size - 1))
     with file.open(user_file.url, "r+") as dst:
-        op = ops.Receive(dst, src, size, offset=offset)
+        op = ops.Receive(
+            dst, src, size, offset=offset, queue_depth=queue_depth)
         with pytest.raises(errors.PartialContent) as e:
             op.run()
 
@@ -253,13 +543,14 @@ def test_receive_unbuffered_stream_partial_content(user_file):
 
 
 @pytest.mark.parametrize("offset,size", OFFSET_SIZE)
-def test_receive_no_size(user_file, offset, size):
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_receive_no_size(user_file, offset, size, queue_depth):
     with io.open(user_file.path, "wb") as f:
         f.truncate(offset + size)
 
     src = io.BytesIO(b"x" * size)
     with file.open(user_file.url, "r+") as dst:
-        op = ops.Receive(dst, src, offset=offset)
+        op = ops.Receive(dst, src, offset=offset, queue_depth=queue_depth)
         op.run()
 
     with io.open(user_file.path, "rb") as f:
@@ -372,3 +663,114 @@ def test_flush_repr():
     rep = repr(op)
     assert "Flush" in rep
     assert "done=0" in rep
+
+
+# Benchmarks
+
+BENCH_SIZE = 256 * 1024**2
+
+BENCH_BUFFER_SIZE = [
+    pytest.param(128 * 1024, id="128k"),
+    pytest.param(1024**2, id="1m"),
+    pytest.param(8 * 1024**2, id="8m"),
+]
+
+
+@pytest.fixture
+def bench_file(user_file):
+    """
+    Return url to file on user storage, filled with data.
+    """
+    with io.open(user_file.path, "wb") as f:
+        chunk = b"x" * 8 * 1024**2
+        for i in range(BENCH_SIZE // len(chunk)):
+            f.write(chunk)
+    return user_file.url
+
+
+@pytest.fixture
+def bench_nbd(tmpdir):
+    """
+    Return url to raw image exported by qemu-nbd.
+    """
+    image = str(tmpdir.join("image"))
+    with io.open(image, "wb") as f:
+        f.truncate(BENCH_SIZE)
+    sock = nbd.UnixAddress(tmpdir.join("sock"))
+    with qemu_nbd.run(image, "raw", sock):
+        yield urllib_parse.urlparse(sock.url())
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+def test_send_memory_benchmark(bench, buffer_size):
+    src = memory.Backend("r", bytearray(BENCH_SIZE))
+    op = ops.Send(
+        src, benchmark.Writer(), BENCH_SIZE, buffersize=buffer_size)
+    bench(BENCH_SIZE, op.run)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+def test_receive_memory_benchmark(bench, buffer_size):
+    dst = memory.Backend("r+", bytearray(BENCH_SIZE))
+    op = ops.Receive(
+        dst, benchmark.Reader(BENCH_SIZE), BENCH_SIZE,
+        buffersize=buffer_size)
+    bench(BENCH_SIZE, op.run)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_send_file_benchmark(bench, bench_file, buffer_size, queue_depth):
+    with file.open(bench_file, "r") as src:
+        op = ops.Send(
+            src, benchmark.Writer(), BENCH_SIZE, buffersize=buffer_size,
+            queue_depth=queue_depth)
+        bench(BENCH_SIZE, op.run)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+@pytest.mark.parametrize("queue_depth", QUEUE_DEPTH)
+def test_receive_file_benchmark(bench, bench_file, buffer_size, queue_depth):
+    with file.open(bench_file, "r+") as dst:
+        op = ops.Receive(
+            dst, benchmark.Reader(BENCH_SIZE), BENCH_SIZE,
+            buffersize=buffer_size, queue_depth=queue_depth)
+        bench(BENCH_SIZE, op.run)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("sparse", [True, False])
+def test_zero_file_benchmark(bench, bench_file, sparse):
+    with file.open(bench_file, "r+", sparse=sparse) as dst:
+        op = ops.Zero(dst, BENCH_SIZE, flush=True)
+        bench(BENCH_SIZE, op.run)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+def test_send_nbd_benchmark(bench, bench_nbd, buffer_size):
+    with nbd_backend.open(bench_nbd, "r") as src:
+        op = ops.Send(
+            src, benchmark.Writer(), BENCH_SIZE, buffersize=buffer_size)
+        bench(BENCH_SIZE, op.run)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("buffer_size", BENCH_BUFFER_SIZE)
+def test_receive_nbd_benchmark(bench, bench_nbd, buffer_size):
+    with nbd_backend.open(bench_nbd, "r+") as dst:
+        op = ops.Receive(
+            dst, benchmark.Reader(BENCH_SIZE), BENCH_SIZE,
+            buffersize=buffer_size)
+        bench(BENCH_SIZE, op.run)
+
+
+@pytest.mark.benchmark
+def test_zero_nbd_benchmark(bench, bench_nbd):
+    with nbd_backend.open(bench_nbd, "r+") as dst:
+        op = ops.Zero(dst, BENCH_SIZE, flush=True)
+        bench(BENCH_SIZE, op.run)
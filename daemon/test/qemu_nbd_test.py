@@ -128,6 +128,33 @@ def test_options(tmpdir, fmt, cache, aio, discard):
     qemu_img.compare(src, dst)
 
 
+@pytest.mark.benchmark
+@pytest.mark.parametrize("fmt", ["raw", "qcow2"])
+def test_copy_benchmark(tmpdir, bench, fmt):
+    size = 256 * 1024**2
+    chunk_size = 1024**2
+
+    src = str(tmpdir.join("src." + fmt))
+    qemu_img.create(src, fmt, size=size)
+
+    with qemu_nbd.open(src, fmt) as c:
+        for offset in range(0, size, chunk_size):
+            c.write(offset, b"x" * chunk_size)
+        c.flush()
+
+    dst = str(tmpdir.join("dst." + fmt))
+    qemu_img.create(dst, fmt, size=size)
+
+    src_addr = nbd.UnixAddress(str(tmpdir.join("src.sock")))
+    dst_addr = nbd.UnixAddress(str(tmpdir.join("dst.sock")))
+
+    with qemu_nbd.run(src, fmt, src_addr, read_only=True), \
+            qemu_nbd.run(dst, fmt, dst_addr), \
+            nbd.Client(src_addr) as src_client, \
+            nbd.Client(dst_addr) as dst_client:
+        bench(size, nbdutil.copy, src_client, dst_client)
+
+
 @pytest.mark.parametrize("fmt", ["raw", "qcow2"])
 def test_shared(tmpdir, fmt):
     size = 1024**2
@@ -0,0 +1,127 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from __future__ import absolute_import
+
+import pytest
+
+from ovirt_imageio import sizing
+
+KiB = 1024
+MiB = 1024**2
+
+
+class FakeBackend(object):
+
+    def __init__(self, block_size=1, max_request_size=None):
+        self.block_size = block_size
+        if max_request_size is not None:
+            self.max_request_size = max_request_size
+
+
+def run(sizer, rate):
+    """
+    Run steps until sizer settles, using rate(size) to compute the
+    throughput of every step. Return the sizes tried.
+    """
+    sizes = [sizer.size]
+    while not sizer.settled:
+        for _ in range(sizer.WINDOW):
+            sizer.update(sizer.size, sizer.size / rate(sizer.size))
+        sizes.append(sizer.size)
+    return sizes
+
+
+def test_create_fixed():
+    sizer = sizing.create([FakeBackend()], 8 * MiB)
+    assert isinstance(sizer, sizing.Fixed)
+    assert sizer.size == 8 * MiB
+    assert sizer.maximum == 8 * MiB
+    assert sizer.settled
+
+
+def test_create_max_request_size():
+    backends = [FakeBackend(), FakeBackend(max_request_size=2 * MiB)]
+    sizer = sizing.create(backends, 8 * MiB, adaptive=True)
+    assert sizer.size == 2 * MiB
+    assert sizer.maximum == 2 * MiB
+
+
+def test_create_block_size():
+    backends = [FakeBackend(block_size=512), FakeBackend(block_size=4096)]
+    sizer = sizing.create(backends, 1000 * KiB + 1, adaptive=True)
+    assert sizer.size == 1000 * KiB
+    assert sizer.alignment == 4096
+
+
+def test_create_limits():
+    sizer = sizing.create(
+        [FakeBackend()], 4 * MiB, adaptive=True, minimum=1 * MiB,
+        maximum=16 * MiB)
+    assert sizer.size == 4 * MiB
+    assert sizer.minimum == 1 * MiB
+    assert sizer.maximum == 16 * MiB
+
+
+def test_adaptive_grow():
+    sizer = sizing.Adaptive(1 * MiB, 256 * KiB, 32 * MiB)
+    # Throughput improves up to 8 MiB.
+    sizes = run(sizer, lambda size: min(size, 8 * MiB))
+    assert sizes == [1 * MiB, 2 * MiB, 4 * MiB, 8 * MiB, 16 * MiB, 8 * MiB]
+    assert sizer.size == 8 * MiB
+
+
+def test_adaptive_shrink():
+    sizer = sizing.Adaptive(4 * MiB, 256 * KiB, 32 * MiB)
+    # Throughput improves down to 1 MiB.
+    sizes = run(sizer, lambda size: 1 * MiB**2 / max(size, 1 * MiB))
+    assert sizes == [4 * MiB, 8 * MiB, 2 * MiB, 1 * MiB, 512 * KiB, 1 * MiB]
+    assert sizer.size == 1 * MiB
+
+
+def test_adaptive_stable():
+    sizer = sizing.Adaptive(4 * MiB, 256 * KiB, 32 * MiB)
+    sizes = run(sizer, lambda size: 100 * MiB)
+    assert sizes == [4 * MiB, 8 * MiB, 2 * MiB, 4 * MiB]
+
+
+def test_adaptive_maximum():
+    sizer = sizing.Adaptive(4 * MiB, 256 * KiB, 8 * MiB)
+    sizes = run(sizer, lambda size: size)
+    assert sizes == [4 * MiB, 8 * MiB, 8 * MiB]
+
+
+def test_adaptive_at_maximum():
+    # Cannot grow, so try to shrink.
+    sizer = sizing.Adaptive(8 * MiB, 256 * KiB, 8 * MiB)
+    sizes = run(sizer, lambda size: 1 * MiB**2 / size)
+    assert sizes == [8 * MiB, 4 * MiB, 2 * MiB, 1 * MiB, 512 * KiB,
+                     256 * KiB, 256 * KiB]
+
+
+def test_adaptive_no_range():
+    sizer = sizing.Adaptive(4 * MiB, 4 * MiB, 4 * MiB)
+    assert sizer.settled
+    sizer.update(4 * MiB, 1.0)
+    assert sizer.size == 4 * MiB
+
+
+def test_adaptive_alignment():
+    sizer = sizing.Adaptive(12 * KiB, 4 * KiB, 1 * MiB, alignment=4096)
+    sizes = run(sizer, lambda size: 1 * MiB**2 / size)
+    assert sizes == [12 * KiB, 24 * KiB, 4 * KiB, 4 * KiB]
+
+
+@pytest.mark.parametrize("seconds", [0.0, 1.0])
+def test_adaptive_window(seconds):
+    sizer = sizing.Adaptive(1 * MiB, 256 * KiB, 32 * MiB)
+    for _ in range(sizer.WINDOW - 1):
+        sizer.update(1 * MiB, seconds)
+    assert sizer.size == 1 * MiB
+    sizer.update(1 * MiB, seconds)
+    assert sizer.size == 2 * MiB
@@ -7,6 +7,7 @@
 # (at your option) any later version.
 
 import os
+import socket
 
 from contextlib import contextmanager
 
@@ -15,6 +16,7 @@ import pytest
 from ovirt_imageio import auth
 from ovirt_imageio import config
 from ovirt_imageio import services
+from ovirt_imageio import ssl
 from ovirt_imageio.ssl import check_protocol
 
 
@@ -45,8 +47,9 @@ def test_default_reject(protocol):
 
 
 @pytest.mark.parametrize("protocol", ["-tls1_2"])
-def test_default_accept(protocol):
-    with remote_service("daemon.conf") as service:
+@pytest.mark.parametrize("config_file", ["daemon.conf", "daemon-async.conf"])
+def test_default_accept(protocol, config_file):
+    with remote_service(config_file) as service:
         rc = check_protocol("127.0.0.1", service.port, protocol)
     assert rc == 0
 
@@ -72,3 +75,67 @@ def test_legacy_accept(protocol):
     with remote_service("daemon-tls1_1.conf") as service:
         rc = check_protocol("127.0.0.1", service.port, protocol)
     assert rc == 0
+
+
+@pytest.mark.parametrize("config_file", ["daemon.conf", "daemon-async.conf"])
+def test_session_resumption(config_file):
+    with remote_service(config_file) as service:
+        ctx = ssl.client_context(service._config.tls.ca_file)
+        # Test certificate does not match the host name.
+        ctx.check_hostname = False
+        session = None
+        for i in range(3):
+            sock = socket.create_connection(("127.0.0.1", service.port))
+            with ctx.wrap_socket(
+                    sock, server_hostname="localhost",
+                    session=session) as s:
+                # Wait for the session ticket, sent after the handshake
+                # with TLSv1.3.
+                s.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                s.recv(4096)
+                session = s.session
+
+        stats = service.tls_stats()
+
+    assert stats["hits"] == 2
+    assert stats["hit_rate"] == 2 / 3
+
+
+@pytest.mark.parametrize("enable", [True, False])
+def test_session_tickets(enable):
+    ctx = ssl.server_context(
+        "test/pki/cert.pem",
+        "test/pki/key.pem",
+        cafile="test/pki/ca.pem",
+        session_tickets=enable)
+    assert bool(ctx.options & ssl.ssl.OP_NO_TICKET) != enable
+
+
+def test_ktls_supported():
+    # Depends on Python, OpenSSL and kernel, but must not fail.
+    assert ssl.ktls_supported() in (True, False)
+
+
+def test_server_context_ktls():
+    ctx = ssl.server_context(
+        "test/pki/cert.pem",
+        "test/pki/key.pem",
+        cafile="test/pki/ca.pem",
+        enable_ktls=True)
+    if ssl.ktls_supported():
+        assert ctx.options & ssl.ssl.OP_ENABLE_KTLS
+
+
+def test_can_sendfile_plain():
+    a, b = socket.socketpair()
+    with a, b:
+        assert ssl.can_sendfile(a)
+
+
+def test_can_sendfile_userspace_tls():
+    with remote_service("daemon.conf") as service:
+        ctx = ssl.client_context(service._config.tls.ca_file)
+        ctx.check_hostname = False
+        sock = socket.create_connection(("127.0.0.1", service.port))
+        with ctx.wrap_socket(sock, server_hostname="localhost") as s:
+            assert not ssl.can_sendfile(s)
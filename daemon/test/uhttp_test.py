@@ -22,10 +22,13 @@ from ovirt_imageio import util
 from ovirt_imageio import uhttp
 
 
-@pytest.fixture(scope="session")
+@pytest.fixture(
+    scope="session",
+    params=[uhttp.Server, uhttp.AsyncServer],
+    ids=["threading", "async"])
 def uhttpserver(request):
     tmp = tempfile.NamedTemporaryFile()
-    server = uhttp.Server(tmp.name, uhttp.Connection)
+    server = request.param(tmp.name, uhttp.Connection)
     util.start_thread(server.serve_forever, kwargs={"poll_interval": 0.1})
     request.addfinalizer(server.shutdown)
     request.addfinalizer(tmp.close)
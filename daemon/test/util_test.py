@@ -9,6 +9,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import json
 import os
 import signal
 import time
@@ -166,7 +167,9 @@ def test_clock_measure_multiple(fake_time):
     c.stop("sync")
     c.stop("total")
     assert str(c) == (
-        "[total=5.000000/1, read=2.000000/2, write=2.000000/2, "
+        "[total=5.000000/1, "
+        "read=2.000000/2 (p50=1.000000 p99=1.000000 max=1.000000), "
+        "write=2.000000/2 (p50=1.000000 p99=1.000000 max=1.000000), "
         "sync=1.000000/1]")
 
 
@@ -180,6 +183,21 @@ def test_clock_running(fake_time):
     assert str(c) == "[total=7.000000/1, read=4.000000/1]"
 
 
+def test_clock_percentiles(fake_time):
+    c = util.Clock()
+    for i in range(99):
+        with c.run("write"):
+            fake_time.value += 0.001
+    with c.run("write"):
+        fake_time.value += 5
+    h = c._timers["write"].histogram
+    assert h.count == 100
+    assert h.percentile(50) == pytest.approx(0.001, rel=0.07)
+    assert h.percentile(99) == pytest.approx(0.001, rel=0.07)
+    assert h.percentile(100) == pytest.approx(5)
+    assert h.max == pytest.approx(5)
+
+
 # Inccorrect usage
 
 def test_clock_start_twice():
@@ -237,6 +255,90 @@ def test_benchmark():
     print(c)
 
 
+def test_histogram_empty():
+    h = util.Histogram()
+    assert h.count == 0
+    assert h.percentile(50) == 0
+
+
+@pytest.mark.parametrize("usec", [0, 1, 31, 32, 33, 1000, 123456, 10**9])
+def test_histogram_error(usec):
+    h = util.Histogram()
+    # Record also smaller and larger values, so the percentile is not
+    # clamped to the minimum and maximum values.
+    h.record(0)
+    h.record(usec / 1000000.0)
+    h.record(10**10 / 1000000.0)
+    value = h.percentile(50) * 1000000
+    assert abs(value - usec) <= usec * 2**(1 - util.Histogram.SUB_BITS)
+
+
+def test_histogram_buckets():
+    h = util.Histogram()
+    for usec in range(util.Histogram.MAX_VALUE.bit_length() * 100):
+        i = h._index(usec)
+        low, high = h._range(i)
+        assert low <= usec <= high
+
+
+def test_histogram_record_buckets():
+    for usec in range(0, util.Histogram.MAX_VALUE.bit_length() * 100, 7):
+        h = util.Histogram()
+        h.record(usec / 1000000.0)
+        i, = h.counts
+        low, high = h._range(i)
+        assert low <= int(usec / 1000000.0 * 1000000) <= high
+
+
+def test_histogram_negative_value():
+    h = util.Histogram()
+    h.record(-1.0)
+    assert list(h.counts) == [0]
+
+
+def test_histogram_max_value():
+    h = util.Histogram()
+    h.record(10**6)
+    assert max(h.counts) == h._index(util.Histogram.MAX_VALUE)
+    assert h.max == 10**6
+
+
+def test_histogram_percentiles():
+    h = util.Histogram()
+    for i in range(1, 101):
+        h.record(i / 1000.0)
+    assert h.percentile(50) == pytest.approx(0.050, rel=0.07)
+    assert h.percentile(90) == pytest.approx(0.090, rel=0.07)
+    assert h.percentile(99) == pytest.approx(0.099, rel=0.07)
+    assert h.percentile(0) == pytest.approx(0.001, rel=0.07)
+    assert h.percentile(100) == 0.1
+
+
+def test_histogram_merge():
+    a = util.Histogram()
+    b = util.Histogram()
+    for i in range(1, 51):
+        a.record(i / 1000.0)
+    for i in range(51, 101):
+        b.record(i / 1000.0)
+    a.merge(b)
+    assert a.count == 100
+    assert a.sum == pytest.approx(5.05)
+    assert a.min == 0.001
+    assert a.max == 0.1
+    assert a.percentile(90) == pytest.approx(0.090, rel=0.07)
+
+
+def test_histogram_state():
+    h = util.Histogram()
+    for i in range(1, 101):
+        h.record(i / 1000.0)
+    state = json.loads(json.dumps(h.state()))
+    copy = util.Histogram.from_state(state)
+    assert copy.counts == h.counts
+    assert copy.percentile(50) == h.percentile(50)
+
+
 @pytest.mark.parametrize("size,rounded", [
     (0, 0),
     (1, 512),
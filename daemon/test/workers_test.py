@@ -0,0 +1,232 @@
+# ovirt-imageio
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+from __future__ import absolute_import
+
+import json
+
+import pytest
+
+from ovirt_imageio import config
+from ovirt_imageio import services
+from ovirt_imageio import workers
+
+from . import http
+from . import testutil
+
+from . marks import requires_python3
+
+pytestmark = requires_python3
+
+
+@pytest.fixture(scope="module")
+def daemon():
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.daemon.workers = 2
+    w = workers.Workers(cfg)
+    w.start()
+    try:
+        auth = workers.Authorizer(w)
+        control = services.ControlService(cfg, auth, workers=w)
+        control.start()
+        try:
+            yield cfg, w
+        finally:
+            control.stop()
+    finally:
+        w.stop()
+
+
+@pytest.mark.parametrize("option", ["cache_size", "write_buffer_size"])
+def test_unsupported_options(option):
+    cfg = config.load(["test/conf/daemon.conf"])
+    cfg.daemon.workers = 2
+    setattr(cfg.daemon, option, 1024**2)
+    with pytest.raises(ValueError):
+        workers.Workers(cfg)
+
+
+def test_start(daemon):
+    cfg, w = daemon
+    assert len(w.sockets) == 2
+    assert cfg.remote.port != 0
+    assert cfg.local.socket != ""
+
+
+def test_ticket_replicated(daemon, tmpdir):
+    cfg, w = daemon
+    image = testutil.create_tempfile(tmpdir, "image", b"x" * 8 * 4096)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=8 * 4096, ops=["read"])
+
+    with http.UnixClient(cfg.control.socket) as c:
+        res = c.request(
+            "PUT", "/tickets/" + ticket["uuid"], json.dumps(ticket))
+        assert res.status == 200
+        res.read()
+
+    # Every worker has the ticket.
+    for address in w.sockets:
+        with http.UnixClient(address) as c:
+            res = c.request("GET", "/tickets/" + ticket["uuid"])
+            assert res.status == 200
+            res.read()
+
+    # Every connection may be served by another worker.
+    for i in range(8):
+        with http.Client(cfg) as c:
+            res = c.get(
+                "/images/" + ticket["uuid"],
+                headers={"Range": "bytes={}-{}".format(
+                    i * 4096, (i + 1) * 4096 - 1)})
+            assert res.status == 206
+            assert res.read() == b"x" * 4096
+
+    with http.UnixClient(cfg.control.socket) as c:
+        res = c.request("GET", "/tickets/" + ticket["uuid"])
+        assert res.status == 200
+        info = json.loads(res.read())
+        assert info["transferred"] == 8 * 4096
+        assert not info["active"]
+
+    with http.UnixClient(cfg.control.socket) as c:
+        res = c.request("DELETE", "/tickets/" + ticket["uuid"])
+        assert res.status == 204
+        res.read()
+
+    for address in w.sockets:
+        with http.UnixClient(address) as c:
+            res = c.request("GET", "/tickets/" + ticket["uuid"])
+            assert res.status == 404
+            res.read()
+
+
+def test_local_service(daemon, tmpdir):
+    cfg, w = daemon
+    image = testutil.create_tempfile(tmpdir, "image", b"y" * 4096)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=4096, ops=["read"])
+
+    with http.UnixClient(cfg.control.socket) as c:
+        res = c.request(
+            "PUT", "/tickets/" + ticket["uuid"], json.dumps(ticket))
+        assert res.status == 200
+        res.read()
+
+    try:
+        for i in range(4):
+            with http.UnixClient(cfg.local.socket) as c:
+                res = c.request("GET", "/images/" + ticket["uuid"])
+                assert res.status == 200
+                assert res.read() == b"y" * 4096
+    finally:
+        with http.UnixClient(cfg.control.socket) as c:
+            c.request("DELETE", "/tickets/").read()
+
+
+def test_extend(daemon):
+    cfg, w = daemon
+    ticket = testutil.create_ticket(ops=["read"])
+
+    with http.UnixClient(cfg.control.socket) as c:
+        c.request(
+            "PUT", "/tickets/" + ticket["uuid"], json.dumps(ticket)).read()
+
+    try:
+        with http.UnixClient(cfg.control.socket) as c:
+            res = c.request(
+                "PATCH", "/tickets/" + ticket["uuid"],
+                json.dumps({"timeout": 600}))
+            assert res.status == 200
+            res.read()
+
+        expires = set()
+        for address in w.sockets:
+            with http.UnixClient(address) as c:
+                res = c.request("GET", "/tickets/" + ticket["uuid"])
+                info = json.loads(res.read())
+                assert info["timeout"] == 300
+                expires.add(info["expires"])
+
+        with http.UnixClient(cfg.control.socket) as c:
+            res = c.request("GET", "/tickets/" + ticket["uuid"])
+            info = json.loads(res.read())
+            assert info["expires"] == max(expires)
+    finally:
+        with http.UnixClient(cfg.control.socket) as c:
+            c.request("DELETE", "/tickets/").read()
+
+
+def test_metrics(daemon, tmpdir):
+    cfg, w = daemon
+    image = testutil.create_tempfile(tmpdir, "image", b"z" * 4096)
+    ticket = testutil.create_ticket(
+        url="file://" + str(image), size=4096, ops=["read"])
+
+    with http.UnixClient(cfg.control.socket) as c:
+        c.request(
+            "PUT", "/tickets/" + ticket["uuid"], json.dumps(ticket)).read()
+
+    try:
+        before = read_bytes(cfg)
+        for i in range(4):
+            with http.Client(cfg) as c:
+                c.get("/images/" + ticket["uuid"]).read()
+        after = read_bytes(cfg)
+    finally:
+        with http.UnixClient(cfg.control.socket) as c:
+            c.request("DELETE", "/tickets/").read()
+
+    # Reads served by all workers are included.
+    assert after - before == 4 * 4096
+
+    with http.UnixClient(cfg.control.socket) as c:
+        res = c.request("GET", "/metrics")
+        assert res.status == 200
+        text = res.read().decode("utf-8")
+
+    assert 'ovirt_imageio_bytes_total{op="read",backend="file"}' in text
+
+
+def read_bytes(cfg):
+    with http.UnixClient(cfg.control.socket) as c:
+        res = c.request("GET", "/metrics?format=json")
+        samples = json.loads(res.read())
+    values = dict(
+        (tuple(labels), value)
+        for labels, value in samples["ovirt_imageio_bytes_total"])
+    return values.get(("read", "file"), 0)
+
+
+def test_merge_info():
+    info = {"active": False, "expires": 100, "idle_time": 50,
+            "transferred": 0, "uuid": "id"}
+    infos = [
+        {"active": False, "expires": 120, "idle_time": 30,
+         "transferred": 100, "uuid": "id"},
+        {"active": True, "expires": 110, "idle_time": 0,
+         "transferred": 200, "uuid": "id"},
+    ]
+    assert workers.merge_info(info, infos) == {
+        "active": True,
+        "expires": 120,
+        "idle_time": 0,
+        "transferred": 300,
+        "uuid": "id",
+    }
+
+
+def test_merge_info_transferred_unknown():
+    info = {"active": False, "expires": 100, "idle_time": 50,
+            "transferred": 0}
+    infos = [
+        {"active": False, "expires": 100, "idle_time": 50,
+         "transferred": 100},
+        {"active": True, "expires": 100, "idle_time": 0},
+    ]
+    assert "transferred" not in workers.merge_info(info, infos)
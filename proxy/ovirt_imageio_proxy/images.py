@@ -14,6 +14,10 @@ import config
 
 from . import web
 
+# Daemon features supported by forwarding requests as is, when the daemon
+# supports them: batched PATCH requests, and compressed data encodings.
+FORWARDED_FEATURES = {"batch", "gzip", "zstd"}
+
 
 class RequestHandler(object):
     """
@@ -82,6 +86,7 @@ class RequestHandler(object):
                 "invalid JSON or missing 'features'")
 
         allow = allow.intersection(daemon_allow)
+        features = features.union(FORWARDED_FEATURES)
         features = features.intersection(daemon_features)
         return web.response(payload={"features": list(features)},
                             allow=','.join(allow))
@@ -96,6 +101,12 @@ class RequestHandler(object):
         if 'Range' in self.request.headers:
             headers['Range'] = self.request.headers['Range']
 
+        # Requests accepts gzip by default, decompressing the response;
+        # accept only what the client accepts, and forward compressed data
+        # as is.
+        headers['Accept-Encoding'] = self.request.headers.get(
+            'Accept-Encoding', 'identity')
+
         body = ""
         stream = True  # Don't let Requests read entire body into memory
 
@@ -116,10 +127,17 @@ class RequestHandler(object):
             response.headers['Content-Disposition'] = disposition
 
 
+        encoding = imaged_response.headers.get('Content-Encoding')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+            # Content-Length is the size of the compressed data.
+            chunks = imaged_response.raw.stream(4096, decode_content=False)
+        else:
+            chunks = imaged_response.iter_content(4096, False)
+
         max_transfer_bytes = int(imaged_response.headers.get('Content-Length'))
-        response.body_file = web.CappedStream(RequestStreamAdapter(
-            imaged_response.iter_content(4096, False)),
-            max_transfer_bytes)
+        response.body_file = web.CappedStream(RequestStreamAdapter(chunks),
+                                              max_transfer_bytes)
         response.headers['Content-Length'] = str(max_transfer_bytes)
         logging.debug("Resource %s: transferring %d bytes from host",
                       res_id, max_transfer_bytes)
@@ -145,6 +163,9 @@ class RequestHandler(object):
         headers['Content-Length'] = self.request.headers['Content-Length']
         if 'Content-Range' in self.request.headers:
             headers['Content-Range'] = self.request.headers['Content-Range']
+        if 'Content-Encoding' in self.request.headers:
+            headers['Content-Encoding'] = \
+                self.request.headers['Content-Encoding']
 
         max_transfer_bytes = int(headers['Content-Length'])
         body = web.CappedStream(self.request.body_file, max_transfer_bytes)
@@ -143,6 +143,57 @@ def test_images_get_imaged_with_authorization(proxy_server, signed_ticket):
     assert res.getheader("content-disposition") == "attachment; filename=\xd7\x90"
 
 
+def test_images_get_imaged_compressed(proxy_server, signed_ticket):
+    auth.add_signed_ticket(signed_ticket.data)
+
+    body = "compressed"
+    request_headers = {
+        "Range": "bytes=0-99",
+        "Accept-Encoding": "gzip",
+    }
+    response_headers = {
+        "Content-Range": "bytes 0-99/100",
+        "Content-Length": str(len(body)),
+        "Content-Encoding": "gzip",
+    }
+    path = "/images/" + signed_ticket.id
+
+    with requests_mock.Mocker() as m:
+        m.get(signed_ticket.url + path,
+              status_code=206,
+              text=body,
+              headers=response_headers)
+        res = http.request(proxy_server, "GET", path, headers=request_headers)
+
+    # The client Accept-Encoding is forwarded to the daemon.
+    assert m.called
+    assert m.last_request.headers["Accept-Encoding"] == "gzip"
+
+    # Compressed data is forwarded as is.
+    assert res.status == 206
+    assert res.getheader("content-encoding") == "gzip"
+    assert res.getheader("content-length") == str(len(body))
+    assert res.read() == body
+
+
+def test_images_get_imaged_identity(proxy_server, signed_ticket):
+    auth.add_signed_ticket(signed_ticket.data)
+    path = "/images/" + signed_ticket.id
+
+    with requests_mock.Mocker() as m:
+        m.get(signed_ticket.url + path,
+              status_code=200,
+              text="hello",
+              headers={"Content-Length": "5"})
+        res = http.request(proxy_server, "GET", path)
+
+    # The proxy must not accept compressed data the client did not accept.
+    assert m.last_request.headers["Accept-Encoding"] == "identity"
+    assert res.status == 200
+    assert res.getheader("content-encoding") is None
+    assert res.read() == "hello"
+
+
 def test_images_get_imaged_with_installed_ticket(proxy_server, signed_ticket):
     auth.add_signed_ticket(signed_ticket.data)
 
@@ -233,6 +284,34 @@ def test_images_put_imaged_200_ok(proxy_server, signed_ticket):
     assert read_timeout == proxy_server.imaged_read_timeout_sec
 
 
+def test_images_put_imaged_compressed(proxy_server, signed_ticket):
+    auth.add_signed_ticket(signed_ticket.data)
+
+    body = "compressed"
+    client_headers = {
+        "Content-Range": "bytes 0-99/*",
+        "Content-Encoding": "gzip",
+    }
+    path = "/images/" + signed_ticket.id
+
+    proxy_headers = {
+        "Content-Length": str(len(body)),
+        "Content-Range": "bytes 0-99/*",
+        "Content-Encoding": "gzip",
+    }
+
+    with requests_mock.Mocker() as m:
+        m.put(signed_ticket.url + path,
+              status_code=200,
+              text=None,
+              request_headers=proxy_headers)
+        res = http.request(proxy_server, "PUT", path, body=body,
+                           headers=client_headers)
+
+    assert m.called
+    assert res.status == 200
+
+
 def test_images_put_imaged_without_content_range(proxy_server, signed_ticket):
     auth.add_signed_ticket(signed_ticket.data)
 
@@ -515,6 +594,31 @@ def test_images_options_newer_daemon(proxy_server, signed_ticket):
     assert "unix_socket" not in proxy_options
 
 
+def test_images_options_daemon_forwarded_features(proxy_server,
+                                                  signed_ticket):
+    auth.add_signed_ticket(signed_ticket.data)
+
+    path = "/images/" + signed_ticket.id
+
+    # Batched PATCH requests and compressed data are forwarded as is, so
+    # the proxy supports them if the daemon does.
+    daemon_features = {"zero", "flush", "batch", "zstd", "gzip"}
+    daemon_body = json.dumps({"features": list(daemon_features)})
+    daemon_headers = {"Content-Type": "application/json",
+                      "Content-Length": "%d" % len(daemon_body),
+                      "Allow": "OPTIONS,GET,PUT,PATCH"}
+
+    with requests_mock.Mocker() as m:
+        m.options(requests_mock.ANY,
+                  status_code=200,
+                  text=daemon_body,
+                  headers=daemon_headers)
+        res = http.request(proxy_server, "OPTIONS", path)
+
+    assert res.status == 200
+    assert set(json.loads(res.read())["features"]) == daemon_features
+
+
 def test_images_options_old_daemon_without_options(proxy_server, signed_ticket):
     auth.add_signed_ticket(signed_ticket.data)
 